@@ -2,26 +2,196 @@
 
 BASE_URL = "http://dist.blizzard.com.edgesuite.net/tpr/wow/config"
 
-import configparser, os, glob, sys, io, collections
+import configparser, os, glob, sys, io, collections, collections.abc, hashlib, struct, mmap, json, array
 
-import jenkins
+import jenkins, casc
+
+# Listfile hash to name table. The listfile is compiled once into a binary
+# table next to it (listfile + '.hashes'), and later runs map the table in,
+# instead of hashing every name again. The table is rebuilt when the size,
+# mtime, or the contents of the listfile change.
+class DBFileList(collections.abc.Mapping):
+	_MAGIC = b'CASCLIST'
+	_VERSION = 1
+	_HEADER = struct.Struct('<8sII')
+	_ALIGN = 16
+	_SUFFIX = '.hashes'
 
-class DBFileList(collections.Mapping):
 	def __init__(self, options):
-		collections.Mapping.__init__(self)
+		collections.abc.Mapping.__init__(self)
 
 		self.options = options
 
-		self.files = {}
+		# Hash to name index lookup, and names sorted by their upper case
+		# form, with their offsets and hashes
+		self.index = None
+		self.names = b''
+		self.offsets = None
+		self.hashes = None
+		self.map = None
 
 	def __getitem__(self, key):
-		return self.files.__getitem__(key)
+		idx = self.index.get(key)
+		if idx is None:
+			raise KeyError(key)
+
+		return self.__name(idx)
 
 	def __iter__(self):
-		return self.files.__iter__()
+		for idx in range(0, self.index.n_entries):
+			yield self.index.key.unpack_from(self.index.keys, idx * self.index.key.size)[0]
 
 	def __len__(self):
-		return self.files.__len__()
+		return self.index.n_entries
+
+	def items(self):
+		for idx in range(0, self.index.n_entries):
+			yield (self.index.key.unpack_from(self.index.keys, idx * self.index.key.size)[0],
+				self.__name(self.index.record.unpack_from(self.index.records, idx * self.index.record.size)[0]))
+
+	def __name(self, idx):
+		start, end = self.offsets[idx], self.offsets[idx + 1]
+		return bytes(self.names[start:end]).decode('utf-8')
+
+	# Name to hash lookup through the listfile, returns None for unlisted names
+	def file_hash(self, file_name):
+		name = file_name.strip().replace('/', '\\').upper()
+
+		start, end = 0, len(self.hashes)
+		while start < end:
+			mid = (start + end) // 2
+			if self.__name(mid).upper() < name:
+				start = mid + 1
+			else:
+				end = mid
+
+		if start < len(self.hashes) and self.__name(start).upper() == name:
+			return self.hashes[start]
+
+		return None
+
+	def table_path(self):
+		return self.options.dbfile + DBFileList._SUFFIX
+
+	def __source(self):
+		info = os.stat(self.options.dbfile)
+		return { 'size': info.st_size, 'mtime': info.st_mtime_ns }
+
+	def __load(self, source, source_md5 = None):
+		path = self.table_path()
+		if not os.access(path, os.R_OK) or os.stat(path).st_size <= DBFileList._HEADER.size:
+			return False
+
+		with open(path, 'rb') as f:
+			data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+		magic, version, header_len = DBFileList._HEADER.unpack_from(data, 0)
+		if magic != DBFileList._MAGIC or version != DBFileList._VERSION:
+			data.close()
+			return False
+
+		offset = DBFileList._HEADER.size
+		header = json.loads(data[offset:offset + header_len].decode('utf-8'))
+		if header['byteorder'] != sys.byteorder or header['size'] != source['size'] or \
+				(header['mtime'] != source['mtime'] and header['md5'] != source_md5):
+			data.close()
+			return False
+
+		view = memoryview(data)
+		sections = dict([ (name, view[offset:offset + length]) for name, (offset, length) in header['sections'].items() ])
+
+		self.index = casc.CASCCompactIndex('Q', 'I')
+		self.index.keys = sections['keys']
+		self.index.records = sections['records']
+		self.index.n_entries = self.index.n_keys = header['n_entries']
+		self.names = sections['names']
+		self.offsets = sections['offsets'].cast('I')
+		self.hashes = sections['hashes'].cast('Q')
+		self.map = data
+
+		return True
+
+	def __save(self, source, source_md5):
+		sections = collections.OrderedDict([
+			('keys', self.index.keys),
+			('records', self.index.records),
+			('names', self.names),
+			('offsets', self.offsets),
+			('hashes', self.hashes),
+		])
+
+		header = {
+			'byteorder' : sys.byteorder,
+			'size'      : source['size'],
+			'mtime'     : source['mtime'],
+			'md5'       : source_md5,
+			'n_entries' : self.index.n_entries,
+		}
+
+		# Header length depends on the section offsets, so reserve room for them
+		header_len = len(json.dumps(header)) + 64 * (len(sections) + 1)
+		offset = self.__align(DBFileList._HEADER.size + header_len)
+		header['sections'] = {}
+		for name, section in sections.items():
+			header['sections'][name] = (offset, memoryview(section).nbytes)
+			offset = self.__align(offset + memoryview(section).nbytes)
+
+		header_data = json.dumps(header).encode('utf-8')
+		header_data += b' ' * (header_len - len(header_data))
+
+		path = self.table_path()
+		tmp_path = '%s.%u.tmp' % (path, os.getpid())
+		try:
+			with open(tmp_path, 'wb') as f:
+				f.write(DBFileList._HEADER.pack(DBFileList._MAGIC, DBFileList._VERSION, header_len))
+				f.write(header_data)
+				for name, section in sections.items():
+					f.write(bytes(header['sections'][name][0] - f.tell()))
+					f.write(section)
+
+			# Write then rename, so an interrupted run never leaves a truncated table
+			os.replace(tmp_path, path)
+		except OSError:
+			# The table is only an optimization, read-only listfile locations
+			# just hash the names on every run
+			if os.path.exists(tmp_path):
+				os.unlink(tmp_path)
+
+	def __align(self, offset):
+		return (offset + DBFileList._ALIGN - 1) & ~(DBFileList._ALIGN - 1)
+
+	def __build(self, data):
+		file_names = {}
+		for line in data.decode('utf-8').splitlines():
+			cleaned_file = line.strip().replace('/', '\\')
+			if not cleaned_file:
+				continue
+
+			base_fname = os.path.splitext(cleaned_file)[0]
+
+			file_names[cleaned_file.upper()] = cleaned_file
+			for ext in [ '.db2', '.dbc' ]:
+				file_names[(base_fname + ext).upper()] = base_fname + ext
+
+		upper_names = sorted(file_names.keys())
+		hash_values = jenkins.hashlittle2_many(upper_names)
+
+		# A hash names the last listed file with it
+		hash_names = dict(zip(hash_values, range(0, len(upper_names))))
+
+		names = [ file_names[name].encode('utf-8') for name in upper_names ]
+		offsets = [ 0 ]
+		for name in names:
+			offsets.append(offsets[-1] + len(name))
+
+		self.names = b''.join(names)
+		self.offsets = array.array('I', offsets)
+		self.hashes = array.array('Q', hash_values)
+
+		self.index = casc.CASCCompactIndex('Q', 'I')
+		self.index.extend(struct.pack('>%uQ' % len(hash_names), *hash_names.keys()),
+			struct.pack('<%uI' % len(hash_names), *hash_names.values()))
+		self.index.finalize()
 
 	def open(self):
 		if not self.options.dbfile:
@@ -32,19 +202,19 @@ class DBFileList(collections.Mapping):
 			self.options.parser.error('Unable to open filename list %s' % self.options.dbfile)
 			return False
 
-		with open(self.options.dbfile, 'r') as f:
-			for line in f:
-				cleaned_file = line.strip().replace('/', '\\')
-				base_fname = os.path.splitext(cleaned_file)[0]
+		source = self.__source()
+		if self.__load(source):
+			return True
 
-				hash_value = jenkins.hashlittle2(cleaned_file.upper())
-				self.files[(hash_value[0] << 32) | hash_value[1]] = cleaned_file
+		with open(self.options.dbfile, 'rb') as f:
+			data = f.read()
 
-				for ext in [ '.db2', '.dbc' ]:
-					final_file = base_fname + ext
-					hash_value = jenkins.hashlittle2(final_file.upper())
+		# Touched, but unchanged listfiles keep their table
+		source_md5 = hashlib.md5(data).hexdigest()
+		if not self.__load(source, source_md5):
+			self.__build(data)
 
-					self.files[(hash_value[0] << 32) | hash_value[1]] = final_file
+		self.__save(source, source_md5)
 
 		return True
 
@@ -55,6 +225,7 @@ class BuildCfg(object):
 		self.build_cfg_file = None
 		self.cdn_domain = None
 		self.cdn_dir = None
+		self.snapshot = None
 
 	def open(self):
 		if not self.options.data_dir:
@@ -79,7 +250,7 @@ class BuildCfg(object):
 			self.options.parser.error('Unknown file format for .build.info file, expected 14 fields, got %u' % len(line_split))
 
 		self.build_cfg_file = line_split[2]
-		self.cdn_domain = line_split[7].split(' ')[0].strip()
+		self.cdn_domain = getattr(self.options, 'cdn_host', None) or line_split[7].split(' ')[0].strip()
 		self.cdn_dir = line_split[6]
 
 		if len(self.build_cfg_file) == 0:
@@ -103,6 +274,9 @@ class BuildCfg(object):
 
 		print('Wow build: %s' % line_split[-1])
 
+		if getattr(self.options, 'snapshot', False):
+			self.snapshot = casc.CASCSnapshot(self.options, self.build_cfg_file, hashlib.md5(''.join(build_lines).encode('utf-8')).hexdigest())
+
 		return True
 
 	def root_file(self):
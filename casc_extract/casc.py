@@ -1,6 +1,14 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
 # CASC file formats, based on the work of Caali et al. @ http://www.ownedcore.com/forums/world-of-warcraft/world-of-warcraft-model-editing/471104-analysis-of-casc-filesystem.html
-import os, sys, mmap, hashlib, stat, struct, zlib, glob, re, urllib.request, urllib.error, collections, codecs, io
+import os, sys, mmap, hashlib, stat, struct, zlib, glob, re, urllib.request, urllib.error, collections, codecs, io, bisect, operator, json, shutil, time, atexit
+import http.client, http.server, threading, random, functools, itertools
+import concurrent.futures, multiprocessing, queue, traceback, array
+
+# NumPy is optional, and only used to sort and decode large tables in bulk
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 import jenkins
 
@@ -11,12 +19,303 @@ _CHUNK_HEADER_2_LEN = 8
 _CHUNK_SUM_LEN = 16
 _MARKER_LEN = 1
 _BLOCK_DATA_SIZE = 65535
+_DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+_PARTIAL_SUFFIX = '.part'
+
+_ROOT_BLOCK_HEADER = struct.Struct('<iII')
+_ROOT_ENTRY = struct.Struct('<16sQ')
+_ROOT_MD5 = struct.Struct('16s')
 
 _NULL_CHUNK = 0x00
 _COMPRESSED_CHUNK = 0x5A
 _UNCOMPRESSED_CHUNK = 0x4E
 
 CDNIndexRecord = collections.namedtuple( 'CDNIndexRecord', [ 'index', 'size', 'offset' ] )
+# A single CDN request. The response is split into (offset, size, cache path,
+# checksum, resume) parts, offsets are relative to the archive, start is the
+# first byte requested. A size of None means the rest of the response. resume
+# is the number of bytes of the part already in its partial file.
+CDNRequest = collections.namedtuple( 'CDNRequest', [ 'url', 'headers', 'start', 'parts' ] )
+
+# Parse the requested (first byte, last byte) from the Range header of headers,
+# last is None for an open ended range
+def _http_range(headers):
+	if not headers or 'Range' not in headers:
+		return 0, None
+
+	mobj = re.match('^bytes=([0-9]+)-([0-9]*)$', headers['Range'])
+	if not mobj:
+		return 0, None
+
+	if mobj.group(2) == '':
+		return int(mobj.group(1)), None
+
+	return int(mobj.group(1)), int(mobj.group(2))
+
+# Range header value of bytes first to last, or to the end of the file if
+# last is None
+def _http_range_value(first, last):
+	if last is None:
+		return 'bytes=%d-' % first
+
+	return 'bytes=%d-%d' % (first, last)
+
+# headers for the rest of the range of headers, after its first offset bytes
+def _resume_headers(headers, offset):
+	if offset == 0:
+		return headers
+
+	first, last = _http_range(headers)
+	resume_headers = dict(headers or {})
+	resume_headers['Range'] = _http_range_value(first + offset, last)
+	return resume_headers
+
+def _md5_handle(handle, length = None):
+	md5 = hashlib.md5()
+	handle.seek(0)
+	while length is None or length > 0:
+		data = handle.read(length is None and _DOWNLOAD_BLOCK_SIZE or min(length, _DOWNLOAD_BLOCK_SIZE))
+		if not data:
+			break
+
+		md5.update(data)
+		if length is not None:
+			length -= len(data)
+
+	return md5
+
+# Download checksums, called with a seekable handle to the downloaded data
+def md5_checksum(md5s):
+	return lambda handle: _md5_handle(handle).hexdigest() == md5s
+
+# The key of a BLTE encoded file is the MD5 of its header, or of the whole
+# file if it has no chunk table. The header alone does not cover the chunk
+# data, so a file with a chunk table must also be as long as the table says,
+# or a truncated download would pass.
+def blte_checksum(key):
+	def check(handle):
+		handle.seek(0)
+		header = handle.read(8)
+		if len(header) < 8 or header[:4] != _BLTE_MAGIC:
+			return False
+
+		header_len = struct.unpack('>I', header[4:])[0]
+		if header_len > 0:
+			table = handle.read(header_len - 8)
+			n_chunks = len(table) >= 4 and struct.unpack('>I', table[:4])[0] & 0xFFFFFF or 0
+			if len(table) < 4 + n_chunks * 24:
+				return False
+
+			length = header_len + sum([ c_len for c_len, out_len, md5 in struct.iter_unpack('>II16s', table[4:4 + n_chunks * 24]) ])
+			if handle.seek(0, os.SEEK_END) != length:
+				return False
+
+		return _md5_handle(handle, header_len or None).digest() == key
+
+	return check
+
+# Compact, read-only lookup table for fixed width keys and records (--compact-index).
+# Keys and records are packed into contiguous buffers sorted by key, and
+# looked up with a binary search, instead of holding a Python object per
+# entry in a dict. Entries are added with add(), and the table can be used
+# after finalize(). A lookup returns the last record added for the key, or
+# a list of all of the key's records in insertion order if multi is set.
+class CASCCompactIndex(object):
+	def __init__(self, key_format, record_format, record_type = None, multi = False):
+		# Big endian keys sort the same as bytes and as integers
+		self.key = struct.Struct('>' + key_format)
+		self.record = struct.Struct('<' + record_format)
+		self.record_type = record_type
+		self.multi = multi
+
+		self.keys = bytearray()
+		self.records = bytearray()
+		self.n_entries = 0
+		self.n_keys = 0
+
+	def __len__(self):
+		return self.n_keys
+
+	def __contains__(self, key):
+		start, end = self.__range(key)
+		return start != end
+
+	def __key(self, idx):
+		return self.key.unpack_from(self.keys, idx * self.key.size)[0]
+
+	def __value(self, idx):
+		values = self.record.unpack_from(self.records, idx * self.record.size)
+		if self.record_type:
+			return self.record_type(*values)
+		elif len(values) == 1:
+			return values[0]
+		else:
+			return values
+
+	# Keys are compared as unpacked from the buffer, without slicing it
+	def __range(self, key):
+		key = self.key.unpack(self.key.pack(key))[0]
+
+		start = bisect.bisect_left(range(0, self.n_entries), key, key = self.__key)
+		end = start
+		while end < self.n_entries and self.__key(end) == key:
+			end += 1
+
+		return start, end
+
+	def add(self, key, *values):
+		self.keys += self.key.pack(key)
+		self.records += self.record.pack(*values)
+		self.n_entries += 1
+
+	# Add entries from already packed key and record buffers
+	def extend(self, keys, records):
+		self.keys += keys
+		self.records += records
+		self.n_entries += len(records) // self.record.size
+
+	# Sort the entries by key (keeping insertion order of equal keys), and
+	# return the number of entries that share a key with a previous entry.
+	# Entries are sorted by row number and then moved to their sorted rows,
+	# so that no row is copied into an object of its own.
+	def finalize(self):
+		if numpy is not None:
+			rows, self.n_keys = self.__sort_numpy()
+		else:
+			rows, self.n_keys = self.__sort()
+
+		self.keys = self.__permute(self.keys, self.key.size, rows)
+		self.records = self.__permute(self.records, self.record.size, rows)
+
+		return self.n_entries - self.n_keys
+
+	# Row numbers in key order, and the number of distinct keys. Big endian
+	# keys sort the same as integers, so each row is sorted as a single
+	# integer of its key, with the row number in the low bits to keep equal
+	# keys in insertion order.
+	def __sort(self):
+		order = sorted([ (key << 32) | row for row, key in enumerate(self.__key_ints()) ])
+
+		rows = array.array('I', map((0xFFFFFFFF).__and__, order))
+		n_keys = sum(1 for key, group in itertools.groupby(map((32).__rrshift__, order)))
+
+		return rows, n_keys
+
+	# Keys that are whole 64 bit words are sorted as integers, which is a lot
+	# faster than sorting them as strings
+	def __sort_numpy(self):
+		if self.key.size % 8 == 0:
+			keys = numpy.frombuffer(self.keys, dtype = '>u8', count = self.n_entries * self.key.size // 8)
+			keys = keys.reshape(self.n_entries, self.key.size // 8)
+			rows = numpy.lexsort(keys.T[::-1])
+			sorted_keys = keys[rows]
+			changes = (sorted_keys[1:] != sorted_keys[:-1]).any(axis = 1)
+		else:
+			keys = numpy.frombuffer(self.keys, dtype = 'S%u' % self.key.size, count = self.n_entries)
+			rows = numpy.argsort(keys, kind = 'stable')
+			sorted_keys = keys[rows]
+			changes = sorted_keys[1:] != sorted_keys[:-1]
+
+		n_keys = int(numpy.count_nonzero(changes)) + min(1, self.n_entries)
+
+		return rows, n_keys
+
+	# The keys as integers, in row order
+	def __key_ints(self):
+		key_size = self.key.size
+		if key_size == 8:
+			keys = array.array('Q', self.keys[:self.n_entries * 8])
+			if sys.byteorder == 'little':
+				keys.byteswap()
+			return keys
+
+		keys = memoryview(self.keys)
+		return (int.from_bytes(keys[offset:offset + key_size], 'big') for offset in range(0, self.n_entries * key_size, key_size))
+
+	# Buffer of size byte items moved to the given row order
+	def __permute(self, data, size, rows):
+		if numpy is not None:
+			return bytearray(numpy.frombuffer(data, dtype = 'V%u' % size, count = len(rows))[rows].tobytes())
+
+		# Items are split into columns of words, which are gathered in the row
+		# order one column at a time
+		word = 'I'
+		if size % 4 != 0:
+			word = 'B'
+
+		words = array.array(word, data[:len(rows) * size])
+		n_columns = size // words.itemsize
+		for column in range(0, n_columns):
+			words[column::n_columns] = array.array(word, map(words[column::n_columns].__getitem__, rows))
+
+		return bytearray(words.tobytes())
+
+	def get(self, key, default = None):
+		start, end = self.__range(key)
+		if start == end:
+			return default
+
+		if self.multi:
+			return [ self.__value(idx) for idx in range(start, end) ]
+		else:
+			return self.__value(end - 1)
+
+# Turn an output sink (file-like object, socket, or a callable) into a
+# function accepting a block of decoded data
+def _sink_writer(sink):
+	if hasattr(sink, 'write'):
+		return sink.write
+	elif hasattr(sink, 'sendall'):
+		return sink.sendall
+	elif callable(sink):
+		return sink
+
+	raise TypeError('Unsupported BLTE output sink %r' % sink)
+
+_BLTE_POOL = None
+
+# Number of workers of the blte_pool() pool, 0 if parallel decoding is not
+# enabled
+def blte_workers(options):
+	workers = getattr(options, 'blte_workers', 0)
+	if not workers or workers < 2:
+		return 0
+
+	return workers
+
+# Shared worker pool for parallel BLTE chunk decoding, None if parallel
+# decoding is not enabled (--blte-workers)
+def blte_pool(options):
+	global _BLTE_POOL
+
+	workers = blte_workers(options)
+	if not workers:
+		return None
+
+	if not _BLTE_POOL:
+		# Worker processes of --jobs are daemonic, and can not start processes
+		# of their own
+		if getattr(options, 'blte_pool', 'thread') == 'process' and not multiprocessing.current_process().daemon:
+			_BLTE_POOL = concurrent.futures.ProcessPoolExecutor(workers)
+		else:
+			_BLTE_POOL = concurrent.futures.ThreadPoolExecutor(workers)
+
+	return _BLTE_POOL
+
+def _reset_blte_pool():
+	global _BLTE_POOL
+	_BLTE_POOL = None
+
+# Pool threads do not survive a fork, so forked children (e.g., --jobs
+# workers) start a pool of their own
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(after_in_child = _reset_blte_pool)
+
+# Pool worker for parallel BLTE decoding, verifies and inflates a single
+# chunk, returning the status and the decoded data
+def _extract_chunk(chunk, data):
+	status = chunk.extract(data)
+	return status, chunk.output_data
 
 class BLTEChunk(object):
 	def __init__(self, id, chunk_length, output_length, md5s):
@@ -25,7 +324,7 @@ class BLTEChunk(object):
 		self.output_length = output_length
 		self.sum = md5s
 
-		self.output_data = ''
+		self.output_data = b''
 
 	def extract(self, data):
 		if len(data) != self.chunk_length:
@@ -46,12 +345,17 @@ class BLTEChunk(object):
 	def __decompress(self, data):
 		type = data[0]
 		if type == _NULL_CHUNK:
-			self.output_data = ''
+			self.output_data = b''
 		elif type == _UNCOMPRESSED_CHUNK:
 			self.output_data = data[1:]
 		else:
 			dc = zlib.decompressobj()
-			uncompressed_data = dc.decompress(data[1:])
+			try:
+				uncompressed_data = dc.decompress(data[1:])
+			except zlib.error as e:
+				sys.stderr.write('Unable to decompress chunk%d: %s\n' % (self.id, e))
+				return False
+
 			if len(dc.unused_data) > 0:
 				self.options.parser.error('Unused %d bytes of compressed data in chunk%d' % (len(dc.unused_data), self.id))
 				return False
@@ -68,7 +372,7 @@ class BLTEChunk(object):
 	def __verify(self, data):
 		md5s = hashlib.md5(data).digest()
 		if md5s != self.sum:
-			sys.stderr.write('Chunk%d of type %#x fails verification, expects %s got %s' % (
+			sys.stderr.write('Chunk%d of type %#x fails verification, expects %s got %s\n' % (
 				self.id, data[0], codecs.encode(self.sum, 'hex').decode('utf-8'),
 				codecs.encode(md5s, 'hex').decode('utf-8')))
 			return False
@@ -76,40 +380,56 @@ class BLTEChunk(object):
 		return True
 
 class BLTEFile(object):
-	def __init__(self, extractor):
+	def __init__(self, extractor, sink = None, pool = None, workers = 0):
 		self.data = extractor
+		self.pool = pool
+		self.workers = max(1, workers)
 		self.offset = 0
 		self.chunks = []
 		self.output_data = b''
+		self.output_length = 0
 		self.extract_status = True
 
+		# Decoded data is either streamed to the sink one chunk at a time, or
+		# collected and joined into output_data once extraction is done
+		self.sink = sink is not None and _sink_writer(sink) or None
+		self.output_md5 = hashlib.md5()
+		self.__output = []
+
+	def __write(self, data):
+		self.output_md5.update(data)
+		self.output_length += len(data)
+		if self.sink:
+			self.sink(data)
+		else:
+			self.__output.append(data)
+
+	def digest(self):
+		return self.output_md5.digest()
+
+	def hexdigest(self):
+		return self.output_md5.hexdigest()
+
 	def add_chunk(self, length, c_length, md5s):
 		self.chunks.append(BLTEChunk(len(self.chunks), length, c_length, md5s))
 
+	# Data is read by offset, never through the file position of a (shared)
+	# memory map
 	def __read(self, bytes):
-		if isinstance(self.data, BLTEExtract):
-			return self.data.fd.read(bytes)
-		else:
-			nibble = self.data[self.offset:self.offset + bytes]
-			self.offset += bytes
-			return nibble
+		nibble = self.data[self.offset:self.offset + bytes]
+		self.offset += bytes
+		return nibble
 
 	def __seek(self, offset, pos):
-		if isinstance(self.data, BLTEExtract):
-			self.data.fd.seek(offset, pos)
-		else:
-			if pos == os.SEEK_CUR:
-				self.offset += offset
-			elif pos == os.SEEK_SET:
-				self.offset = offset
-			elif pos == os.SEEK_END:
-				self.offset = len(self.data) + offset
+		if pos == os.SEEK_CUR:
+			self.offset += offset
+		elif pos == os.SEEK_SET:
+			self.offset = offset
+		elif pos == os.SEEK_END:
+			self.offset = len(self.data) + offset
 
 	def __tell(self):
-		if isinstance(self.data, BLTEExtract):
-			return self.data.fd.tell()
-		else:
-			return self.offset
+		return self.offset
 
 	def __extract_direct(self):
 		type = ord(self.__read(_MARKER_LEN))
@@ -121,7 +441,7 @@ class BLTEFile(object):
 		compressed_data = self.__read(_BLOCK_DATA_SIZE)
 		dc = zlib.decompressobj()
 		while len(compressed_data) > 0:
-			self.output_data += dc.decompress(compressed_data)
+			self.__write(dc.decompress(compressed_data))
 			if len(dc.unused_data) > 0:
 				# Compressed segment ended at some point, rewind file position
 				self.__seek(-len(dc.unused_data), os.SEEK_CUR)
@@ -132,6 +452,43 @@ class BLTEFile(object):
 
 		return True
 
+	def __extract_serial(self):
+		sum_in_file = 0
+		for chunk in self.chunks:
+			#print('Chunk#%d@%u: Data extract len=%u, total=%u' % (chunk.id, self.__tell(), chunk.chunk_length, sum_in_file))
+			data = self.__read(chunk.chunk_length)
+			if not chunk.extract(data):
+				self.extract_status = False
+
+			self.__write(chunk.output_data)
+			sum_in_file += len(chunk.output_data)
+			# Release the decoded chunk, so at most one is held at a time
+			chunk.output_data = b''
+
+	# The chunk table gives the lengths of all chunks up front, so chunks can
+	# be verified and inflated independently in the worker pool. Output is
+	# reassembled in chunk order, with a bounded number of chunks in flight.
+	def __extract_parallel(self):
+		max_pending = 2 * self.workers
+		pending = collections.deque()
+
+		for chunk in self.chunks:
+			data = self.__read(chunk.chunk_length)
+			pending.append(self.pool.submit(_extract_chunk, chunk, data))
+
+			if len(pending) >= max_pending:
+				self.__write_result(pending.popleft())
+
+		while len(pending) > 0:
+			self.__write_result(pending.popleft())
+
+	def __write_result(self, future):
+		status, data = future.result()
+		if not status:
+			self.extract_status = False
+
+		self.__write(data)
+
 	def extract(self):
 		pos = self.__tell()
 
@@ -161,26 +518,252 @@ class BLTEFile(object):
 				self.add_chunk(c_len, out_len, chunk_sum)
 
 			# Read chunk data
-			sum_in_file = 0
-			for chunk_id in range(0, n_chunks):
-				chunk = self.chunks[chunk_id]
+			if self.pool and n_chunks > 1:
+				self.__extract_parallel()
+			else:
+				self.__extract_serial()
 
-				#print('Chunk#%d@%u: Data extract len=%u, total=%u' % (chunk_id, self.__tell(), chunk.chunk_length, sum_in_file))
-				data = self.__read(chunk.chunk_length)
-				if not chunk.extract(data):
-					self.extract_status = False
-
-				self.output_data += chunk.output_data
-				sum_in_file += len(chunk.output_data)
+		if not self.sink:
+			self.output_data = b''.join(self.__output)
+			self.__output = []
 
 		return True
 
 	def verify(self, md5s):
 		pass
 
+# Random access, read-only file object over a BLTE encoded file. The chunk
+# table is used to map decompressed offsets to chunks, and only the chunks
+# covering the requested range are decoded. A small LRU cache of decoded
+# chunks is kept around for consecutive reads.
+class BLTEReader(io.RawIOBase):
+	def __init__(self, data, offset = 0, cache_size = 4, close = None):
+		io.RawIOBase.__init__(self)
+
+		self.data = data
+		self.base = offset
+		self.position = 0
+		self.length = 0
+		self.cache_size = max(1, cache_size)
+		self.cache = collections.OrderedDict()
+		self.on_close = close
+
+		self.chunks = []
+		# Decompressed start offset, and data offset of each chunk
+		self.chunk_offsets = []
+		self.data_offsets = []
+
+		self.__parse()
+
+	def __parse(self):
+		offset = self.base
+		if self.data[offset:offset + 4] != _BLTE_MAGIC:
+			raise ValueError('Invalid BLTE magic in file @%#.8x' % offset)
+
+		chunk_data_offset = struct.unpack('>I', self.data[offset + 4:offset + 8])[0]
+		offset += 8
+		# No chunk table, the whole file has to be decoded in one go
+		if chunk_data_offset == 0:
+			self.__decode_direct(offset)
+			return
+
+		unk_1, cc_b1, cc_b2, cc_b3 = struct.unpack('BBBB', self.data[offset:offset + _CHUNK_HEADER_LEN])
+		if unk_1 != 0x0F:
+			raise ValueError('Unknown magic byte %#x in BLTE @%#.8x' % (unk_1, offset))
+
+		n_chunks = (cc_b1 << 16) | (cc_b2 << 8) | cc_b3
+		offset += _CHUNK_HEADER_LEN
+		data_offset = offset + n_chunks * (_CHUNK_HEADER_2_LEN + _CHUNK_SUM_LEN)
+		for chunk_id in range(0, n_chunks):
+			c_len, out_len = struct.unpack('>II', self.data[offset:offset + _CHUNK_HEADER_2_LEN])
+			offset += _CHUNK_HEADER_2_LEN
+			chunk_sum = self.data[offset:offset + _CHUNK_SUM_LEN]
+			offset += _CHUNK_SUM_LEN
+
+			self.chunks.append(BLTEChunk(chunk_id, c_len, out_len, chunk_sum))
+			self.chunk_offsets.append(self.length)
+			self.data_offsets.append(data_offset)
+
+			self.length += out_len
+			data_offset += c_len
+
+	def __decode_direct(self, offset):
+		file = BLTEFile(self.data)
+		file.offset = self.base
+		if not file.extract():
+			raise ValueError('Unable to decode BLTE file @%#.8x' % self.base)
+
+		self.chunks.append(None)
+		self.chunk_offsets.append(0)
+		self.data_offsets.append(offset)
+		self.length = len(file.output_data)
+		# Direct files only have a single "chunk", keep it around
+		self.cache[0] = file.output_data
+
+	def __chunk(self, idx):
+		data = self.cache.get(idx, None)
+		if data is not None:
+			self.cache.move_to_end(idx)
+			return data
+
+		chunk = self.chunks[idx]
+		offset = self.data_offsets[idx]
+		if not chunk.extract(self.data[offset:offset + chunk.chunk_length]):
+			raise IOError('Unable to decode BLTE chunk %d @%#.8x' % (idx, offset))
+
+		data = chunk.output_data
+		chunk.output_data = b''
+
+		self.cache[idx] = data
+		if len(self.cache) > self.cache_size:
+			self.cache.popitem(last = False)
+
+		return data
+
+	def size(self):
+		return self.length
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def tell(self):
+		return self.position
+
+	def seek(self, offset, whence = os.SEEK_SET):
+		if whence == os.SEEK_SET:
+			position = offset
+		elif whence == os.SEEK_CUR:
+			position = self.position + offset
+		elif whence == os.SEEK_END:
+			position = self.length + offset
+		else:
+			raise ValueError('Invalid whence %d' % whence)
+
+		if position < 0:
+			raise ValueError('Negative seek position %d' % position)
+
+		self.position = position
+		return self.position
+
+	def readinto(self, buffer):
+		output = memoryview(buffer).cast('B')
+		n_bytes = max(0, min(len(output), self.length - self.position))
+
+		written = 0
+		while written < n_bytes:
+			idx = bisect.bisect_right(self.chunk_offsets, self.position) - 1
+			data = self.__chunk(idx)
+
+			chunk_offset = self.position - self.chunk_offsets[idx]
+			n = min(n_bytes - written, len(data) - chunk_offset)
+			# Null chunks decode to nothing, read them as zeros
+			if n <= 0:
+				n = min(n_bytes - written, self.chunks[idx].output_length - chunk_offset)
+				output[written:written + n] = bytes(n)
+			else:
+				output[written:written + n] = data[chunk_offset:chunk_offset + n]
+
+			written += n
+			self.position += n
+
+		return written
+
+	def close(self):
+		if not self.closed:
+			self.cache.clear()
+			self.data = None
+			if self.on_close:
+				self.on_close()
+
+		io.RawIOBase.close(self)
+
+# Long lived, read-only memory maps of the local data.NNN archives, shared by
+# all extractors of the process. At most max_maps archives are kept mapped;
+# the least recently used map is dropped from the pool, and unmapped once
+# nothing references it anymore. Maps are only ever read by offset, so
+# threads can share them. With --data-advise, the ranges of planned
+# extractions are prefetched; maps keep the default advice, as most reads
+# are sequential multi-chunk BLTE reads that benefit from readahead.
+class CASCDataPool(object):
+	def __init__(self, options):
+		self.options = options
+		self.max_maps = max(1, getattr(options, 'data_pool_size', 16))
+		self.advise = getattr(options, 'data_advise', False) and hasattr(mmap, 'MADV_WILLNEED')
+		self.maps = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def data_path(self, data_file_number):
+		return os.path.join(self.options.data_dir, 'Data', 'data', 'data.%03u' % data_file_number)
+
+	def get(self, data_file_number):
+		with self.lock:
+			return self.__get(data_file_number)
+
+	def __get(self, data_file_number):
+		data = self.maps.get(data_file_number, None)
+		if data is not None:
+			self.maps.move_to_end(data_file_number)
+			return data
+
+		data_file = self.data_path(data_file_number)
+		if not os.access(data_file, os.R_OK):
+			self.options.parser.error('File %s not readable.' % data_file)
+			return None
+
+		if os.stat(data_file).st_size == 0:
+			self.options.parser.error('File %s is empty.' % data_file)
+			return None
+
+		with open(data_file, 'rb') as f:
+			data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+		self.maps[data_file_number] = data
+		if len(self.maps) > self.max_maps:
+			self.maps.popitem(last = False)
+
+		return data
+
+	# Hint the kernel to read in the (data file number, offset, BLTE size)
+	# locations that are about to be extracted
+	def prefetch(self, locations):
+		if not self.advise:
+			return
+
+		for data_file_number, data_file_offset, blte_file_size in sorted(locations):
+			data = self.get(data_file_number)
+			if not data:
+				continue
+
+			start = data_file_offset - data_file_offset % mmap.PAGESIZE
+			# Data file entries have a 30 byte header before the BLTE data
+			length = min(len(data) - start, data_file_offset - start + 30 + blte_file_size)
+			if length > 0:
+				data.madvise(mmap.MADV_WILLNEED, start, length)
+
+_DATA_POOL = None
+_DATA_POOL_LOCK = threading.Lock()
+
+def data_pool(options):
+	global _DATA_POOL
+
+	with _DATA_POOL_LOCK:
+		if not _DATA_POOL:
+			_DATA_POOL = CASCDataPool(options)
+
+	return _DATA_POOL
+
 class BLTEExtract(object):
 	def __init__(self, options):
 		self.options = options
+		self.fd = None
+		self.fdesc = None
+		# Offset of the BLTE data in fd
+		self.offset = 0
+		# Data archive maps come from the shared pool, and are not closed here
+		self.pooled = False
 
 	def open(self, data_file):
 		if not os.access(data_file, os.R_OK):
@@ -194,18 +777,23 @@ class BLTEExtract(object):
 
 		self.fdesc = open(data_file, 'rb')
 		self.fd = mmap.mmap(self.fdesc.fileno(), 0, access = mmap.ACCESS_READ)
+		self.offset = 0
+		self.pooled = False
 
 		return True
 
 	def close(self):
-		if self.fd:
+		if self.fd and not self.pooled:
 			self.fd.close()
 
 		if self.fdesc:
 			self.fdesc.close()
 
-	def __extract_file(self):
-		file = BLTEFile(self)
+		self.fd = self.fdesc = None
+
+	def __extract_file(self, sink = None):
+		file = BLTEFile(self.fd, sink, blte_pool(self.options), blte_workers(self.options))
+		file.offset = self.offset
 		if not file.extract():
 			return None
 
@@ -213,15 +801,20 @@ class BLTEExtract(object):
 
 	def extract_buffer_to_file(self, data, fname):
 		dirname = os.path.dirname(os.path.normpath(fname))
-		if not os.path.exists(dirname):
-			os.makedirs(dirname)
+		os.makedirs(dirname, exist_ok = True)
 
-		data = self.extract_buffer(data)
 		with open(fname, 'wb') as f:
-			f.write(data)
+			return self.extract_buffer_to(data, f)
+
+	def extract_buffer_to(self, data, sink):
+		file = BLTEFile(data, sink, blte_pool(self.options), blte_workers(self.options))
+		if not file.extract():
+			return None
+
+		return file
 
 	def extract_buffer(self, data):
-		file = BLTEFile(data)
+		file = BLTEFile(data, pool = blte_pool(self.options), workers = blte_workers(self.options))
 		if not file.extract():
 			return None
 
@@ -243,39 +836,77 @@ class BLTEExtract(object):
 
 		return True
 
-	def extract_data(self, file_key, file_md5sum, data_file_number, data_file_offset, blte_file_size):
-		path = os.path.join(self.options.data_dir, 'Data', 'data', 'data.%03u' % data_file_number)
-
-		if not self.open(path):
-			return None
-
-		self.fd.seek(data_file_offset, os.SEEK_SET)
+	def __seek_data(self, file_key, data_file_number, data_file_offset, blte_file_size):
+		self.fd = data_pool(self.options).get(data_file_number)
+		self.pooled = True
+		if not self.fd:
+			return False
 
-		key = self.fd.read(16)
-		blte_len = struct.unpack('<I', self.fd.read(4))[0]
+		key = self.fd[data_file_offset:data_file_offset + 16]
+		blte_len = struct.unpack('<I', self.fd[data_file_offset + 16:data_file_offset + 20])[0]
 		if key[::-1] != file_key:
-			self.options.parser.error('Invalid file key for %s, expected %s, got %s' % (
-				file_output, codecs.encode(file_key, 'hex').decode('utf-8'), codecs.encode(key, 'hex').decode('utf-8')))
+			self.options.parser.error('Invalid file key for data.%03u@%u, expected %s, got %s' % (
+				data_file_number, data_file_offset, codecs.encode(file_key, 'hex').decode('utf-8'), codecs.encode(key, 'hex').decode('utf-8')))
 
 		if blte_len != blte_file_size:
 			self.options.parser.error('Invalid file length, expected %u got %u' % (blte_file_size, blte_len))
 
 		# Skip 10 bytes of unknown data
-		self.fd.seek(10, os.SEEK_CUR)
+		self.offset = data_file_offset + 30
 
-		file = self.__extract_file()
-		if not file:
-			return None
+		return True
 
-		file_md5 = hashlib.md5(file.output_data).digest()
+	def __verify_md5(self, file, file_md5sum):
+		file_md5 = file.digest()
 		if file_md5sum and file_md5sum != file_md5:
 			self.options.parser.error('Invalid md5sum for extracted file, expected %s got %s' % (
 				codecs.encode(file_md5sum, 'hex').decode('utf-8'), codecs.encode(file_md5, 'hex').decode('utf-8')))
+			return False
+
+		return True
+
+	def extract_data(self, file_key, file_md5sum, data_file_number, data_file_offset, blte_file_size):
+		if not self.__seek_data(file_key, data_file_number, data_file_offset, blte_file_size):
+			return None
+
+		file = self.__extract_file()
+		if not file:
+			return None
+
+		self.__verify_md5(file, file_md5sum)
 
 		self.close()
 
 		return file.output_data
 
+	# Streaming variant of extract_data, decoded data is written to sink one
+	# BLTE chunk at a time
+	def extract_data_to(self, sink, file_key, file_md5sum, data_file_number, data_file_offset, blte_file_size):
+		if not self.__seek_data(file_key, data_file_number, data_file_offset, blte_file_size):
+			return None
+
+		file = self.__extract_file(sink)
+		if not file:
+			return None
+
+		self.close()
+
+		if not self.__verify_md5(file, file_md5sum):
+			return None
+
+		return file
+
+	# Open a random access BLTEReader for a file in the local data archives
+	def open_reader(self, file_key, data_file_number, data_file_offset, blte_file_size, cache_size = 4):
+		if not self.__seek_data(file_key, data_file_number, data_file_offset, blte_file_size):
+			return None
+
+		# The reader only slices the shared map, so it does not need to be closed
+		fd = self.fd
+		self.fd = None
+
+		return BLTEReader(fd, self.offset, cache_size)
+
 	def extract_file(self, file_key, file_md5sum, file_output, data_file_number, data_file_offset, blte_file_size):
 		output_path = ''
 		if file_output:
@@ -288,22 +919,1080 @@ class BLTEExtract(object):
 
 		output_dir = os.path.dirname(os.path.abspath(output_path))
 		try:
-			if not os.path.exists(output_dir):
-				os.makedirs(output_dir)
+			os.makedirs(output_dir, exist_ok = True)
 		except os.error as e:
 			self.options.parser.error('Output "%s" is not writable: %s' % (output_path, e.strerror))
 
-		data = self.extract_data(file_key, file_md5sum, data_file_number, data_file_offset, blte_file_size)
-		if not data:
-			return False
+		# Decoded data is streamed into a partial file, which replaces the
+		# output only once its md5sum is verified, so a failed or corrupt
+		# extraction never leaves data in the output tree
+		partial = output_path + _PARTIAL_SUFFIX
+		file = None
+		try:
+			with open(partial, 'wb') as output_file:
+				file = self.extract_data_to(output_file, file_key, file_md5sum, data_file_number, data_file_offset, blte_file_size)
+
+			if file:
+				os.replace(partial, output_path)
+		except IOError as e:
+			self.options.parser.error('Output "%s" is not writable: %s' % (output_path, e.strerror))
+		finally:
+			if os.path.exists(partial):
+				os.unlink(partial)
+
+		return file is not None
+
+_BATCH = None
+
+def _batch_init(batch):
+	global _BATCH
+	_BATCH = batch
+
+	# Drop the phases inherited from the parent
+	if _STATS:
+		_STATS.take()
+
+def _batch_extract(job):
+	status = _BATCH.extract_one(*job)
+
+	# Worker phases are passed to the parent's stats
+	return status, _STATS and _STATS.take() or None
+
+# Batch extraction of files from the local data archives. Jobs are
+# (file name, extract_file() arguments) tuples, with file locations already
+# resolved from the index, encoding and root files. With more than one
+# worker (--jobs), the job list is divided between forked worker processes
+# that only decode and write; the parsed lookup tables are never copied.
+class BLTEBatchExtract(object):
+	def __init__(self, options, store = None):
+		self.options = options
+		self.store = store
+		self.blte = BLTEExtract(options)
+
+	def extract_one(self, file_name, extract_data):
+		print('Extracting %s ...' % file_name)
+
+		try:
+			if not self.store:
+				return self.blte.extract_file(*extract_data)
+
+			file_key, md5s, file_output = extract_data[:3]
+			return self.store.extract(md5s, os.path.join(self.options.output, file_output),
+					lambda sink: self.blte.extract_data_to(sink, file_key, md5s, *extract_data[3:]))
+		# Errors are reported through the option parser, which exits
+		except SystemExit:
+			return False
+
+	def extract(self, jobs):
+		if getattr(self.options, 'pipeline', False):
+			return BLTEPipeline(self.options, self.store).extract(jobs)
+
+		# Extract data is (file key, md5sum, output, data file number, offset, BLTE size)
+		data_pool(self.options).prefetch([ extract_data[3:] for file_name, extract_data in jobs ])
+
+		# Every job is run, also after a failed one, as with worker processes
+		workers = getattr(self.options, 'jobs', 1)
+		if workers < 2 or len(jobs) < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+			return all([ self.extract_one(*job) for job in jobs ])
+
+		context = multiprocessing.get_context('fork')
+		with context.Pool(min(workers, len(jobs)), _batch_init, (self,)) as pool:
+			results = list(pool.imap_unordered(_batch_extract, jobs, 4))
+
+		status = [ result[0] for result in results ]
+		for result in results:
+			if result[1]:
+				_STATS.merge(result[1])
+
+		# Workers keep their own store statistics
+		if self.store:
+			self.store.extracted += status.count(True)
+
+		return all(status)
+
+# Memory budget of the batch extraction pipeline. A single item larger than
+# the whole budget is let through when nothing else is in flight.
+class _PipelineBudget(object):
+	def __init__(self, limit):
+		self.limit = limit
+		self.used = 0
+		self.peak = 0
+		self.closed = False
+		self.cond = threading.Condition()
+
+	def acquire(self, size):
+		with self.cond:
+			while not self.closed and self.used > 0 and self.used + size > self.limit:
+				self.cond.wait()
+
+			self.used += size
+			self.peak = max(self.peak, self.used)
+
+	def release(self, size):
+		with self.cond:
+			self.used -= size
+			self.cond.notify_all()
+
+	# Let all waiting and future acquires through
+	def close(self):
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
+
+# Decode a BLTE chunk in a pipeline worker, returns (status, decoded data,
+# seconds). Files without a chunk table are decoded whole, with a chunk of
+# None.
+def _pipeline_decode(chunk, data):
+	start = time.perf_counter()
+	try:
+		if chunk is None:
+			file = BLTEFile(data)
+			status, output = file.extract(), file.output_data
+		else:
+			status, output = chunk.extract(data), chunk.output_data
+			# The reader holds on to the chunks of the file being read
+			chunk.output_data = b''
+	except (Exception, SystemExit):
+		status, output = False, b''
+
+	return status, status and output or b'', time.perf_counter() - start
+
+# Pipelined batch extraction (--pipeline). A reader thread slices the BLTE
+# chunks of each file out of the shared data archive maps, a pool of workers
+# verifies and decompresses them, and a writer thread streams the decoded
+# chunks out in job order, so disk I/O and decompression overlap. Files are
+# never held whole; the reader stops when the compressed and decoded chunks
+# in flight would exceed --pipeline-memory megabytes, or when four chunks per
+# worker are queued for the writer. Chunks are decoded in the --blte-workers
+# pool, or without one, by --jobs threads (one per CPU by default). Busy
+# time of each stage is reported at the end.
+class BLTEPipeline(object):
+	def __init__(self, options, store = None):
+		self.options = options
+		self.store = store
+		self.pool = blte_pool(options)
+		if self.pool:
+			self.workers = blte_workers(options)
+		else:
+			self.workers = getattr(options, 'jobs', 1) > 1 and options.jobs or os.cpu_count() or 1
+		self.budget = _PipelineBudget(max(1, getattr(options, 'pipeline_memory', 64)) * 1024 * 1024)
+		self.queue = queue.Queue(4 * self.workers)
+		# The writer consumed all chunks of the current file
+		self.drained = True
+		# The writer stopped early, and the reader has to stop too
+		self.stopping = threading.Event()
+
+		self.read_seconds = 0.0
+		self.read_blocked = 0.0
+		self.decode_seconds = 0.0
+		self.write_seconds = 0.0
+		self.write_waiting = 0.0
+		self.read_bytes = 0
+		self.write_bytes = 0
+
+	def __error(self, message):
+		sys.stderr.write('%s\n' % message)
+
+	# Locate the chunks of a file in the data archives. Returns the archive
+	# map, and a list of (BLTEChunk, data offset) tuples, or None. A file
+	# without a chunk table is a single chunk of None.
+	def __locate(self, file_key, data_file_number, data_file_offset, blte_file_size):
+		data = data_pool(self.options).get(data_file_number)
+		if not data:
+			return None
+
+		# Data file entries have a 30 byte header before the BLTE data
+		header = data[data_file_offset:data_file_offset + 30]
+		if len(header) != 30 or data_file_offset + blte_file_size > len(data):
+			self.__error('Short read for data.%03u@%u' % (data_file_number, data_file_offset))
+			return None
+
+		key = header[15::-1]
+		blte_len = struct.unpack_from('<I', header, 16)[0]
+		if key != file_key:
+			self.__error('Invalid file key for data.%03u@%u, expected %s, got %s' % (
+				data_file_number, data_file_offset, codecs.encode(file_key, 'hex').decode('utf-8'), codecs.encode(key, 'hex').decode('utf-8')))
+			return None
+
+		if blte_len != blte_file_size:
+			self.__error('Invalid file length, expected %u got %u' % (blte_file_size, blte_len))
+			return None
+
+		offset = data_file_offset + 30
+		end = data_file_offset + blte_file_size
+		if data[offset:offset + 4] != _BLTE_MAGIC:
+			self.__error('Invalid BLTE magic in data.%03u@%u' % (data_file_number, data_file_offset))
+			return None
+
+		if struct.unpack('>I', data[offset + 4:offset + 8])[0] == 0:
+			return data, [ (None, offset) ]
+
+		table_header = data[offset + 8:offset + 12]
+		n_chunks = len(table_header) == 4 and struct.unpack('>I', table_header)[0] & 0xFFFFFF or 0
+		if n_chunks == 0 or table_header[0] != 0x0F:
+			self.__error('Invalid BLTE chunk table in data.%03u@%u' % (data_file_number, data_file_offset))
+			return None
+
+		table = data[offset + 12:offset + 12 + n_chunks * 24]
+		chunk_offset = offset + 12 + n_chunks * 24
+		chunks = []
+		for chunk_id, (c_len, out_len, chunk_sum) in enumerate(struct.iter_unpack('>II16s', table)):
+			chunks.append((BLTEChunk(chunk_id, c_len, out_len, chunk_sum), chunk_offset))
+			chunk_offset += c_len
+
+		if len(chunks) != n_chunks or chunk_offset != end:
+			self.__error('BLTE chunk table does not match the file length in data.%03u@%u' % (data_file_number, data_file_offset))
+			return None
+
+		return data, chunks
+
+	def __put(self, item, blocked = 0.0):
+		start = time.perf_counter()
+		self.queue.put(item)
+		self.read_blocked += blocked + time.perf_counter() - start
+
+	# Each file is queued as a ('file', ...) item, its decoded chunks, and an
+	# ('end', status) item. Reading stops early once the writer stops.
+	def __reader(self, jobs, executor):
+		try:
+			for file_name, extract_data in jobs:
+				if self.stopping.is_set():
+					break
+
+				file_key, md5s, file_output, data_file_number, data_file_offset, blte_file_size = extract_data
+
+				start = time.perf_counter()
+				try:
+					located = self.__locate(file_key, data_file_number, data_file_offset, blte_file_size)
+				# Unreadable data archives are reported through the option parser
+				except SystemExit:
+					located = None
+				self.read_seconds += time.perf_counter() - start
+
+				self.__put(('file', file_name, md5s, file_output))
+				if located:
+					data, chunks = located
+					for chunk, offset in chunks:
+						# Files without a chunk table are assumed to decode to their encoded length
+						c_len = chunk and chunk.chunk_length or data_file_offset + blte_file_size - offset
+						cost = c_len + (chunk and chunk.output_length or c_len)
+
+						start = time.perf_counter()
+						self.budget.acquire(cost)
+						blocked = time.perf_counter() - start
+						if self.stopping.is_set():
+							break
+
+						start = time.perf_counter()
+						chunk_data = data[offset:offset + c_len]
+						self.read_seconds += time.perf_counter() - start
+						self.read_bytes += c_len
+
+						self.__put(('chunk', executor.submit(_pipeline_decode, chunk, chunk_data), cost), blocked)
+
+					data = chunk_data = None
+
+				self.__put(('end', located is not None))
+		finally:
+			self.queue.put(None)
+
+	# Stream the decoded chunks of the current file into sink, returns the
+	# md5 of the decoded data, or None if the file could not be decoded. All
+	# chunks of the file are consumed, even if writing fails.
+	def __drain(self, sink, file_output):
+		write = sink is not None and _sink_writer(sink) or None
+		md5 = hashlib.md5()
+		status = True
+		error = None
+		while True:
+			start = time.perf_counter()
+			item = self.queue.get()
+			if item is None:
+				# The reader stopped in the middle of the file
+				self.queue.put(None)
+				status = False
+				break
+
+			if item[0] == 'end':
+				status = status and item[1]
+				break
+
+			future, cost = item[1:]
+			chunk_status, data, seconds = future.result()
+			self.decode_seconds += seconds
+			self.write_waiting += time.perf_counter() - start
+
+			start = time.perf_counter()
+			if not chunk_status:
+				status = False
+			elif write and not error:
+				try:
+					write(data)
+				except OSError as e:
+					error = e
+
+			md5.update(data)
+			self.write_bytes += len(data)
+
+			# Release the decoded chunk before letting the reader go on
+			data = future = item = None
+			self.budget.release(cost)
+			self.write_seconds += time.perf_counter() - start
+
+		self.drained = True
+		if error:
+			raise error
+
+		if not status:
+			if sink is not None:
+				self.__error('Unable to decode BLTE data for %s' % file_output)
+			return None
+
+		return md5
+
+	# Files are written to a partial file, and only moved in place once they
+	# are verified
+	def __write(self, md5s, file_output):
+		output_path = os.path.join(self.options.output, file_output)
+		if self.store:
+			return self.store.extract(md5s, output_path, lambda sink: self.__drain(sink, file_output))
+
+		os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok = True)
+		partial = output_path + _PARTIAL_SUFFIX
+		md5 = None
+		try:
+			with open(partial, 'wb') as f:
+				md5 = self.__drain(f, file_output)
+
+			if md5 and md5s and md5.digest() != md5s:
+				self.__error('Invalid md5sum for extracted file %s, expected %s got %s' % (
+					file_output, codecs.encode(md5s, 'hex').decode('utf-8'), md5.hexdigest()))
+				md5 = None
+
+			if md5:
+				os.replace(partial, output_path)
+		finally:
+			if os.path.exists(partial):
+				os.unlink(partial)
+
+		return md5 is not None
+
+	# Stop the reader after the writer stopped early (e.g., on an exception).
+	# The reader may be blocked on a full queue, or on the memory budget, so
+	# the budget is closed, and the queue is drained until the reader is gone.
+	# Chunks that are not decoded yet are cancelled.
+	def __stop(self, reader):
+		self.stopping.set()
+		self.budget.close()
+		while reader.is_alive():
+			try:
+				item = self.queue.get(timeout = 0.1)
+			except queue.Empty:
+				continue
+
+			if item and item[0] == 'chunk':
+				item[1].cancel()
+				self.budget.release(item[2])
+
+		reader.join()
+
+	def extract(self, jobs):
+		status = True
+		started = time.perf_counter()
+
+		executor = self.pool
+		if not executor:
+			# Decoding is accounted to the phase the pipeline runs in
+			initializer, context = None, ()
+			if _STATS:
+				initializer, context = _STATS.attach, (_STATS.context(),)
+
+			executor = concurrent.futures.ThreadPoolExecutor(self.workers, initializer = initializer, initargs = context)
+
+		reader = threading.Thread(target = self.__reader, args = (jobs, executor))
+		try:
+			reader.start()
+
+			while True:
+				item = self.queue.get()
+				if item is None:
+					break
+
+				kind, file_name, md5s, file_output = item
+				print('Extracting %s ...' % file_name)
+				self.drained = False
+				try:
+					if not self.__write(md5s, file_output):
+						status = False
+				except (OSError, SystemExit) as e:
+					self.__error('Unable to write %s: %s' % (file_output, e))
+					status = False
+
+				# Skip the chunks of a file that failed before they were written
+				if not self.drained:
+					self.__drain(None, file_output)
+
+			reader.join()
+		finally:
+			if reader.is_alive():
+				self.__stop(reader)
+
+			if executor is not self.pool:
+				executor.shutdown(cancel_futures = True)
+
+		self.report(time.perf_counter() - started)
+
+		return status
+
+	def report(self, elapsed):
+		elapsed = max(elapsed, 1e-9)
+		print('Pipeline: %.1fMB read, %.1fMB written in %.2f seconds, peak %.1fMB in flight' % (
+			self.read_bytes / 1048576.0, self.write_bytes / 1048576.0, elapsed, self.budget.peak / 1048576.0))
+		print('  read        %5.1f%% busy, %.2f seconds blocked by backpressure' % (
+			100.0 * self.read_seconds / elapsed, self.read_blocked))
+		print('  decompress  %5.1f%% busy, %u workers' % (
+			100.0 * self.decode_seconds / (elapsed * self.workers), self.workers))
+		print('  write       %5.1f%% busy, %.2f seconds waiting for data' % (
+			100.0 * self.write_seconds / elapsed, self.write_waiting))
+
+		if _STATS:
+			_STATS.add('batch/read', self.read_seconds, self.read_bytes)
+			_STATS.add('batch/write', self.write_seconds, self.write_bytes)
+
+# Content addressed output store (--store). Extracted files are stored once
+# under their content md5sum, and output trees are built from hard links
+# (or copies, if linking is not possible) to the stored files. Content that
+# is already in the store is never extracted again, and output files that
+# already link to the right content are left alone.
+class CASCContentStore(object):
+	def __init__(self, options):
+		self.options = options
+		self.store_dir = options.store
+
+		self.extracted = 0
+		self.linked = 0
+		self.unchanged = 0
+
+	def content_path(self, md5s):
+		md5str = codecs.encode(md5s, 'hex').decode('utf-8')
+		return os.path.join(self.store_dir, md5str[0:2], md5str[2:4], md5str)
+
+	def __makedirs(self, path):
+		dirname = os.path.dirname(os.path.abspath(path))
+		try:
+			os.makedirs(dirname, exist_ok = True)
+		except os.error as e:
+			self.options.parser.error('Unable to make %s: %s' % (dirname, e.strerror))
+
+	def has(self, md5s):
+		return os.access(self.content_path(md5s), os.R_OK)
+
+	# Store content with the md5sum md5s. extract is called with a sink to
+	# write the decoded data to, and returns the BLTEFile (or None on failure).
+	def add(self, md5s, extract):
+		path = self.content_path(md5s)
+		self.__makedirs(path)
+
+		tmp_path = '%s.%u.tmp' % (path, os.getpid())
+		with open(tmp_path, 'wb') as f:
+			file = extract(f)
+
+		if not file or file.digest() != md5s:
+			os.unlink(tmp_path)
+			if file:
+				self.options.parser.error('Invalid md5sum for extracted file, expected %s got %s' % (
+					codecs.encode(md5s, 'hex').decode('utf-8'), file.hexdigest()))
+			return False
+
+		os.replace(tmp_path, path)
+		self.extracted += 1
+
+		return True
+
+	def __link(self, path, output_path):
+		self.__makedirs(output_path)
+
+		tmp_path = '%s.%u.tmp' % (output_path, os.getpid())
+		try:
+			os.link(path, tmp_path)
+		except OSError:
+			shutil.copyfile(path, tmp_path)
+
+		os.replace(tmp_path, output_path)
+
+	# Point output_path to stored content, returns False if the content is not
+	# in the store
+	def link(self, md5s, output_path):
+		path = self.content_path(md5s)
+		if not os.access(path, os.R_OK):
+			return False
+
+		if os.path.exists(output_path) and os.path.samefile(path, output_path):
+			self.unchanged += 1
+		else:
+			self.__link(path, output_path)
+			self.linked += 1
+
+		return True
+
+	# Add content that is not in the store yet, and point output_path to it
+	def extract(self, md5s, output_path, extract):
+		if not self.add(md5s, extract):
+			return False
+
+		self.__link(self.content_path(md5s), output_path)
+
+		return True
+
+	def report(self):
+		print('Content store %s: %u files extracted, %u linked from store, %u unchanged' % (
+			self.store_dir, self.extracted, self.linked, self.unchanged))
+
+# Size bounded cache directory manager (--cache-size, --cache-stats). Last
+# access times of the cached files are kept in an append-only journal in
+# the cache directory, and the least recently used files are evicted when
+# the cache grows past its size limit. Files of the current build can be
+# pinned, so they are never evicted while in use. Downloader threads add
+# files concurrently, so the entries and the journal are kept under a lock.
+class CASCCache(object):
+	JOURNAL = '.journal'
+
+	def __init__(self, options):
+		self.options = options
+		self.cache_dir = options.cache
+		self.max_size = getattr(options, 'cache_size', 0) * 1024 * 1024
+
+		# Relative path -> [ size, last access time ], least recently used first
+		self.entries = collections.OrderedDict()
+		self.size = 0
+		self.pinned = set()
+		self.lock = threading.RLock()
+
+		self.hits = 0
+		self.misses = 0
+		self.bytes_saved = 0
+		self.bytes_fetched = 0
+		self.evicted = 0
+		self.bytes_evicted = 0
+
+		if not os.path.exists(self.cache_dir):
+			os.makedirs(self.cache_dir)
+
+		self.__scan()
+		n_records = self.__read_journal()
+		self.entries = collections.OrderedDict(sorted(self.entries.items(), key = lambda item: item[1][1]))
+
+		# Compact the journal once it is mostly superseded records
+		journal_path = os.path.join(self.cache_dir, CASCCache.JOURNAL)
+		if n_records > 4 * len(self.entries) + 1024:
+			self.__write_journal(journal_path)
+
+		self.journal = open(journal_path, 'a', buffering = 1)
+
+		if getattr(options, 'cache_stats', False):
+			atexit.register(self.report)
+
+	def __scan(self):
+		for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+			for filename in filenames:
+				path = os.path.join(dirpath, filename)
+				rel_path = os.path.relpath(path, self.cache_dir)
+				# Skip the journal, and downloads in progress
+				if rel_path == CASCCache.JOURNAL or filename.endswith(_PARTIAL_SUFFIX):
+					continue
+
+				st = os.stat(path)
+				self.entries[rel_path] = [ st.st_size, st.st_mtime ]
+				self.size += st.st_size
+
+	def __read_journal(self):
+		journal_path = os.path.join(self.cache_dir, CASCCache.JOURNAL)
+		if not os.access(journal_path, os.R_OK):
+			return 0
+
+		n_records = 0
+		with open(journal_path, 'r') as journal:
+			for line in journal:
+				split = line.rstrip('\n').split(' ', 1)
+				n_records += 1
+				if len(split) != 2 or split[1] not in self.entries:
+					continue
+
+				try:
+					self.entries[split[1]][1] = float(split[0])
+				except ValueError:
+					continue
+
+		return n_records
+
+	def __write_journal(self, journal_path):
+		tmp_path = '%s.%u.tmp' % (journal_path, os.getpid())
+		with open(tmp_path, 'w') as journal:
+			for rel_path, entry in self.entries.items():
+				journal.write('%.3f %s\n' % (entry[1], rel_path))
+
+		os.replace(tmp_path, journal_path)
+
+	def __access(self, rel_path):
+		now = time.time()
+		self.entries[rel_path][1] = now
+		self.entries.move_to_end(rel_path)
+		self.journal.write('%.3f %s\n' % (now, rel_path))
+
+	def __rel_path(self, path):
+		return os.path.relpath(path, self.cache_dir)
+
+	def pin(self, path):
+		with self.lock:
+			self.pinned.add(self.__rel_path(path))
+
+	def is_pinned(self, rel_path):
+		for pinned in self.pinned:
+			if rel_path == pinned or rel_path.startswith(pinned + os.sep):
+				return True
+
+		return False
+
+	def hit(self, path):
+		rel_path = self.__rel_path(path)
+		with self.lock:
+			if rel_path not in self.entries:
+				# Evicted by another thread since the caller found it
+				if not os.path.exists(path):
+					return
+
+				self.entries[rel_path] = [ os.stat(path).st_size, 0 ]
+				self.size += self.entries[rel_path][0]
+
+			self.hits += 1
+			self.bytes_saved += self.entries[rel_path][0]
+			self.__access(rel_path)
+
+	def add(self, path, size):
+		rel_path = self.__rel_path(path)
+		with self.lock:
+			if rel_path in self.entries:
+				self.size -= self.entries[rel_path][0]
+
+			self.entries[rel_path] = [ size, 0 ]
+			self.size += size
+
+			self.misses += 1
+			self.bytes_fetched += size
+			self.__access(rel_path)
+
+			self.evict(rel_path)
+
+	# Remove least recently used files until the cache fits in its size
+	# limit. The file that was just added (keep) is never evicted. Entries
+	# are kept in access order, so only the evicted (and pinned) entries at
+	# the front are looked at.
+	def evict(self, keep = None):
+		with self.lock:
+			if self.max_size == 0 or self.size <= self.max_size:
+				return
+
+			size = self.size
+			evict = []
+			for rel_path, entry in self.entries.items():
+				if size <= self.max_size:
+					break
+
+				if rel_path == keep or self.is_pinned(rel_path):
+					continue
+
+				evict.append(rel_path)
+				size -= entry[0]
+
+			for rel_path in evict:
+				try:
+					os.unlink(os.path.join(self.cache_dir, rel_path))
+				except OSError:
+					pass
+
+				entry = self.entries.pop(rel_path)
+				self.size -= entry[0]
+				self.evicted += 1
+				self.bytes_evicted += entry[0]
+
+	def report(self):
+		sys.stderr.write('Cache %s: %u hits, %u misses, %.1f MB saved, %.1f MB fetched, %u files (%.1f MB) evicted, %.1f MB in use\n' % (
+			self.cache_dir, self.hits, self.misses, self.bytes_saved / 1048576.0, self.bytes_fetched / 1048576.0,
+			self.evicted, self.bytes_evicted / 1048576.0, self.size / 1048576.0))
+
+_CACHE = None
+
+# Shared cache manager, None if the cache is not managed
+def cache_manager(options):
+	global _CACHE
+
+	if not getattr(options, 'cache_size', 0) and not getattr(options, 'cache_stats', False):
+		return None
+
+	if not _CACHE:
+		_CACHE = CASCCache(options)
+
+	return _CACHE
+
+# Peak resident set size in bytes of this process, or of its waited for child
+# processes. None where there is no resource module (Windows). ru_maxrss is
+# in bytes on macOS, and in kilobytes on Linux and the BSDs.
+def max_rss(children = False):
+	try:
+		import resource
+	except ImportError:
+		return None
+
+	usage = resource.getrusage(children and resource.RUSAGE_CHILDREN or resource.RUSAGE_SELF)
+	return usage.ru_maxrss * (sys.platform == 'darwin' and 1 or 1024)
+
+# Per phase timing and byte counters (--stats). Methods are wrapped with
+# timers only when stats are enabled, so disabled stats cost nothing. Timers
+# nest per thread, a phase is reported under the phases it runs in, and its
+# time includes the time of the phases under it.
+class CASCStats(object):
+	def __init__(self, options):
+		self.options = options
+		self.started = time.time()
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		# Phase path -> [ calls, seconds, bytes ]
+		self.phases = collections.OrderedDict()
+
+		atexit.register(self.report)
+
+	def __stack(self):
+		if not hasattr(self.local, 'stack'):
+			self.local.stack = []
+
+		return self.local.stack
+
+	def add(self, path, seconds, size = 0, calls = 1):
+		with self.lock:
+			phase = self.phases.setdefault(path, [ 0, 0.0, 0 ])
+			phase[0] += calls
+			phase[1] += seconds
+			phase[2] += size or 0
+
+	# Take the phases collected so far, used to pass the phases of worker
+	# processes to the parent
+	def take(self):
+		with self.lock:
+			phases = self.phases
+			self.phases = collections.OrderedDict()
+
+		return list(phases.items())
+
+	def merge(self, phases):
+		for path, (calls, seconds, size) in phases:
+			self.add(path, seconds, size, calls)
+
+	# Phases of the calling thread, for worker threads to continue them with
+	# attach()
+	def context(self):
+		return list(self.__stack())
+
+	def attach(self, context):
+		self.local.stack = list(context)
+
+	# Time calls of cls.method as phase name. size is called with the object
+	# and the return value of a call, and returns the number of bytes the
+	# call processed.
+	def instrument(self, cls, method, name, size = None):
+		function = getattr(cls, method)
+
+		@functools.wraps(function)
+		def timed(obj, *args, **kwargs):
+			stack = self.__stack()
+			stack.append(name)
+			path = '/'.join(stack)
+			# Phases are listed in the order they first start
+			if path not in self.phases:
+				with self.lock:
+					self.phases.setdefault(path, [ 0, 0.0, 0 ])
+
+			start = time.perf_counter()
+			try:
+				result = function(obj, *args, **kwargs)
+			except:
+				self.add(path, time.perf_counter() - start)
+				raise
+			finally:
+				stack.pop()
+
+			self.add(path, time.perf_counter() - start, size and size(obj, result) or 0)
+			return result
+
+		setattr(cls, method, timed)
+
+	def instrument_defaults(self):
+		self.instrument(CDNIndex, 'open_version', 'cdn.version')
+		self.instrument(CDNIndex, 'open_cdns', 'cdn.cdns')
+		self.instrument(CDNIndex, 'open_cdn_build_cfg', 'cdn.config')
+		self.instrument(CDNIndex, 'open_build_cfg', 'cdn.build_config')
+		self.instrument(CDNIndex, 'open_archives', 'cdn.archives')
+		self.instrument(CDNIndex, 'fetch_requests', 'cdn.prefetch')
+		self.instrument(CDNDownloader, 'fetch_to', 'cdn.fetch', lambda obj, result: result)
+		self.instrument(CASCDataIndex, 'open', 'index')
+		self.instrument(CASCEncodingFile, 'open', 'encoding')
+		self.instrument(CASCRootFile, 'open', 'root')
+		self.instrument(BLTEFile, 'extract', 'blte', lambda obj, result: obj.output_length)
+		self.instrument(BLTEBatchExtract, 'extract', 'batch')
+		self.instrument(BLTEExtract, 'extract_file', 'output')
+		self.instrument(BLTEExtract, 'extract_buffer_to_file', 'output')
+		self.instrument(CASCContentStore, 'extract', 'output')
+
+	def summary(self):
+		phases = collections.OrderedDict()
+		for path, (calls, seconds, size) in self.phases.items():
+			children = sum([ child[1] for child_path, child in self.phases.items()
+				if child_path.startswith(path + '/') and '/' not in child_path[len(path) + 1:] ])
+			phases[path] = {
+				'calls': calls,
+				'seconds': seconds,
+				'self_seconds': max(0.0, seconds - children),
+				'bytes': size,
+			}
+
+		return {
+			'seconds': time.time() - self.started,
+			'max_rss': max_rss(),
+			'max_rss_workers': max_rss(children = True),
+			'phases': phases,
+		}
+
+	def report(self):
+		summary = self.summary()
+
+		sys.stderr.write('%-32s %8s %10s %10s %10s %10s\n' % ('phase', 'calls', 'total (s)', 'self (s)', 'MB', 'MB/s'))
+		for path, phase in summary['phases'].items():
+			name = '  ' * path.count('/') + path.split('/')[-1]
+			size = phase['bytes'] and '%.1f' % (phase['bytes'] / 1048576.0) or '-'
+			rate = phase['bytes'] and '%.1f' % (phase['bytes'] / 1048576.0 / max(phase['seconds'], 1e-9)) or '-'
+			sys.stderr.write('%-32s %8u %10.3f %10.3f %10s %10s\n' % (name, phase['calls'], phase['seconds'], phase['self_seconds'], size, rate))
+
+		if summary['max_rss'] is not None:
+			sys.stderr.write('Total %.3f seconds, peak RSS %.1f MB (%.1f MB in worker processes)\n' % (
+				summary['seconds'], summary['max_rss'] / 1048576.0, summary['max_rss_workers'] / 1048576.0))
+		else:
+			sys.stderr.write('Total %.3f seconds\n' % summary['seconds'])
+
+		if getattr(self.options, 'stats_json', None):
+			with open(self.options.stats_json, 'w') as f:
+				json.dump(summary, f, indent = 2)
+
+_STATS = None
+
+# Shared stats collector, None if stats are not enabled (--stats)
+def stats_manager(options):
+	global _STATS
+
+	if not getattr(options, 'stats', False) and not getattr(options, 'stats_json', None):
+		return None
+
+	if not _STATS:
+		_STATS = CASCStats(options)
+		_STATS.instrument_defaults()
+
+	return _STATS
+
+# Concurrent CDN downloader. Keeps a pool of keep-alive connections per CDN
+# host, runs at most max_connections requests at a time, retries failed
+# requests with a jittered exponential backoff, and fails over to the next
+# host of the CDN host list when a host keeps failing.
+class CDNDownloader(object):
+	def __init__(self, options, hosts):
+		self.options = options
+		self.hosts = hosts
+		self.host_idx = 0
+		self.max_connections = max(1, getattr(options, 'cdn_connections', 8))
+		self.retries = max(0, getattr(options, 'cdn_retries', 3))
+		self.rate = max(0, getattr(options, 'cdn_rate', 0)) * 1024
+		self.timeout = 5
+
+		self.idle = collections.defaultdict(list)
+		self.lock = threading.Lock()
+		self.executor = None
+
+		self.requests = 0
+		self.resumes = 0
+		self.bytes = 0
+		self.started = None
+		self.finished = None
+		self.throttle_time = 0
+
+	def __connection(self, host):
+		with self.lock:
+			if len(self.idle[host]) > 0:
+				return self.idle[host].pop()
+
+		return http.client.HTTPConnection(host, timeout = self.timeout)
+
+	def __release(self, host, connection, response):
+		# A partially read response can not be followed by a new request
+		if response.will_close or not response.isclosed():
+			connection.close()
+			return
+
+		with self.lock:
+			self.idle[host].append(connection)
+
+	def __host(self):
+		with self.lock:
+			return self.hosts[self.host_idx % len(self.hosts)]
+
+	def __failover(self, host):
+		with self.lock:
+			if self.hosts[self.host_idx % len(self.hosts)] == host:
+				self.host_idx += 1
+
+	# Keep the combined transfer rate of all connections at most --cdn-rate.
+	# Each block moves the time the transfer may continue forward by its
+	# length at the allowed rate, idle time does not build up a burst.
+	def __throttle(self, length):
+		if self.rate == 0:
+			return
+
+		with self.lock:
+			now = time.monotonic()
+			self.throttle_time = max(self.throttle_time, now) + length / self.rate
+			delay = self.throttle_time - now
+
+		if delay > 0:
+			time.sleep(delay)
+
+	# Stream path into handle in fixed size blocks. A failed transfer is
+	# resumed with a Range request from the last byte written, on the same or
+	# on the next CDN host. Returns the number of bytes written.
+	def fetch_to(self, path, handle, headers = None):
+		first, last = _http_range(headers)
+		written = 0
+		error = None
+		for attempt in range(0, self.retries + 1):
+			if attempt > 0:
+				time.sleep(min(8.0, 0.5 * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+			position = first + written
+			request_headers = dict(headers or {})
+			if position > 0 or last is not None:
+				request_headers['Range'] = _http_range_value(position, last)
+			elif 'Range' in request_headers:
+				del request_headers['Range']
+
+			with self.lock:
+				self.requests += 1
+				self.resumes += written > 0 and 1 or 0
+				if self.started is None:
+					self.started = time.time()
+
+			host = self.__host()
+			connection = self.__connection(host)
+			try:
+				connection.request('GET', path, headers = request_headers)
+				response = connection.getresponse()
+				# Nothing past the end of the file, when resuming a complete download
+				if response.status == 416 and position > 0 and last is None:
+					response.read()
+					self.__release(host, connection, response)
+					return written
+
+				if response.status not in [200, 206]:
+					response.read()
+					self.__release(host, connection, response)
+					error = '%s: HTTP status %u' % (host, response.status)
+					self.__failover(host)
+					continue
+
+				# Servers may ignore the Range header, and send the whole file
+				skip = response.status == 200 and position or 0
+				remaining = None
+				if last is not None:
+					remaining = last + 1 - position
+				while remaining is None or remaining > 0:
+					block = response.read(_DOWNLOAD_BLOCK_SIZE)
+					if not block:
+						break
+
+					with self.lock:
+						self.bytes += len(block)
+
+					self.__throttle(len(block))
+
+					if skip > 0:
+						skipped = min(skip, len(block))
+						block = block[skipped:]
+						skip -= skipped
+
+					if remaining is not None:
+						block = block[:remaining]
+						remaining -= len(block)
+
+					handle.write(block)
+					written += len(block)
+			except (OSError, http.client.HTTPException) as e:
+				connection.close()
+				error = '%s: %s' % (host, e)
+				self.__failover(host)
+				continue
+
+			if (remaining is not None and remaining > 0) or (remaining is None and response.length):
+				connection.close()
+				error = '%s: connection closed after %u bytes' % (host, written)
+				self.__failover(host)
+				continue
+
+			self.__release(host, connection, response)
+			with self.lock:
+				self.finished = time.time()
+
+			return written
+
+		raise IOError('Unable to fetch %s (%s)' % (path, error))
+
+	def fetch(self, path, headers = None):
+		handle = io.BytesIO()
+		self.fetch_to(path, handle, headers)
+
+		return handle.getvalue()
+
+	def report(self):
+		if self.started is None or self.finished is None:
+			return
+
+		elapsed = max(self.finished - self.started, 0.001)
+		print('Downloaded %.1fMB in %.1f seconds (%.1fMB/s), %u requests, %u resumed' % (
+			self.bytes / 1048576.0, elapsed, self.bytes / 1048576.0 / elapsed, self.requests, self.resumes))
+
+	# Fetch (path, headers, handle) requests concurrently, streaming each
+	# response into its handle, which is closed once the response is complete.
+	# requests is consumed lazily, and at most two requests per connection are
+	# in flight. Yields request indexes in completion order.
+	def fetch_many(self, requests):
+		if not self.executor:
+			self.executor = concurrent.futures.ThreadPoolExecutor(self.max_connections)
 
-		try:
-			with open(output_path, 'wb') as output_file:
-				output_file.write(data)
-		except IOError as e:
-			self.options.parser.error('Output "%s" is not writable: %s' % (output_path, e.strerror))
+		def fetch(path, headers, handle):
+			self.fetch_to(path, handle, headers)
+			handle.close()
 
-		return True
+		requests = enumerate(requests)
+		futures = {}
+		try:
+			while True:
+				for idx, (path, headers, handle) in itertools.islice(requests, 2 * self.max_connections - len(futures)):
+					futures[self.executor.submit(fetch, path, headers, handle)] = idx
+
+				if len(futures) == 0:
+					break
+
+				done, pending = concurrent.futures.wait(futures, return_when = concurrent.futures.FIRST_COMPLETED)
+				for future in done:
+					idx = futures.pop(future)
+					future.result()
+					yield idx
+		finally:
+			for future in futures:
+				future.cancel()
 
 class CASCObject(object):
 	def __init__(self, options):
@@ -320,11 +2009,27 @@ class CASCObject(object):
 			f = urllib.request.urlopen(req, timeout = 5)
 			if f.getcode() not in [200, 206]:
 				self.options.parser.error('HTTP request for %s returns %u' % (url, f.getcode()))
+		except urllib.error.HTTPError as e:
+			# Nothing past the end of the file, when resuming a complete download
+			first, last = _http_range(headers)
+			if e.code == 416 and first > 0 and last is None:
+				return io.BytesIO()
+
+			self.options.parser.error('Unable to fetch %s: %s' % (url, e.reason))
 		except urllib.error.URLError as e:
 			self.options.parser.error('Unable to fetch %s: %s' % (url, e.reason))
 
 		return f
 
+	# CDN hosts to fetch from. A --cdn-host override (e.g., a casc_extract
+	# proxy) replaces the hosts given by the patch server or .build.info.
+	def select_cdn_hosts(self, hosts):
+		cdn_host = getattr(self.options, 'cdn_host', None)
+		if cdn_host:
+			return [ cdn_host ]
+
+		return hosts
+
 	def cache_dir(self, path = None):
 		dir = self.options.cache
 		if path:
@@ -338,20 +2043,122 @@ class CASCObject(object):
 
 		return dir
 
-	def cached_open(self, file, url, headers = None):
-		handle = None
+	def cache_pin(self, path):
+		cache = cache_manager(self.options)
+		if cache:
+			cache.pin(path)
+
+	# Stream url into handle. A dropped connection ends the response early,
+	# instead of raising.
+	def stream_url(self, url, handle, headers = None):
+		response = self.get_url(url, headers)
+		shutil.copyfileobj(response, handle, _DOWNLOAD_BLOCK_SIZE)
+		if getattr(response, 'length', None):
+			self.options.parser.error('Unable to fetch %s: connection closed with %u bytes left' % (url, response.length))
+
+	# Files are written into the cache under a temporary name, verified with
+	# checksum, and atomically renamed, so an interrupted write never leaves a
+	# truncated file in the cache
+	def cache_commit(self, file, write, checksum = None):
+		partial = '%s.%u.%u%s' % (file, os.getpid(), threading.get_ident(), _PARTIAL_SUFFIX)
+		try:
+			with open(partial, 'w+b') as f:
+				write(f)
+
+				if checksum and not checksum(f):
+					self.options.parser.error('Checksum mismatch for %s' % os.path.basename(file))
+
+
+			os.replace(partial, file)
+		finally:
+			if os.path.exists(partial):
+				os.unlink(partial)
+
+		cache = cache_manager(self.options)
+		if cache:
+			cache.add(file, os.path.getsize(file))
+
+	def cache_write(self, file, data, checksum = None):
+		self.cache_commit(file, lambda f: f.write(data), checksum)
+
+	# Downloads are written into a partial file of a stable name next to
+	# their cache file, which is kept if the download fails. Returns the
+	# number of bytes of file's partial file to continue the download from,
+	# at most length bytes, or None if the partial file is complete, and was
+	# moved into the cache. Downloads without a checksum can not be verified
+	# once resumed, and always start over.
+	def cache_resume(self, file, checksum = None, length = None):
+		partial = file + _PARTIAL_SUFFIX
+		if not checksum or not os.path.exists(partial):
+			return 0
+
+		with open(partial, 'rb') as f:
+			complete = checksum(f)
+			size = f.seek(0, os.SEEK_END)
 
-		if not os.path.exists(file):
-			handle = self.get_url(url, headers)
-			data = handle.read()
-			with open(file, 'wb') as f:
-				f.write(data)
+		if complete:
+			self.cache_store(file)
+			return None
 
-			handle = io.BytesIO(data)
+		if length is not None and size >= length:
+			os.unlink(partial)
+			return 0
+
+		return size
+
+	# Move the verified partial file of file into the cache
+	def cache_store(self, file):
+		os.replace(file + _PARTIAL_SUFFIX, file)
+
+		cache = cache_manager(self.options)
+		if cache:
+			cache.add(file, os.path.getsize(file))
+
+	def download(self, file, url, headers = None, checksum = None):
+		first, last = _http_range(headers)
+		length = None
+		if last is not None:
+			length = last + 1 - first
+
+		resume = self.cache_resume(file, checksum, length)
+		if resume is None:
+			return
+
+		partial = file + _PARTIAL_SUFFIX
+		try:
+			with open(partial, 'a+b') as f:
+				f.truncate(resume)
+				if resume > 0:
+					print('Resuming %s at byte %u ...' % (url, resume))
+
+				self.stream_url(url, f, _resume_headers(headers, resume))
+
+				# A resumed download that does not verify is downloaded again as a whole
+				if resume > 0 and not checksum(f):
+					f.truncate(0)
+					self.stream_url(url, f, headers)
+
+				verified = not checksum or checksum(f)
+		except BaseException:
+			if not checksum and os.path.exists(partial):
+				os.unlink(partial)
+			raise
+
+		if not verified:
+			os.unlink(partial)
+			self.options.parser.error('Checksum mismatch for %s' % os.path.basename(file))
+
+		self.cache_store(file)
+
+	def cached_open(self, file, url, headers = None, checksum = None):
+		if not os.path.exists(file):
+			self.download(file, url, headers, checksum)
 		else:
-			handle = open(file, 'rb')
+			cache = cache_manager(self.options)
+			if cache:
+				cache.hit(file)
 
-		return handle
+		return open(file, 'rb')
 
 class BuildCfg:
 	def __init__(self, handle):
@@ -370,6 +2177,175 @@ class BuildCfg:
 
 			setattr(self, key, data)
 
+# Pre-parsed lookup tables of a build (--snapshot). Each compact index is
+# stored in its own file under CACHE_DIR/snapshot/<build configuration>, and
+# memory mapped on later runs instead of parsing the source files again. A
+# snapshot table is only used if it was written from the same source, i.e.,
+# the same CDN versions hash or local .build.info contents.
+class CASCSnapshot(CASCObject):
+	_MAGIC = b'CASCSNAP'
+	_VERSION = 1
+	_HEADER = struct.Struct('<8sII')
+	_ALIGN = 16
+
+	def __init__(self, options, build_cfg_hash, source):
+		CASCObject.__init__(self, options)
+
+		self.build_cfg_hash = build_cfg_hash
+		self.source = source
+		self.maps = []
+
+		self.cache_pin(self.cache_dir(os.path.join('snapshot', self.build_cfg_hash)))
+
+	def snapshot_path(self, name):
+		return os.path.join(self.cache_dir(os.path.join('snapshot', self.build_cfg_hash)), name)
+
+	def load(self, name, record_type = None):
+		path = self.snapshot_path(name)
+		if not os.access(path, os.R_OK) or os.stat(path).st_size <= CASCSnapshot._HEADER.size:
+			return None
+
+		with open(path, 'rb') as f:
+			data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+		magic, version, header_len = CASCSnapshot._HEADER.unpack_from(data, 0)
+		if magic != CASCSnapshot._MAGIC or version != CASCSnapshot._VERSION:
+			data.close()
+			return None
+
+		offset = CASCSnapshot._HEADER.size
+		header = json.loads(data[offset:offset + header_len].decode('utf-8'))
+		if header['source'] != self.source:
+			data.close()
+			return None
+
+		index = CASCCompactIndex(header['key_format'], header['record_format'], record_type, header['multi'])
+		view = memoryview(data)
+		index.keys = view[header['keys_offset']:header['keys_offset'] + header['keys_length']]
+		index.records = view[header['records_offset']:header['records_offset'] + header['records_length']]
+		index.n_entries = header['n_entries']
+		index.n_keys = header['n_keys']
+
+		self.maps.append(data)
+
+		return index
+
+	def save(self, name, index):
+		header = {
+			'source'        : self.source,
+			'key_format'    : index.key.format[1:],
+			'record_format' : index.record.format[1:],
+			'multi'         : index.multi,
+			'n_entries'     : index.n_entries,
+			'n_keys'        : index.n_keys,
+		}
+
+		# Header length depends on the buffer offsets, so reserve room for them
+		header_len = len(json.dumps(header)) + 256
+		header['keys_offset'] = self.__align(CASCSnapshot._HEADER.size + header_len)
+		header['keys_length'] = len(index.keys)
+		header['records_offset'] = self.__align(header['keys_offset'] + len(index.keys))
+		header['records_length'] = len(index.records)
+
+		header_data = json.dumps(header).encode('utf-8')
+		header_data += b' ' * (header_len - len(header_data))
+
+		path = self.snapshot_path(name)
+		tmp_path = '%s.%u.tmp' % (path, os.getpid())
+		with open(tmp_path, 'wb') as f:
+			f.write(CASCSnapshot._HEADER.pack(CASCSnapshot._MAGIC, CASCSnapshot._VERSION, header_len))
+			f.write(header_data)
+			f.write(bytes(header['keys_offset'] - f.tell()))
+			f.write(index.keys)
+			f.write(bytes(header['records_offset'] - f.tell()))
+			f.write(index.records)
+
+		# Write then rename, so an interrupted run never leaves a truncated snapshot
+		os.replace(tmp_path, path)
+
+	def __align(self, offset):
+		return (offset + CASCSnapshot._ALIGN - 1) & ~(CASCSnapshot._ALIGN - 1)
+
+# Output handle of a CDNRequest. The response is written straight into the
+# partial files of the request's parts, and each part is verified and moved
+# into the cache as soon as its last byte arrives. The bytes of gaps between
+# parts, and of parts already in their partial file, are skipped. Resumed
+# parts that do not verify are collected in retry.
+class CDNRequestWriter(object):
+	def __init__(self, cdn, request):
+		self.cdn = cdn
+		self.position = request.start
+		self.parts = collections.deque(request.parts)
+		self.handle = None
+		self.retry = []
+
+	def __open(self, part):
+		offset, size, path, checksum, resume = part
+		self.handle = open(path + _PARTIAL_SUFFIX, 'a+b')
+		self.handle.truncate(resume)
+
+	def __finish(self):
+		part = self.parts.popleft()
+		offset, size, path, checksum, resume = part
+
+		if not self.handle:
+			self.__open(part)
+
+		try:
+			verified = not checksum or checksum(self.handle)
+		finally:
+			self.handle.close()
+			self.handle = None
+
+		if verified:
+			self.cdn.cache_store(path)
+			return
+
+		os.unlink(path + _PARTIAL_SUFFIX)
+		if resume == 0:
+			raise IOError('Checksum mismatch for %s' % os.path.basename(path))
+
+		self.retry.append(part)
+
+	def write(self, data):
+		data = memoryview(data)
+		while len(data) > 0 and len(self.parts) > 0:
+			offset, size, path, checksum, resume = self.parts[0]
+			end = None
+			if size is not None:
+				end = offset + size
+
+			if self.position < offset + resume:
+				length = min(len(data), offset + resume - self.position)
+			else:
+				if not self.handle:
+					self.__open(self.parts[0])
+
+				length = len(data)
+				if end is not None:
+					length = min(length, end - self.position)
+				self.handle.write(data[:length])
+
+			data = data[length:]
+			self.position += length
+			if end is not None and self.position >= end:
+				self.__finish()
+
+	# Close the partial file being written, it is kept for a later resume
+	def release(self):
+		if self.handle:
+			self.handle.close()
+			self.handle = None
+
+	# The response is complete, the last part may run to its end
+	def close(self):
+		if len(self.parts) > 0 and self.parts[0][1] is None:
+			self.__finish()
+
+		if len(self.parts) > 0:
+			self.release()
+			raise IOError('Response ended before %s' % os.path.basename(self.parts[0][2]))
+
 class CDNIndex(CASCObject):
 	PATCH_BASE_URL = 'http://us.patch.battle.net:1119'
 
@@ -377,16 +2353,28 @@ class CDNIndex(CASCObject):
 	PATCH_PTR = 'wowt'
 	PATCH_LIVE = 'wow'
 
-	def __init__(self, options):
+	# product selects the patch server product, instead of --ptr/--beta. Builds
+	# opened with a shared CDNIndex add their archives to its archive list
+	# and CDN index, so archives common to several builds are parsed once.
+	# build_cfg_hash selects a build configuration, instead of the current
+	# build of the product; archives still come from the current CDN
+	# configuration.
+	def __init__(self, options, product = None, shared = None, build_cfg_hash = None):
 		CASCObject.__init__(self, options)
 
+		self.product = product
+		self.shared = shared
+		self.pinned_build_cfg = build_cfg_hash
 		self.cdn_hash = None
 		self.cdn_host = None
+		self.cdn_hosts = []
 		self.cdn_path = None
+		self.cdn_downloader = None
 		self.build_cfg_hash = []
 		self.archives = []
 		self.cdn_index = {}
 		self.builds = []
+		self.snapshot = None
 
 		self.version = None
 		self.build_number = 0
@@ -409,12 +2397,15 @@ class CDNIndex(CASCObject):
 		return self.cdn_url('data', self.get_build_cfg().encoding[1])
 
 	def patch_base_url(self):
-		if self.options.ptr:
-			return '%s/%s' % ( CDNIndex.PATCH_BASE_URL, CDNIndex.PATCH_PTR )
+		base_url = getattr(self.options, 'patch_url', None) or CDNIndex.PATCH_BASE_URL
+		if self.product:
+			return '%s/%s' % ( base_url, self.product )
+		elif self.options.ptr:
+			return '%s/%s' % ( base_url, CDNIndex.PATCH_PTR )
 		elif self.options.beta:
-			return '%s/%s' % ( CDNIndex.PATCH_BASE_URL, CDNIndex.PATCH_BETA )
+			return '%s/%s' % ( base_url, CDNIndex.PATCH_BETA )
 		else:
-			return '%s/%s' % ( CDNIndex.PATCH_BASE_URL, CDNIndex.PATCH_LIVE )
+			return '%s/%s' % ( base_url, CDNIndex.PATCH_LIVE )
 
 	def open_cdns(self):
 		cdns_url = '%s/cdns' % self.patch_base_url()
@@ -427,7 +2418,8 @@ class CDNIndex(CASCObject):
 				continue
 
 			self.cdn_path = split[1]
-			self.cdn_host = split[2].split(' ')[0].strip()
+			self.cdn_hosts = self.select_cdn_hosts([ host for host in split[2].strip().split(' ') if host ])
+			self.cdn_host = self.cdn_hosts and self.cdn_hosts[0] or None
 
 		if not self.cdn_path or not self.cdn_host:
 			sys.stderr.write('Unable to extract CDN information\n')
@@ -439,6 +2431,77 @@ class CDNIndex(CASCObject):
 	def cdn_url(self, type, file):
 		return '%s/%s/%s/%s/%s' % (self.cdn_base_url(), type, file[:2], file[2:4], file)
 
+	def downloader(self):
+		if not self.cdn_downloader:
+			self.cdn_downloader = CDNDownloader(self.options, self.cdn_hosts)
+
+		return self.cdn_downloader
+
+	# CDN requests go through the downloader, and may be served by any CDN host
+	def get_url(self, url, headers = None):
+		host_url = 'http://%s' % self.cdn_host
+		if not self.cdn_host or not url.startswith(self.cdn_base_url()):
+			return CASCObject.get_url(self, url, headers)
+
+		print('Fetching %s ...' % url)
+		try:
+			return io.BytesIO(self.downloader().fetch(url[len(host_url):], headers))
+		except IOError as e:
+			self.options.parser.error(str(e))
+
+	def stream_url(self, url, handle, headers = None):
+		host_url = 'http://%s' % self.cdn_host
+		if not self.cdn_host or not url.startswith(self.cdn_base_url()):
+			return CASCObject.stream_url(self, url, handle, headers)
+
+		print('Fetching %s ...' % url)
+		try:
+			self.downloader().fetch_to(url[len(host_url):], handle, headers)
+		except IOError as e:
+			self.options.parser.error(str(e))
+
+	def download_report(self):
+		if self.cdn_downloader:
+			self.cdn_downloader.report()
+
+	# Run CDNRequests concurrently, and stream their parts into the cache.
+	# Resumed parts that do not verify are fetched again as a whole.
+	def fetch_requests(self, requests):
+		if len(requests) == 0:
+			return
+
+		print('Fetching %u files with %u requests from %s ...' % (
+			sum([ len(request.parts) for request in requests ]), len(requests), self.cdn_base_url()))
+
+		host_url = 'http://%s' % self.cdn_host
+		writers = [ CDNRequestWriter(self, request) for request in requests ]
+		try:
+			for idx in self.downloader().fetch_many((request.url[len(host_url):], request.headers, writer)
+					for request, writer in zip(requests, writers)):
+				pass
+		except IOError as e:
+			self.options.parser.error(str(e))
+		finally:
+			for writer in writers:
+				writer.release()
+
+		retry = []
+		for request, writer in zip(requests, writers):
+			for offset, size, path, checksum, resume in writer.retry:
+				headers = None
+				if size is not None:
+					headers = { 'Range': _http_range_value(offset, offset + size - 1) }
+				retry.append(CDNRequest(request.url, headers, offset, [ (offset, size, path, checksum, 0) ]))
+
+		if len(retry) > 0:
+			self.fetch_requests(retry)
+
+	# Fetch missing (cache path, url, headers) requests into the cache
+	# concurrently
+	def prefetch(self, requests):
+		self.fetch_requests([ CDNRequest(url, headers, 0, [ (0, None, path, None, 0) ])
+			for path, url, headers in requests if not os.path.exists(path) ])
+
 	def open_version(self):
 		version_url =  '%s/versions' % self.patch_base_url()
 		handle = self.get_url(version_url)
@@ -475,7 +2538,8 @@ class CDNIndex(CASCObject):
 		path = os.path.join(self.cache_dir('config'), self.cdn_hash)
 		url = self.cdn_url('config', self.cdn_hash)
 
-		for line in self.cached_open(path, url):
+		self.cache_pin(path)
+		for line in self.cached_open(path, url, checksum = md5_checksum(self.cdn_hash)):
 			mobj = re.match('^archives = (.+)', line.decode('utf-8'))
 			if mobj:
 				self.archives = mobj.group(1).split(' ')
@@ -492,13 +2556,44 @@ class CDNIndex(CASCObject):
 			path = os.path.join(self.cache_dir('config'), cfg)
 			url = self.cdn_url('config', cfg)
 
-			self.builds.append(BuildCfg(self.cached_open(path, url)))
+			self.cache_pin(path)
+			self.builds.append(BuildCfg(self.cached_open(path, url, checksum = md5_checksum(cfg))))
+
+	def open_snapshot(self):
+		if not getattr(self.options, 'snapshot', False):
+			return
+
+		self.snapshot = CASCSnapshot(self.options, self.build_cfg_hash[0], self.cdn_hash)
 
 	def open_archives(self):
+		if self.snapshot:
+			cdn_index = self.snapshot.load('cdn_index', CDNIndexRecord)
+			if cdn_index:
+				self.cdn_index = cdn_index
+				print('Using CDN index snapshot, %u entries' % len(self.cdn_index))
+				return
+
+		first = 0
+		# Keys are content addressed, so a key can be fetched from any archive
+		# that holds it. The compact index can not grow once finalized.
+		if self.shared and not isinstance(self.shared.cdn_index, CASCCompactIndex):
+			known = set(self.shared.archives)
+			archives = [ archive for archive in self.archives if archive not in known ]
+			print('Sharing %u of %u CDN index files' % (len(self.archives) - len(archives), len(self.archives)))
+
+			first = len(self.shared.archives)
+			self.archives = self.shared.archives
+			self.archives.extend(archives)
+			self.cdn_index = self.shared.cdn_index
+		elif getattr(self.options, 'compact_index', False):
+			self.cdn_index = CASCCompactIndex('16s', 'Iii', CDNIndexRecord)
+
 		sys.stdout.write('Parsing CDN index files ... ')
 
 		index_cache = self.cache_dir('index')
-		for idx in range(0, len(self.archives)):
+		self.prefetch([ (os.path.join(index_cache, '%s.index' % archive), self.cdn_url('data', '%s.index' % archive), None) for archive in self.archives[first:] ])
+
+		for idx in range(first, len(self.archives)):
 			index_file_name = '%s.index' % self.archives[idx]
 			index_file_path = os.path.join(index_cache, index_file_name)
 			index_file_url = self.cdn_url('data', index_file_name)
@@ -507,7 +2602,15 @@ class CDNIndex(CASCObject):
 			if not self.parse_archive(handle, idx):
 				self.options.parser.error('Unable to parse index file %s, aborting ...' % index_file_name)
 
-		sys.stdout.write('%u entries\n' % len(self.cdn_index.keys()))
+		if isinstance(self.cdn_index, CASCCompactIndex):
+			duplicates = self.cdn_index.finalize()
+			if duplicates > 0:
+				sys.stderr.write('%u duplicate keys in CDN index files, using the last occurrence\n' % duplicates)
+
+			if self.snapshot:
+				self.snapshot.save('cdn_index', self.cdn_index)
+
+		sys.stdout.write('%u entries\n' % len(self.cdn_index))
 
 	def parse_archive(self, handle, idx):
 		handle.seek(-12, os.SEEK_END)
@@ -520,13 +2623,17 @@ class CDNIndex(CASCObject):
 			key = handle.read(16)
 			size, offset = struct.unpack('>ii', handle.read(8))
 
-			if key in self.cdn_index:
-				sys.stderr.write('Key %s, %d, %d, %d exists in index @ (%s, %d, %d, %d)\n' % (
-					codecs.encode(key, 'hex').decode('utf-8'), idx, size, offset,
-					self.archives[self.cdn_index[key].index],
-					self.cdn_index[key].size, self.cdn_index[ key ].offset ))
+			# Duplicates are counted when the compact index is finalized
+			if isinstance(self.cdn_index, CASCCompactIndex):
+				self.cdn_index.add(key, idx, size, offset)
+			else:
+				if key in self.cdn_index:
+					sys.stderr.write('Key %s, %d, %d, %d exists in index @ (%s, %d, %d)\n' % (
+						codecs.encode(key, 'hex').decode('utf-8'), idx, size, offset,
+						self.archives[self.cdn_index[key].index],
+						self.cdn_index[key].size, self.cdn_index[ key ].offset ))
 
-			self.cdn_index[key] = CDNIndexRecord(idx, size, offset)
+				self.cdn_index[key] = CDNIndexRecord(idx, size, offset)
 
 			block_bytes_left = 4096 - handle.tell() % 4096
 			if block_bytes_left < 24:
@@ -543,61 +2650,565 @@ class CDNIndex(CASCObject):
 		return True
 
 	def open(self):
+		if not self.open_build():
+			return False
+
+		self.open_snapshot()
+		self.open_archives()
+
+		return True
+
+	# Open the build without the CDN archive indices, enough to fetch the
+	# encoding and root files
+	def open_build(self):
 		self.open_version()
 		self.open_cdns()
 		self.open_cdn_build_cfg()
+
+		if self.pinned_build_cfg:
+			self.build_cfg_hash = [ self.pinned_build_cfg ]
+
 		self.open_build_cfg()
-		self.open_archives()
+
+		if self.pinned_build_cfg:
+			self.version = getattr(self.get_build_cfg(), 'build_name', self.pinned_build_cfg)
+			print('Using build configuration %s, build %s' % (self.pinned_build_cfg, self.version))
 
 		return True
 
-	def fetch_file(self, key):
+	# (cache path, url, headers) request for a file, the file is either in an
+	# archive or stored on its own
+	def file_request(self, key):
 		key_info = self.cdn_index.get(key, None)
-		handle = None
 		key_file_path = os.path.join(self.cache_dir('data'), codecs.encode(key, 'hex').decode('utf-8'))
 		if key_info:
 			key_file_url = self.cdn_url('data', self.archives[key_info.index])
 
-			handle = self.cached_open(key_file_path, key_file_url, {'Range': 'bytes=%d-%d' % (key_info.offset, key_info.offset + key_info.size - 1)})
+			return (key_file_path, key_file_url, {'Range': 'bytes=%d-%d' % (key_info.offset, key_info.offset + key_info.size - 1)})
+		else:
+			return (key_file_path, self.cdn_url('data', codecs.encode(key, 'hex').decode('utf-8')), None)
+
+	# Plan the CDN requests for files missing from the cache. Files in the same
+	# archive are sorted by offset, and neighboring files are merged into a
+	# single range request, as long as the gap between them is at most
+	# --cdn-max-gap bytes, and the merged range at most --cdn-max-span bytes.
+	# Files not in an archive are requested on their own.
+	def plan_files(self, keys):
+		max_gap = getattr(self.options, 'cdn_max_gap', 64) * 1024
+		max_span = getattr(self.options, 'cdn_max_span', 16) * 1024 * 1024
+
+		data_cache = self.cache_dir('data')
+		archived = collections.defaultdict(list)
+		requests = []
+		for key in sorted(set(keys)):
+			key_hex = codecs.encode(key, 'hex').decode('utf-8')
+			path = os.path.join(data_cache, key_hex)
+			if os.path.exists(path):
+				continue
+
+			# Files left partially downloaded by an earlier run continue from
+			# the end of their partial file
+			key_info = self.cdn_index.get(key, None)
+			resume = self.cache_resume(path, blte_checksum(key), key_info and key_info.size or None)
+			if resume is None:
+				continue
+
+			if key_info:
+				archived[key_info.index].append((key_info.offset, key_info.size, path, blte_checksum(key), resume))
+			else:
+				requests.append(CDNRequest(self.cdn_url('data', key_hex), _resume_headers(None, resume), resume,
+					[ (0, None, path, blte_checksum(key), resume) ]))
+
+		for index in sorted(archived.keys()):
+			parts = sorted(archived[index], key = lambda part: part[:3])
+			spans = []
+			for part in parts:
+				offset, size, path, checksum, resume = part
+				if len(spans) > 0 and offset - spans[-1][1] <= max_gap and offset + size - spans[-1][0] <= max_span:
+					spans[-1][1] = max(spans[-1][1], offset + size)
+					spans[-1][2].append(part)
+				else:
+					spans.append([ offset + resume, offset + size, [ part ] ])
+
+			url = self.cdn_url('data', self.archives[index])
+			for start, end, span_parts in spans:
+				requests.append(CDNRequest(url, {'Range': 'bytes=%d-%d' % (start, end - 1)}, start, span_parts))
+
+		return requests
+
+	def print_plan(self, requests):
+		files = 0
+		payload = 0
+		fetched = 0
+		loose = 0
+		for request in requests:
+			files += len(request.parts)
+			if request.parts[0][1] is None:
+				loose += 1
+				continue
+
+			end = max([ part[0] + part[1] for part in request.parts ])
+			payload += sum([ part[1] - part[4] for part in request.parts ])
+			fetched += end - request.start
+			print('%s bytes=%d-%d, %u files' % (request.url, request.start, end - 1, len(request.parts)))
+
+		print('%u files in %u requests (%u ranged, %u whole files)' % (files, len(requests), len(requests) - loose, loose))
+		print('Ranged requests fetch %u bytes for %u bytes of files (%u bytes wasted)' % (fetched, payload, fetched - payload))
+
+	def prefetch_files(self, keys):
+		self.fetch_requests(self.plan_files(keys))
+
+	# Download a file into the cache, returns the cache path
+	def download_file(self, key):
+		path, url, headers = self.file_request(key)
+		if not os.path.exists(path):
+			self.download(path, url, headers, blte_checksum(key))
+
+		return path
+
+	def fetch_file(self, key):
+		with self.cached_open(*self.file_request(key), checksum = blte_checksum(key)) as handle:
+			return handle.read()
+
+# Watches the versions files of patch server products for new builds, and
+# prefetches each new build into the cache: CDN and build configurations,
+# CDN archive indexes, the encoding and root files, and the files of the
+# listfile. A later extraction of the build then runs from the cache. Polls
+# are conditional requests on the validators of the previous response, and
+# new builds are prefetched one at a time in a background thread, while
+# polling continues.
+class CDNWatcher(object):
+	def __init__(self, options, targets, fname_db = None):
+		self.options = options
+		self.fname_db = fname_db
+
+		# Products, and the locales to prefetch root file entries of
+		self.products = collections.OrderedDict()
+		for product, locale in targets:
+			self.products.setdefault(product, []).append(locale)
+
+		self.validators = {}
+		self.builds = {}
+		self.pending = {}
+		self.executor = concurrent.futures.ThreadPoolExecutor(1)
+
+		self.polls = 0
+		self.not_modified = 0
+		self.prefetched = 0
+
+	def log(self, message):
+		print('[%s] %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), message))
+		sys.stdout.flush()
+
+	def versions_url(self, product):
+		return '%s/versions' % CDNIndex(self.options, product).patch_base_url()
+
+	# Fetch the versions file of a product, returns (build configuration,
+	# version, validators), or None if it is unchanged or can not be fetched
+	def poll(self, product):
+		url = self.versions_url(product)
+		self.polls += 1
+		try:
+			handle = urllib.request.urlopen(urllib.request.Request(url, headers = self.validators.get(product, {})), timeout = 5)
+			data = handle.read().decode('utf-8')
+		except urllib.error.HTTPError as e:
+			if e.code == 304:
+				self.not_modified += 1
+			else:
+				self.log('%s: HTTP status %u' % (url, e.code))
+			return None
+		except (urllib.error.URLError, OSError, http.client.HTTPException) as e:
+			self.log('%s: %s' % (url, getattr(e, 'reason', e)))
+			return None
+
+		validators = {}
+		if handle.headers.get('ETag'):
+			validators['If-None-Match'] = handle.headers['ETag']
+		if handle.headers.get('Last-Modified'):
+			validators['If-Modified-Since'] = handle.headers['Last-Modified']
+
+		for line in data.split('\n'):
+			split = line.strip().split('|')
+			if split[0] != 'us' or len(split) < 3:
+				continue
+
+			return split[1], split[-2], validators
+
+		self.log('%s: no build for region us' % url)
+		return None
+
+	def prefetch(self, product, build_cfg_hash, version):
+		start = time.time()
+		try:
+			cdn = CDNIndex(self.options, product, build_cfg_hash = build_cfg_hash)
+			if not cdn.open():
+				return False
+
+			encoding = CASCEncodingFile(self.options, cdn)
+			if not encoding.open():
+				return False
+
+			keys = set()
+			for locale in self.products[product]:
+				root = CASCRootFile(self.options, cdn, encoding, None, locale)
+				if not root.open():
+					return False
+
+				for file_hash, file_name in (self.fname_db or {}).items():
+					for md5s in root.GetFileHashMD5(file_hash)[:1]:
+						keys.update(encoding.GetFileKeys(md5s)[:1])
+
+			cdn.prefetch_files(keys)
+			cdn.download_report()
+		# Errors of a single build are reported, and the build is tried again
+		# on the next poll. parser.error() exits with SystemExit, other errors
+		# are logged with their traceback, so they do not end the watch.
+		except SystemExit as e:
+			self.log('Prefetch of %s build %s failed: %s' % (product, version, e))
+			return False
+		except Exception as e:
+			self.log('Prefetch of %s build %s failed: %s\n%s' % (product, version, e, traceback.format_exc().rstrip()))
+			return False
+
+		self.log('Prefetched %s build %s (%s), %u files in %.1f seconds' % (
+			product, version, build_cfg_hash, len(keys), time.time() - start))
+		return True
+
+	# Collect finished prefetches. A failed one forgets the validators of its
+	# product, so the next poll sees the build again.
+	def collect(self, wait = False):
+		for product, (build_cfg_hash, version, validators, future) in list(self.pending.items()):
+			if not wait and not future.done():
+				continue
+
+			if future.result():
+				self.builds[product] = build_cfg_hash
+				self.validators[product] = validators
+				self.prefetched += 1
+
+			del self.pending[product]
+
+	def check(self):
+		self.collect()
+
+		for product in self.products.keys():
+			result = self.poll(product)
+			if not result:
+				continue
+
+			build_cfg_hash, version, validators = result
+			if build_cfg_hash == self.builds.get(product):
+				self.validators[product] = validators
+				continue
+
+			# Only a single prefetch per product is in flight, a newer build is
+			# picked up once it finishes
+			if product in self.pending:
+				continue
+
+			self.log('New %s build %s (%s)' % (product, version, build_cfg_hash))
+			self.pending[product] = (build_cfg_hash, version, validators,
+				self.executor.submit(self.prefetch, product, build_cfg_hash, version))
+
+	# Poll every interval seconds, polls times (forever if 0)
+	def run(self, interval, polls = 0):
+		self.log('Watching %s every %u seconds' % (', '.join(self.products.keys()), interval))
+
+		n_polls = 0
+		try:
+			while True:
+				self.check()
+
+				n_polls += 1
+				if polls and n_polls >= polls:
+					break
+
+				time.sleep(interval)
+		except KeyboardInterrupt:
+			pass
+
+		self.collect(True)
+		self.executor.shutdown()
+
+		self.log('%u polls, %u not modified, %u builds prefetched' % (self.polls, self.not_modified, self.prefetched))
+
+# Request handler of CDNProxy, GET requests of CDN files with an optional
+# single range
+class CDNProxyHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		if self.server.proxy.verbose:
+			http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+	def do_GET(self):
+		proxy = self.server.proxy
+		if not CDNProxy.PATH_RE.match(self.path):
+			self.send_error(404)
+			return
+
+		try:
+			first, last = proxy.range(self.headers.get('Range'))
+			path, offset, size, total = proxy.open(self.path, first, last)
+		except ValueError:
+			self.send_error(416)
+			return
+		except IOError as e:
+			self.send_error(502, str(e))
+			return
+
+		with open(path, 'rb') as handle:
+			if first is None:
+				self.send_response(200)
+			else:
+				self.send_response(206)
+				if total is None:
+					total = '*'
+				self.send_header('Content-Range', 'bytes %d-%d/%s' % (first, first + size - 1, total))
+			self.send_header('Content-Type', 'application/octet-stream')
+			self.send_header('Content-Length', str(size))
+			self.end_headers()
+
+			handle.seek(offset)
+			remaining = size
+			try:
+				while remaining > 0:
+					block = handle.read(min(remaining, _DOWNLOAD_BLOCK_SIZE))
+					if not block:
+						break
+
+					self.wfile.write(block)
+					remaining -= len(block)
+			# Clients going away mid transfer are not an error of the proxy
+			except (BrokenPipeError, ConnectionResetError):
+				self.close_connection = True
+
+		proxy.served(size - remaining)
+
+# Caching CDN proxy (-m proxy). Serves the CDN path layout (/<cdn path>/config,
+# /data, and /patch files) from a store directory shared by everyone using the
+# proxy, and fetches misses from the upstream CDN hosts. Concurrent requests
+# for the same missing file or range share a single upstream fetch. Whole
+# files are stored under their CDN path, ranges of files not in the store
+# under <CDN path>.ranges/<first>-<last>, and any stored range containing a
+# requested range serves it. Clients use the proxy with --cdn-host.
+class CDNProxy(object):
+	PATH_RE = re.compile('^/[A-Za-z0-9_/-]+/(config|data|patch)/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{32}(\\.index)?$')
+	RANGE_SUFFIX = '.ranges'
+
+	def __init__(self, options, hosts):
+		self.options = options
+		self.store = options.proxy_store
+		self.downloader = CDNDownloader(options, hosts)
+		self.verbose = False
+
+		self.lock = threading.Lock()
+		self.inflight = {}
+
+		self.hits = 0
+		self.misses = 0
+		self.shared = 0
+		self.bytes_served = 0
+
+	# (first byte, last byte) of a Range header, (None, None) without one
+	def range(self, header):
+		if not header:
+			return None, None
+
+		mobj = re.match('^bytes=([0-9]+)-([0-9]*)$', header.strip())
+		if not mobj:
+			raise ValueError(header)
+
+		first = int(mobj.group(1))
+		last = None
+		if mobj.group(2) != '':
+			last = int(mobj.group(2))
+
+		if last is not None and last < first:
+			raise ValueError(header)
+
+		return first, last
+
+	def store_path(self, path):
+		return os.path.join(self.store, *path.lstrip('/').split('/'))
+
+	def served(self, size):
+		with self.lock:
+			self.bytes_served += size
+
+	# Run fetch once for concurrent callers with the same key, callers that
+	# join a fetch in flight get its result (or exception)
+	def __single_flight(self, key, fetch):
+		with self.lock:
+			future = self.inflight.get(key)
+			owner = future is None
+			if owner:
+				future = concurrent.futures.Future()
+				self.inflight[key] = future
+			else:
+				self.shared += 1
+
+		if not owner:
+			return future.result()
+
+		try:
+			result = fetch()
+			future.set_result(result)
+			return result
+		except BaseException as e:
+			future.set_exception(e)
+			raise
+		finally:
+			with self.lock:
+				del self.inflight[key]
+
+	def __commit(self, path, url, headers = None, checksum = None):
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+
+		partial = '%s.%u.%u%s' % (path, os.getpid(), threading.get_ident(), _PARTIAL_SUFFIX)
+		try:
+			with open(partial, 'w+b') as f:
+				self.downloader.fetch_to(url, f, headers)
+				if checksum and not checksum(f):
+					raise IOError('Checksum mismatch for %s' % url)
+
+			os.replace(partial, path)
+		finally:
+			if os.path.exists(partial):
+				os.unlink(partial)
+
+		return path
+
+	def __fetch_file(self, url):
+		path = self.store_path(url)
+		if os.path.exists(path):
+			return path
+
+		with self.lock:
+			self.misses += 1
+
+		# Configuration files are named by the md5sum of their contents
+		checksum = '/config/' in url and md5_checksum(os.path.basename(url)) or None
+		return self.__commit(path, url, None, checksum)
+
+	def __stored_range(self, url, first, last):
+		range_dir = self.store_path(url) + CDNProxy.RANGE_SUFFIX
+		if not os.path.isdir(range_dir):
+			return None
+
+		for name in os.listdir(range_dir):
+			mobj = re.match('^([0-9]+)-([0-9]+)$', name)
+			if mobj and int(mobj.group(1)) <= first and int(mobj.group(2)) >= last:
+				return os.path.join(range_dir, name), int(mobj.group(1))
+
+		return None
+
+	def __fetch_range(self, url, first, last):
+		stored = self.__stored_range(url, first, last)
+		if stored:
+			return stored
+
+		with self.lock:
+			self.misses += 1
+
+		path = os.path.join(self.store_path(url) + CDNProxy.RANGE_SUFFIX, '%d-%d' % (first, last))
+		return self.__commit(path, url, { 'Range': 'bytes=%d-%d' % (first, last) }), first
+
+	# Returns (stored file, offset, size, file size) to serve a request from.
+	# The file size is None for stored ranges.
+	def open(self, url, first, last):
+		path = self.store_path(url)
+		if os.path.exists(path):
+			with self.lock:
+				self.hits += 1
+		# Closed ranges of files not in the store are fetched on their own
+		elif first is not None and last is not None:
+			stored = self.__stored_range(url, first, last)
+			if stored:
+				with self.lock:
+					self.hits += 1
+			else:
+				stored = self.__single_flight((url, first, last), lambda: self.__fetch_range(url, first, last))
+
+			return stored[0], first - stored[1], last - first + 1, None
 		else:
-			handle = self.cached_open(key_file_path, self.cdn_url('data', codecs.encode(key, 'hex').decode('utf-8')))
+			self.__single_flight(url, lambda: self.__fetch_file(url))
+
+		size = os.path.getsize(path)
+		if first is None:
+			return path, 0, size, size
+
+		if first >= size:
+			raise ValueError(first)
+
+		if last is None or last >= size:
+			last = size - 1
+
+		return path, first, last - first + 1, size
+
+	def report(self):
+		print('%u hits, %u misses, %u requests shared an upstream fetch, served %.1fMB' % (
+			self.hits, self.misses, self.shared, self.bytes_served / 1048576.0))
+		self.downloader.report()
 
-		return handle.read()
+	def serve(self, host, port):
+		server = http.server.ThreadingHTTPServer((host, port), CDNProxyHandler)
+		server.daemon_threads = True
+		server.proxy = self
+
+		print('Serving CDN files from %s on %s:%u, upstream %s' % (self.store, host, port, ', '.join(self.downloader.hosts)))
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+
+		server.server_close()
+		self.report()
 
 class CASCDataIndexFile(object):
+	# Index entry is a 9 byte key, followed by a big endian 40 bit data file
+	# location, and a little endian 32 bit file size
+	_ENTRY = struct.Struct('>9sBI4x')
+	_ENTRY_SIZE = struct.Struct('<14xI')
+
 	def __init__(self, options, index, version, file):
 		self.index = index
 		self.version = version
 		self.file = file
 		self.options = options
 
+		self.entries = {}
+		self.duplicates = 0
+
 	def open(self):
 		if not os.access(self.file, os.R_OK):
 			self.options.parser.error('Unable to read index file %s' % self.file)
 			return False
 
-		fsize = os.stat(self.file).st_size
 		with open(self.file, 'rb') as f:
-			hdr2_len = struct.unpack('I', f.read(4))[0]
-			hdr2_sum = f.read(4) # Unused for now
+			data = f.read()
+
+		hdr2_len = struct.unpack_from('I', data, 0)[0]
+		hdr2_sum = data[4:8] # Unused for now
 
-			padding = (8 + hdr2_len + 0x0F) & 0xFFFFFFF0
-			# Seek up to start of hdr2
-			f.seek(padding, os.SEEK_SET)
+		padding = (8 + hdr2_len + 0x0F) & 0xFFFFFFF0
+		# Start of hdr2
+		data_len, data_sum = struct.unpack_from('II', data, padding)
 
-			data_len, data_sum = struct.unpack('II', f.read(8))
-			for entry_idx in range(0, data_len // 18):
-				key = f.read(9)
-				high_byte = struct.unpack('B', f.read(1))[0]
-				low_bits = struct.unpack('>I', f.read(4))[0]
-				file_size = struct.unpack('I', f.read(4))[0]
+		n_entries = data_len // 18
+		block = data[padding + 8:padding + 8 + n_entries * 18]
 
-				data_file_number = (high_byte << 2) | ((low_bits & 0xC0000000) >> 30)
-				data_file_offset = (low_bits & 0x3FFFFFFF)
+		values = []
+		for (key, high_byte, low_bits), (file_size,) in zip(
+				CASCDataIndexFile._ENTRY.iter_unpack(block), CASCDataIndexFile._ENTRY_SIZE.iter_unpack(block)):
+			data_file_number = (high_byte << 2) | ((low_bits & 0xC0000000) >> 30)
+			data_file_offset = (low_bits & 0x3FFFFFFF)
 
-				self.index.AddIndex(key, int(data_file_number), int(data_file_offset), file_size, self.file)
+			values.append((key, (data_file_number, data_file_offset, file_size)))
 
-				#print(key.encode('hex'), data_file_number, data_file_offset, high_byte, low_bits, file_size)
+		# First occurrence of a key wins, so build the map in reverse order
+		self.entries = dict(reversed(values))
+		self.duplicates = n_entries - len(self.entries)
 
 		return True
 
@@ -607,12 +3218,16 @@ class CASCDataIndex(object):
 		self.idx_files = {}
 		self.idx_data = {}
 
-	def AddIndex(self, key, data_file, data_offset, file_size, indexname):
-		if key not in self.idx_data:
-			self.idx_data[key] = (data_file, data_offset, file_size)
-		else:
-			sys.stderr.write('Duplicate key %s in index %s old=%s, new=%s\n' % (
-				codecs.encode(key, 'hex').decode('utf-8'), indexname, self.idx_data[key], (data_file, data_offset, file_size)))
+	# Merge a parsed index bucket, keys already present are kept. Returns the
+	# number of duplicate keys.
+	def AddIndexFile(self, index_file):
+		duplicates = self.idx_data.keys() & index_file.entries.keys()
+		for key in duplicates:
+			del index_file.entries[key]
+
+		self.idx_data.update(index_file.entries)
+
+		return index_file.duplicates + len(duplicates)
 
 	def GetIndexData(self, key):
 		return self.idx_data.get(key[:9], (-1, 0, 0))
@@ -646,68 +3261,231 @@ class CASCDataIndex(object):
 			if self.idx_files[file_number][0] < file_version:
 				self.idx_files[file_number] = (file_version, idx_file)
 
-		for file_number, file_data in self.idx_files.items():
-			self.idx_data[file_number] = CASCDataIndexFile(self.options, self, *file_data)
-			if not self.idx_data[file_number].open():
+		# Buckets are merged in bucket order
+		duplicates = 0
+		for file_number in sorted(self.idx_files.keys()):
+			index_file = CASCDataIndexFile(self.options, self, *self.idx_files[file_number])
+			if not index_file.open():
 				return False
 
+			duplicates += self.AddIndexFile(index_file)
+			index_file.entries = {}
+
+		if duplicates > 0:
+			sys.stderr.write('%u duplicate keys in local index files, using the first occurrence\n' % duplicates)
+
 		return True
 
 class CASCEncodingFile(CASCObject):
+	_PAGE_SIZE = 4096
+
 	def __init__(self, options, build):
 		CASCObject.__init__(self, options)
 		self.build = build
 		self.first_entries = []
 		self.md5_map = { }
-
+		if getattr(options, 'compact_index', False):
+			self.md5_map = CASCCompactIndex('16s', 'I16s', multi = True)
+
+		# Lazy mode, pages of the memory mapped encoding file are decoded on
+		# demand and kept in a small LRU cache
+		self.lazy = getattr(options, 'lazy_encoding', False)
+		self.data = None
+		self.page_offset = 0
+		self.page_cache = collections.OrderedDict()
+		self.page_cache_size = 64
+
+	# Keyed by md5sum, so builds sharing a cache (--targets, watch mode) do not
+	# overwrite each other's encoding file
 	def encoding_path(self):
-		return os.path.join(self.cache_dir(), 'encoding')
+		return os.path.join(self.cache_dir(), 'encoding.%s' % self.build.encoding_file())
+
+	# Verified encoding files are stamped with their md5sum, size and mtime.
+	# A file that still matches its stamp is not hashed again on later runs.
+	def stamp_path(self):
+		return self.encoding_path() + '.verified'
+
+	def __stamp(self):
+		info = os.stat(self.encoding_path())
+		return { 'md5': self.build.encoding_file(), 'size': info.st_size, 'mtime': info.st_mtime_ns }
+
+	def __stamped(self):
+		try:
+			with open(self.stamp_path(), 'r') as f:
+				return json.load(f) == self.__stamp()
+		except (OSError, ValueError):
+			return False
+
+	def __write_stamp(self):
+		self.cache_write(self.stamp_path(), json.dumps(self.__stamp()).encode('utf-8'))
 
 	def __bootstrap(self):
 		if not os.access(self.cache_dir(), os.W_OK):
 			self.options.parser.error('Error bootstrapping CASCEncodingFile, "%s" is not writable' % self.cache_dir())
 
-		handle = self.get_url(self.build.encoding_blte_url())
+		# The BLTE encoded file is streamed into the cache, and decoded from
+		# there into the encoding file one chunk at a time
+		url = self.build.encoding_blte_url()
+		key = url.split('/')[-1]
+		blte_path = os.path.join(self.cache_dir('data'), key)
+		if not os.path.exists(blte_path):
+			downloader = isinstance(self.build, CASCObject) and self.build or self
+			downloader.download(blte_path, url, checksum = blte_checksum(codecs.decode(key, 'hex')))
+
+		def decode(f):
+			with open(blte_path, 'rb') as blte_file:
+				data = mmap.mmap(blte_file.fileno(), 0, access = mmap.ACCESS_READ)
+
+			blte = BLTEFile(data, sink = f, pool = blte_pool(self.options), workers = blte_workers(self.options))
+			if not blte.extract():
+				self.options.parser.error('Unable to uncompress BLTE data for encoding file')
+
+			data.close()
+
+			md5s = blte.hexdigest()
+			if md5s != self.build.encoding_file():
+				self.options.parser.error('Invalid md5sum in encoding file, expected %s got %s' % (self.build.encoding_file(), md5s))
 
-		blte = BLTEFile(handle.read())
-		if not blte.extract():
-			self.options.parser.error('Unable to uncompress BLTE data for encoding file')
+		self.cache_commit(self.encoding_path(), decode)
+		self.__write_stamp()
 
-		md5s = hashlib.md5(blte.output_data).hexdigest()
-		if md5s != self.build.encoding_file():
-			self.options.parser.error('Invalid md5sum in encoding file, expected %s got %s' % (self.build.encoding_file(), md5s))
+		return self.__map()
 
-		with open(self.encoding_path(), 'wb') as f:
-			f.write(blte.output_data)
+	def __map(self):
+		with open(self.encoding_path(), 'rb') as encoding_file:
+			return mmap.mmap(encoding_file.fileno(), 0, access = mmap.ACCESS_READ)
+
+	def __page(self, hash_block):
+		page = self.page_cache.get(hash_block, None)
+		if page is not None:
+			self.page_cache.move_to_end(hash_block)
+			return page
+
+		page = { }
+		if not self.__parse_page(self.data, hash_block, page):
+			return { }
+
+		self.page_cache[hash_block] = page
+		if len(self.page_cache) > self.page_cache_size:
+			self.page_cache.popitem(last = False)
+
+		return page
+
+	def __lookup(self, md5s):
+		if not self.lazy:
+			entry = self.md5_map.get(md5s, None)
+			# Compact index holds a (file_size, key) record per key
+			if entry and isinstance(self.md5_map, CASCCompactIndex):
+				return (entry[0][0], [ key for file_size, key in entry ])
+
+			return entry
+
+		# First md5s of the pages are sorted, find the only page that can hold md5s
+		hash_block = bisect.bisect_right(self.first_entries, md5s) - 1
+		if hash_block < 0:
+			return None
 
-		return blte.output_data
+		return self.__page(hash_block).get(md5s, None)
 
 	def HasMD5(self, md5s):
-		return self.md5_map.has_key(md5s)
+		return self.__lookup(md5s) is not None
 
 	def GetFileKeys(self, md5s):
-		return self.md5_map.get(md5s, (0, []))[1]
+		entry = self.__lookup(md5s)
+		if not entry:
+			return []
+
+		return entry[1]
+
+	def __parse_page(self, data, hash_block, md5_map):
+		offset = before = self.page_offset + hash_block * CASCEncodingFile._PAGE_SIZE
+		entry_id = 0
+		#print('Block %u begins at %u' % (hash_block, f.tell()))
+		n_keys = struct.unpack('H', data[offset:offset + 2])[0]; offset += 2
+		while n_keys != 0:
+			keys = []
+			file_size = struct.unpack('>I', data[offset:offset + 4])[0]; offset += 4
+
+			file_md5 = data[offset:offset + 16]; offset += 16
+			for key_idx in range(0, n_keys):
+				keys.append(data[offset:offset + 16]); offset += 16
+
+			if entry_id == 0 and file_md5 != self.first_entries[hash_block]:
+				self.options.parser.error('Invalid first md5 in block %d@%u, expected %s got %s' % (
+					hash_block, offset,
+					codecs.encode(self.first_entries[hash_block], 'hex').decode('utf-8'),
+					codecs.encode(file_md5, 'hex').decode('utf-8')))
+				return False
+
+			#print('%5u %8u %8u %2u %s %s' % (entry_id, f.tell(), file_size, n_keys, file_md5.encode('hex'), file_key.encode('hex')))
+			if file_size > 1000000000:
+				self.options.parser.error('Invalid (too large) file size %u in block %u, entry id %u, pos %u' % (file_size, hash_block, entry_id, offset))
+				return False
+
+			# Entries are sorted, so a duplicate in the compact index follows the original
+			if isinstance(md5_map, CASCCompactIndex):
+				duplicate = md5_map.n_entries > 0 and md5_map.keys[-16:] == file_md5
+			else:
+				duplicate = file_md5 in md5_map
+
+			if duplicate:
+				self.options.parser.error('Duplicate md5 entry %s in block %d@%u' % (
+					codecs.encode(file_md5, 'hex').decode('utf-8'), hash_block, offset))
+				return False
+
+			if isinstance(md5_map, CASCCompactIndex):
+				for key in keys:
+					md5_map.add(file_md5, file_size, key)
+			else:
+				md5_map[file_md5] = (file_size, keys)
+
+			entry_id += 1
+			n_keys = struct.unpack('H', data[offset:offset + 2])[0]; offset += 2
+
+		# Blocks are padded to 4096 bytes it seems, sanity check that the padding is all zeros, though
+		padding = data[offset:before + CASCEncodingFile._PAGE_SIZE]
+		if padding.count(0) != len(padding):
+			pad_idx = len(padding) - len(padding.lstrip(b'\x00'))
+			self.options.parser.error('Invalid padding byte %u at the end of block %u, pos %u, expected 0, got %#x' % (
+				pad_idx, hash_block, offset + pad_idx, padding[pad_idx]))
+			return False
+
+		return True
 
 	def open(self):
 		data = ''
 
+		self.cache_pin(self.encoding_path())
+		snapshot = getattr(self.build, 'snapshot', None)
+		if snapshot and not self.lazy:
+			md5_map = snapshot.load('encoding')
+			if md5_map:
+				self.md5_map = md5_map
+				print('Using encoding file snapshot %s, %u entries' % (self.build.encoding_file(), len(self.md5_map)))
+				return True
+
 		if not os.access(self.encoding_path(), os.R_OK):
 			data = self.__bootstrap()
 		else:
-			with open(self.encoding_path(), 'rb') as encoding_file:
-				data = encoding_file.read()
+			data = self.__map()
 
-			md5str = hashlib.md5(data).hexdigest()
-			if md5str != self.build.encoding_file():
-				data = self.__bootstrap()
+			if not self.__stamped():
+				md5str = hashlib.md5(data).hexdigest()
+				if md5str != self.build.encoding_file():
+					data.close()
+					data = self.__bootstrap()
+				else:
+					self.__write_stamp()
+
+		if self.lazy and not isinstance(data, mmap.mmap):
+			data = self.__map()
 
 		sys.stdout.write('Parsing encoding file %s ... ' % self.build.encoding_file())
 
 		offset = 0
-		fsize = os.stat(self.encoding_path()).st_size
 		magic = data[offset:offset + 2]; offset += 2
 		if magic != b'EN':
-			self.options.parser.error('Unknown magic "%s" in encoding file %s' % (locale, self.encoding_path()))
+			self.options.parser.error('Unknown magic "%s" in encoding file %s' % (magic, self.encoding_path()))
 			return False
 
 		unk_b1, unk_b2, unk_b3, unk_s1, unk_s2, hash_table_size, unk_hash_count, unk_b4, hash_table_offset = struct.unpack('>BBBHHIIBI', data[offset:offset + 20])
@@ -721,49 +3499,26 @@ class CASCEncodingFile(CASCObject):
 			offset += 16
 			self.first_entries.append(md5_file)
 
-		for hash_block in range(0, hash_table_size):
-			before = offset
-			entry_id = 0
-			#print('Block %u begins at %u' % (hash_block, f.tell()))
-			n_keys = struct.unpack('H', data[offset:offset + 2])[0]; offset += 2
-			while n_keys != 0:
-				keys = []
-				file_size = struct.unpack('>I', data[offset:offset + 4])[0]; offset += 4
-
-				file_md5 = data[offset:offset + 16]; offset += 16
-				for key_idx in range(0, n_keys):
-					keys.append(data[offset:offset + 16]); offset += 16
-
-				if entry_id == 0 and file_md5 != self.first_entries[hash_block]:
-					self.options.parser.error('Invalid first md5 in block %d@%u, expected %s got %s' % (
-						hash_block, offset,
-						codecs.encode(self.first_entries[hash_block], 'hex').decode('utf-8'),
-						codecs.encode(file_md5, 'hex').decode('utf-8')))
-					return False
-
-				#print('%5u %8u %8u %2u %s %s' % (entry_id, f.tell(), file_size, n_keys, file_md5.encode('hex'), file_key.encode('hex')))
-				if file_size > 1000000000:
-					self.options.parser.error('Invalid (too large) file size %u in block %u, entry id %u, pos %u' % (file_size, hash_block, entry_id, offset))
-					return False
+		self.page_offset = offset
 
-				if file_md5 in self.md5_map:
-					self.options.parser.error('Duplicate md5 entry %s in block %d@%u' % (
-						codecs.encode(file_md5, 'hex').decode('utf-8'), hash_block, offset))
-					return False
+		if self.lazy:
+			self.data = data
+			sys.stdout.write('%u pages\n' % hash_table_size)
+			return True
 
-				self.md5_map[file_md5] = (file_size, keys)
+		for hash_block in range(0, hash_table_size):
+			if not self.__parse_page(data, hash_block, self.md5_map):
+				return False
 
-				entry_id += 1
-				n_keys = struct.unpack('H', data[offset:offset + 2])[0]; offset += 2
+		if isinstance(data, mmap.mmap):
+			data.close()
 
-			# Blocks are padded to 4096 bytes it seems, sanity check that the padding is all zeros, though
-			for pad_idx in range(0, 4096 - (offset - before)):
-				byte = data[offset:offset + 1]; offset += 1
-				if byte != b'\x00':
-					self.options.parser.error('Invalid padding byte %u at the end of block %u, pos %u, expected 0, got %#x' % (pad_idx, hash_block, offset, ord(byte)))
-					return False
+		if isinstance(self.md5_map, CASCCompactIndex):
+			self.md5_map.finalize()
+			if snapshot:
+				snapshot.save('encoding', self.md5_map)
 
-		sys.stdout.write('%u entries\n' % len(self.md5_map.keys()))
+		sys.stdout.write('%u entries\n' % len(self.md5_map))
 
 		# Rest of the encoding file is unnecessary for now
 
@@ -817,21 +3572,24 @@ class CASCRootFile(CASCObject):
 
 	LOCALE_ALL = 0xFFFFFFFF
 
-	def __init__(self, options, build, encoding, index):
+	def __init__(self, options, build, encoding, index, locale = None):
 		CASCObject.__init__(self, options)
 
 		self.build = build
 		self.index = index
 		self.encoding = encoding
 		self.hash_map = {}
+		if getattr(options, 'compact_index', False):
+			self.hash_map = CASCCompactIndex('Q', '16s', multi = True)
 
-		if options.locale not in CASCRootFile._locale:
+		self.locale_name = locale or options.locale
+		if self.locale_name not in CASCRootFile._locale:
 			self.options.parser.error('Invalid locale, valid values are %s' % (', '.join(CASCRootFile._locale.keys())))
 
-		self.locale = CASCRootFile._locale[self.options.locale]
+		self.locale = CASCRootFile._locale[self.locale_name]
 
 	def root_path(self):
-		return os.path.join(self.cache_dir(), 'root')
+		return os.path.join(self.cache_dir(), 'root.%s' % self.build.root_file())
 
 	def __bootstrap(self):
 		if not os.access(self.cache_dir(), os.W_OK):
@@ -860,43 +3618,133 @@ class CASCRootFile(CASCObject):
 			if len(keys) > 1:
 				print('Duplicate root key found for %s, using first one ...' % self.build.root_file())
 
-			handle = self.get_url(self.build.cdn_url('data', codecs.encode(keys[0], 'hex').decode('utf-8')))
+			with open(self.build.download_file(keys[0]), 'rb') as blte_file:
+				blte_data = mmap.mmap(blte_file.fileno(), 0, access = mmap.ACCESS_READ)
 
-			blte = BLTEFile(handle.read())
+			blte = BLTEFile(blte_data, pool = blte_pool(self.options), workers = blte_workers(self.options))
 			if not blte.extract():
 				self.options.parser.error('Unable to uncompress BLTE data for root file')
 
-			md5s = hashlib.md5(blte.output_data).hexdigest()
+			blte_data.close()
+
+			md5s = blte.hexdigest()
 			if md5s != self.build.root_file():
 				self.options.parser.error('Invalid md5sum in root file, expected %s got %s' % (self.build.root_file(), md5s))
 
 			data = blte.output_data
 
-		with open(self.root_path(), 'wb') as f:
-			f.write(data)
+		self.cache_write(self.root_path(), data)
 
 		return data
 
 	def GetFileMD5(self, file):
 		hash_name = file.strip().upper().replace('/', '\\')
-		hash = jenkins.hashlittle2(hash_name)
-		v = (hash[0] << 32) | hash[1]
-		return self.hash_map.get(v, [])
+		v = jenkins.hashlittle2_many([ hash_name ])[0]
+		return self.__md5s(v)
 
 	def GetFileHashMD5(self, file_hash):
-		return self.hash_map.get(file_hash, [])
+		return self.__md5s(file_hash)
+
+	# Compare the files of a (hash, name) listfile against an older root file,
+	# returns added, removed and changed lists of (hash, name) tuples
+	def Diff(self, other, fname_db):
+		added = []
+		removed = []
+		changed = []
+		for file_hash, file_name in fname_db.items():
+			md5s = set(self.GetFileHashMD5(file_hash))
+			other_md5s = set(other.GetFileHashMD5(file_hash))
+			if md5s == other_md5s:
+				continue
+
+			if len(other_md5s) == 0:
+				added.append((file_hash, file_name))
+			elif len(md5s) == 0:
+				removed.append((file_hash, file_name))
+			else:
+				changed.append((file_hash, file_name))
+
+		return added, removed, changed
+
+	# Root entries are a fixed stride array of (md5, name hash) pairs. Split
+	# them into name hash (big endian) and md5 columns with strided slices,
+	# instead of per entry.
+	def __columns(self, entries):
+		stride = _ROOT_ENTRY.size
+		n_entries = len(entries) // stride
+
+		md5s = bytearray(16 * n_entries)
+		for byte in range(0, 16):
+			md5s[byte::16] = entries[byte::stride]
+
+		hashes = bytearray(8 * n_entries)
+		for byte in range(0, 8):
+			hashes[7 - byte::8] = entries[16 + byte::stride]
+
+		return hashes, md5s
+
+	# Build the default (dict) name hash to md5s map from the columns. The
+	# map is built by C iterators, holding the last md5 of each name hash.
+	# Entries that did not end up in the map (earlier md5s of a name hash
+	# with several) are found with a NumPy sort, or by identity in a second
+	# C pass, and only those are collected in Python. Name hashes with
+	# several md5s map to a tuple of them.
+	def __build_map(self, hashes, md5s):
+		keys = array.array('Q', hashes)
+		if sys.byteorder == 'little':
+			keys.byteswap()
+		# Both passes, and the map, share the same key and md5 objects
+		keys = keys.tolist()
+		md5s = list(map(operator.itemgetter(0), _ROOT_MD5.iter_unpack(md5s)))
+
+		self.hash_map = dict(zip(keys, md5s))
+		if len(self.hash_map) == len(md5s):
+			return
+
+		if numpy is not None:
+			hashes = numpy.frombuffer(hashes, dtype = '>u8')
+			order = numpy.argsort(hashes, kind = 'stable')
+			# Rows followed, in key order, by a row of the same key
+			rows = numpy.sort(order[:-1][hashes[order[1:]] == hashes[order[:-1]]]).tolist()
+			entries = zip(map(keys.__getitem__, rows), map(md5s.__getitem__, rows))
+		else:
+			entries = itertools.compress(zip(keys, md5s), map(operator.is_not, map(self.hash_map.__getitem__, keys), md5s))
+
+		earlier = {}
+		for key, md5 in entries:
+			earlier.setdefault(key, []).append(md5)
+
+		for key, key_md5s in earlier.items():
+			self.hash_map[key] = tuple(key_md5s) + (self.hash_map[key],)
+
+	# md5s of a name hash, a single md5 is held in the map as is
+	def __md5s(self, file_hash):
+		md5s = self.hash_map.get(file_hash, [])
+		if isinstance(md5s, bytes):
+			return [ md5s ]
+
+		return md5s
 
 	def GetLocale(self):
-		if self.options.locale not in CASCRootFile._locale:
+		if self.locale_name not in CASCRootFile._locale:
 			return 0
 
-		flags = CASCRootFile._locale[self.options.locale]
-		if self.options.locale in ['en_US', 'en_GB']:
+		flags = CASCRootFile._locale[self.locale_name]
+		if self.locale_name in ['en_US', 'en_GB']:
 			flags = CASCRootFile._locale['en_US'] | CASCRootFile._locale['en_GB']
 
 		return flags
 
 	def open(self):
+		self.cache_pin(self.root_path())
+		snapshot = getattr(self.build, 'snapshot', None)
+		if snapshot:
+			hash_map = snapshot.load('root.%s' % self.locale_name)
+			if hash_map:
+				self.hash_map = hash_map
+				print('Using root file snapshot %s, %u entries' % (self.build.root_file(), len(self.hash_map)))
+				return True
+
 		if not os.access(self.root_path(), os.R_OK):
 			data = self.__bootstrap()
 		else:
@@ -909,35 +3757,121 @@ class CASCRootFile(CASCObject):
 
 		sys.stdout.write('Parsing root file %s ... ' % self.build.root_file())
 		offset = 0
-		n_md5s = 0
+		blocks = []
+		locale = self.GetLocale()
+		view = memoryview(data)
 		while offset < len(data):
-			n_entries, unk_1, flags = struct.unpack('<iII', data[offset:offset + 12])
+			n_entries, unk_1, flags = _ROOT_BLOCK_HEADER.unpack_from(data, offset)
 			#if flags == 0xFFFFFFFF or flags & 0x2:
 			#	print('%u %d, unk_1=%#.8x, flags=%#.8x' % (offset, n_entries, unk_1, flags))
-			offset += 12
+			offset += _ROOT_BLOCK_HEADER.size
 			if n_entries == 0:
 				continue
 
+			# Only grab enUS and "all" locales, other blocks are skipped whole
+			if flags != CASCRootFile.LOCALE_ALL and not (flags & locale):
+				offset += (4 + _ROOT_ENTRY.size) * n_entries
+				continue
+
 			offset += 4 * n_entries
 
-			for entry_idx in range(0, n_entries):
-				md5s = data[offset:offset + 16]
-				offset += 16
-				file_name_hash = data[offset:offset + 8]
-				offset += 8
-				val = struct.unpack('Q', file_name_hash)[0]
+			blocks.append(view[offset:offset + _ROOT_ENTRY.size * n_entries])
+			offset += _ROOT_ENTRY.size * n_entries
+
+		# Entries of all matching blocks are decoded in one go
+		entries = b''.join(blocks)
+		del blocks, view
+		n_md5s = len(entries) // _ROOT_ENTRY.size
+		hashes, md5s = self.__columns(entries)
+		del entries
+
+		if isinstance(self.hash_map, CASCCompactIndex):
+			self.hash_map.extend(hashes, md5s)
+			self.hash_map.finalize()
+			if snapshot:
+				snapshot.save('root.%s' % self.locale_name, self.hash_map)
+		else:
+			self.__build_map(hashes, md5s)
 
-				# Only grab enUS and "all" locales
-				if flags != CASCRootFile.LOCALE_ALL and not (flags & self.GetLocale()):
-					continue
+		sys.stdout.write('%u entries\n' % n_md5s)
+		return True
 
-				if not val in self.hash_map:
-					self.hash_map[val] = []
 
-				#print(unk_data[entry_idx], file_name_hash.encode('hex'), md5s.encode('hex'))
-				self.hash_map[val].append(md5s)
-				n_md5s += 1
+# Client data tables of a build, by name, for dbc_extract. Tables are decoded
+# into memory and handed to the DB2 parsers without being written out.
+class CASCFileSource(object):
+	PATHS = [ 'DBFilesClient\\%s', 'DBFilesClient\\%s.db2', 'DBFilesClient\\%s.dbc' ]
+
+	def __init__(self, options):
+		self.options = options
+
+		self.build = None
+		self.index = None
+		self.encoding = None
+		self.root = None
+		self.blte = BLTEExtract(options)
+
+	def open(self):
+		import build_cfg
+
+		if not self.options.online:
+			self.build = build_cfg.BuildCfg(self.options)
+			if not self.build.open():
+				return False
+
+			self.index = CASCDataIndex(self.options)
+			if not self.index.open():
+				return False
+		else:
+			self.build = CDNIndex(self.options)
+			if not self.build.open():
+				return False
+
+		self.encoding = CASCEncodingFile(self.options, self.build)
+		if not self.encoding.open():
+			return False
+
+		self.root = CASCRootFile(self.options, self.build, self.encoding, self.index)
+		if not self.root.open():
+			return False
 
-		sys.stdout.write('%u entries\n' % n_md5s)
 		return True
 
+	# Random access BLTEReader over a table, or None if the build has no such
+	# table
+	def open_file(self, name):
+		for path in CASCFileSource.PATHS:
+			for md5s in self.root.GetFileMD5(path % name):
+				for file_key in self.encoding.GetFileKeys(md5s):
+					if self.options.online:
+						return BLTEReader(self.build.fetch_file(file_key))
+
+					file_location = self.index.GetIndexData(file_key)
+					if file_location[0] > -1:
+						return self.blte.open_reader(file_key, *file_location)
+
+		return None
+
+	# The first length bytes of a table, or None if the build has no such
+	# table. Only the chunks covering them are decoded.
+	def header(self, name, length):
+		reader = self.open_file(name)
+		if not reader:
+			return None
+
+		with reader:
+			return reader.read(length)
+
+	# Decoded table data, or None if the build has no such table
+	def get(self, name):
+		for path in CASCFileSource.PATHS:
+			for md5s in self.root.GetFileMD5(path % name):
+				for file_key in self.encoding.GetFileKeys(md5s):
+					if self.options.online:
+						return self.blte.extract_buffer(self.build.fetch_file(file_key))
+
+					file_location = self.index.GetIndexData(file_key)
+					if file_location[0] > -1:
+						return self.blte.extract_data(file_key, md5s, *file_location)
+
+		return None
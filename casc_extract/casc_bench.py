@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# casc_extract benchmark runner. Times each phase of a local batch extraction
+# (listfile hashing, index, encoding and root parsing, BLTE decoding, and
+# output writing) over a synthetic installation generated by casc_synth, and
+# writes machine readable results that can be compared across commits.
+
+import optparse, os, sys, time, json, shutil, tempfile, copy, tracemalloc, platform, subprocess, contextlib, shlex
+
+import casc, casc_synth, build_cfg, casc_extract
+
+class CASCBench(object):
+	PHASES = [ 'hash', 'index', 'encoding', 'root', 'decode', 'write' ]
+
+	def __init__(self, options, extract_options):
+		self.options = options
+		self.extract_options = extract_options
+
+		self.build = None
+		self.fname_db = None
+		self.index = None
+		self.encoding = None
+		self.root = None
+		self.jobs = []
+
+		self.hash_options = None
+
+	# The listfile is hashed from a copy in a directory of its own, with the
+	# compiled table of earlier runs removed first. Otherwise the phase would
+	# only map the table compiled by the previous run.
+	def phase_hash(self):
+		self.fname_db = build_cfg.DBFileList(self.hash_options)
+		if os.path.exists(self.fname_db.table_path()):
+			os.unlink(self.fname_db.table_path())
+
+		self.fname_db.open()
+
+		return len(self.fname_db), 'names'
+
+	def phase_index(self):
+		self.index = casc.CASCDataIndex(self.extract_options)
+		self.index.open()
+
+		data_dir = os.path.join(self.extract_options.data_dir, 'Data', 'data')
+		return sum([ os.path.getsize(os.path.join(data_dir, name)) for name in os.listdir(data_dir) if name.endswith('.idx') ]), 'bytes'
+
+	def phase_encoding(self):
+		self.encoding = casc.CASCEncodingFile(self.extract_options, self.build)
+		self.encoding.open()
+
+		return os.path.getsize(self.encoding.encoding_path()), 'bytes'
+
+	def phase_root(self):
+		self.root = casc.CASCRootFile(self.extract_options, self.build, self.encoding, self.index)
+		self.root.open()
+
+		return os.path.getsize(self.root.root_path()), 'bytes'
+
+	def phase_decode(self):
+		blte = casc.BLTEExtract(self.extract_options)
+		size = 0
+		for file_name, extract_data in self.jobs:
+			data = blte.extract_data(*(extract_data[:2] + extract_data[3:]))
+			size += len(data)
+
+		return size, 'bytes'
+
+	def phase_write(self):
+		if os.path.exists(self.extract_options.output):
+			shutil.rmtree(self.extract_options.output)
+
+		casc.BLTEBatchExtract(self.extract_options, None).extract(self.jobs)
+
+		return sum([ os.path.getsize(os.path.join(self.extract_options.output, extract_data[2])) for file_name, extract_data in self.jobs ]), 'bytes'
+
+	# Same file selection as batch mode in casc_extract
+	def __jobs(self):
+		self.jobs = []
+		for file_hash, file_name in self.fname_db.items():
+			for md5s in self.root.GetFileHashMD5(file_hash):
+				for file_key in self.encoding.GetFileKeys(md5s):
+					file_location = self.index.GetIndexData(file_key)
+					if file_location[0] > -1:
+						self.jobs.append((file_name, (file_key, md5s, file_name.replace('\\', '/')) + file_location))
+						break
+
+	def __run(self, phase, memory):
+		if memory:
+			tracemalloc.start()
+
+		start = time.perf_counter()
+		with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+			units, unit = getattr(self, 'phase_%s' % phase)()
+		elapsed = time.perf_counter() - start
+
+		peak = None
+		if memory:
+			peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+
+		return elapsed, units, unit, peak
+
+	def run(self):
+		hash_dir = tempfile.mkdtemp(prefix = 'casc_bench_hash')
+		try:
+			self.hash_options = copy.copy(self.extract_options)
+			self.hash_options.dbfile = os.path.join(hash_dir, os.path.basename(self.extract_options.dbfile))
+			shutil.copyfile(self.extract_options.dbfile, self.hash_options.dbfile)
+
+			return self.__run_phases()
+		finally:
+			shutil.rmtree(hash_dir)
+
+	def __run_phases(self):
+		self.build = build_cfg.BuildCfg(self.extract_options)
+		with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+			self.build.open()
+
+			# Decode the encoding and root files into the cache, phases time
+			# parsing the cached files
+			self.phase_index()
+			self.phase_encoding()
+			self.phase_root()
+			self.phase_hash()
+
+		results = {}
+		for phase in CASCBench.PHASES:
+			if phase == 'decode':
+				self.__jobs()
+
+			runs = []
+			for run in range(0, self.options.repeat):
+				elapsed, units, unit, peak = self.__run(phase, False)
+				runs.append(elapsed)
+
+			peak = None
+			if self.options.memory:
+				peak = self.__run(phase, True)[3]
+
+			results[phase] = {
+				'seconds': min(runs),
+				'runs': runs,
+				'units': units,
+				'unit': unit,
+				'peak_memory': peak,
+			}
+
+		return results
+
+def git_commit():
+	try:
+		return subprocess.check_output([ 'git', 'rev-parse', 'HEAD' ],
+			cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode('utf-8').strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def print_results(results, base = None):
+	print('%-10s %10s %10s %14s %12s%s' % ('phase', 'best (s)', 'mean (s)', 'throughput', 'peak (MB)', base and '%12s %8s' % ('base (s)', 'change') or ''))
+	for phase in CASCBench.PHASES:
+		result = results['phases'][phase]
+		per_second = result['units'] / max(result['seconds'], 1e-9)
+		if result['unit'] == 'bytes':
+			throughput = '%.1f MB/s' % (per_second / 1048576.0)
+		else:
+			throughput = '%.0f %s/s' % (per_second, result['unit'])
+
+		peak = result['peak_memory'] is not None and '%.1f' % (result['peak_memory'] / 1048576.0) or '-'
+		line = '%-10s %10.4f %10.4f %14s %12s' % (phase, result['seconds'], sum(result['runs']) / len(result['runs']), throughput, peak)
+		if base and phase in base['phases']:
+			base_seconds = base['phases'][phase]['seconds']
+			line += '%12.4f %+7.1f%%' % (base_seconds, 100.0 * (result['seconds'] - base_seconds) / max(base_seconds, 1e-9))
+
+		print(line)
+
+	if results['max_rss'] is not None:
+		print('Peak RSS: %.1f MB' % (results['max_rss'] / 1048576.0))
+
+parser = optparse.OptionParser( usage = '%prog [options]', conflict_handler = 'resolve' )
+parser.add_option( '-d', '--datadir', type = 'string', dest = 'synth_dir', default = None,
+		help = 'Existing synthetic installation to benchmark [default generate one into a temporary directory]' )
+parser.add_option( '-x', '--cache', type = 'string', dest = 'cache', default = None,
+		help = 'Cache directory of the existing synthetic installation' )
+parser.add_option( '-n', '--files', type = 'int', dest = 'files', default = 2000,
+		help = 'Number of listed files to generate [default 2000]' )
+parser.add_option( '--unlisted', type = 'int', dest = 'unlisted', default = 20000,
+		help = 'Number of files only in the root file to generate [default 20000]' )
+parser.add_option( '--file-size', type = 'int', dest = 'file_size', default = 32768,
+		help = 'Mean generated file size in bytes [default 32768]' )
+parser.add_option( '--chunk-size', type = 'int', dest = 'chunk_size', default = 65536,
+		help = 'BLTE chunk size in bytes [default 65536]' )
+parser.add_option( '--ratio', type = 'float', dest = 'ratio', default = 0.5,
+		help = 'Approximate compression ratio of the generated files [default 0.5]' )
+parser.add_option( '--data-file-size', type = 'int', dest = 'data_file_size', default = 256,
+		help = 'Maximum data.NNN archive size in megabytes [default 256]' )
+parser.add_option( '--seed', type = 'int', dest = 'seed', default = 1,
+		help = 'Random seed [default 1]' )
+parser.add_option( '-r', '--repeat', type = 'int', dest = 'repeat', default = 3,
+		help = 'Timed runs per phase, the best run is reported [default 3]' )
+parser.add_option( '--memory', action = 'store_true', dest = 'memory', default = False,
+		help = 'Measure peak Python memory use of each phase in an extra, traced run [default no]' )
+parser.add_option( '--casc-options', type = 'string', dest = 'casc_options', default = '',
+		help = 'casc_extract options to benchmark with, e.g., "--compact-index -j 4"' )
+parser.add_option( '--json', type = 'string', dest = 'json', default = None,
+		help = 'Write results into a JSON file' )
+parser.add_option( '--compare', type = 'string', dest = 'compare', default = None,
+		help = 'Compare results against an earlier JSON results file' )
+
+if __name__ == '__main__':
+	(opts, args) = parser.parse_args()
+	opts.parser = parser
+
+	work_dir = tempfile.mkdtemp(prefix = 'casc_bench')
+	try:
+		synth = None
+		if not opts.synth_dir:
+			opts.synth_dir = os.path.join(work_dir, 'synth')
+			opts.cache = os.path.join(work_dir, 'cache')
+			print('Generating synthetic installation into %s ...' % opts.synth_dir)
+			synth = casc_synth.CASCSynth(opts).generate()
+		elif not opts.cache:
+			parser.error('An existing synthetic installation requires its cache directory')
+
+		extract_args = shlex.split(opts.casc_options) + [ '-m', 'batch',
+			'-d', opts.synth_dir, '-x', opts.cache, '-b', os.path.join(opts.synth_dir, 'listfile'),
+			'-o', os.path.join(work_dir, 'output') ]
+		(extract_opts, extract_args) = casc_extract.parser.parse_args(extract_args)
+		extract_opts.parser = casc_extract.parser
+
+		results = {
+			'commit': git_commit(),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'casc_options': opts.casc_options,
+			'synth': synth,
+			'phases': CASCBench(opts, extract_opts).run(),
+			'max_rss': casc.max_rss(),
+		}
+	finally:
+		shutil.rmtree(work_dir)
+
+	base = None
+	if opts.compare:
+		with open(opts.compare, 'r') as f:
+			base = json.load(f)
+
+	print_results(results, base)
+
+	if opts.json:
+		with open(opts.json, 'w') as f:
+			json.dump(results, f, indent = 2, sort_keys = True)
@@ -1,14 +1,14 @@
 #!/usr/bin/env python3
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
-import optparse, sys, os
+import optparse, sys, os, re, collections
 
 import build_cfg, casc
 import binascii
 
 parser = optparse.OptionParser( usage = 'Usage: %prog -d wow_install_dir [options] file_path ...')
-parser.add_option( '--cdn', dest = 'online', action = 'store_true', help = 'Fetch data from Blizzard CDN [only used for mode=batch/extract]' )
-parser.add_option( '-m', '--mode', dest = 'mode', choices = [ 'batch', 'unpack', 'extract', 'fieldlist' ],
-		help = 'Extraction mode: "batch" for file extraction, "unpack" for BLTE file unpack, "extract" for key or MD5 based file extract from local game client files' )
+parser.add_option( '--cdn', dest = 'online', action = 'store_true', help = 'Fetch data from Blizzard CDN [only used for mode=batch/extract/diff]' )
+parser.add_option( '-m', '--mode', dest = 'mode', choices = [ 'batch', 'unpack', 'extract', 'fieldlist', 'diff', 'watch', 'proxy' ],
+		help = 'Extraction mode: "batch" for file extraction, "unpack" for BLTE file unpack, "extract" for key, MD5, or name hash based file extract from local game client files, "diff" for listing files changed between two CDN builds (and extracting them with --output), "watch" for prefetching new CDN builds into the cache as they appear, "proxy" for serving CDN files to other casc_extract runs from a shared store' )
 parser.add_option( '-b', '--dbfile', dest = 'dbfile', type = 'string', default = 'dbfile',
 		help = "A textual file containing a list of file paths to extract [default dbfile, only needed for mode=batch]" )
 parser.add_option( '-r', '--root', dest = 'root_file', type = 'string', default = 'root',
@@ -23,11 +23,153 @@ parser.add_option( '-x', '--cache', type = 'string', dest = 'cache', default = '
 parser.add_option( '--ptr', action = 'store_true', dest = 'ptr', default = False, help = 'Download PTR files [default no, only used for --cdn]' )
 parser.add_option( '--beta', action = 'store_true', dest = 'beta', default = False, help = 'Download Beta files [default no, only used for --cdn]' )
 parser.add_option( '--locale', action = 'store', dest = 'locale', default = 'en_US', help = 'Extraction locale [default en_US, only used for --cdn]' )
+parser.add_option( '--targets', action = 'store', dest = 'targets', default = None,
+		help = 'Comma separated list of product[:locale] targets (e.g., wow,wowt,wow_beta:de_DE) to extract in a single run, instead of --ptr/--beta/--locale. Files go to OUTPUT/build[/product][/locale], with a product directory when more than one product is given [only used for mode=batch with --cdn, and mode=watch, which defaults to wow,wowt,wow_beta]' )
+parser.add_option( '--lazy-encoding', action = 'store_true', dest = 'lazy_encoding', default = None,
+		help = 'Decode encoding file pages on demand instead of parsing the whole file [default yes for mode=extract, no otherwise]' )
+parser.add_option( '--no-lazy-encoding', action = 'store_false', dest = 'lazy_encoding',
+		help = 'Parse the whole encoding file, also for mode=extract' )
+parser.add_option( '--compact-index', action = 'store_true', dest = 'compact_index', default = False,
+		help = 'Keep encoding, root and CDN index lookup tables in compact sorted arrays [default no]' )
+parser.add_option( '--cdn-connections', type = 'int', dest = 'cdn_connections', default = 8,
+		help = 'Maximum number of concurrent CDN requests [default 8]' )
+parser.add_option( '--cdn-retries', type = 'int', dest = 'cdn_retries', default = 3,
+		help = 'Number of times a failed CDN request is retried, failing over to other CDN hosts [default 3]' )
+parser.add_option( '--cdn-max-gap', type = 'int', dest = 'cdn_max_gap', default = 64,
+		help = 'Largest gap in kilobytes between files of an archive that are fetched with a single range request [default 64]' )
+parser.add_option( '--cdn-max-span', type = 'int', dest = 'cdn_max_span', default = 16,
+		help = 'Largest single range request in megabytes [default 16]' )
+parser.add_option( '--cdn-rate', type = 'int', dest = 'cdn_rate', default = 0,
+		help = 'Combined CDN download rate limit in kilobytes per second [default 0, unlimited]' )
+parser.add_option( '--patch-url', type = 'string', dest = 'patch_url', default = None,
+		help = 'Patch server base URL, e.g., a local stand-in server [default %s]' % casc.CDNIndex.PATCH_BASE_URL )
+parser.add_option( '--cdn-host', type = 'string', dest = 'cdn_host', default = None,
+		help = 'CDN host[:port] to fetch CDN files from instead of the hosts given by the patch server, e.g., a casc_extract proxy. Upstream host for mode=proxy' )
+parser.add_option( '--proxy-listen', type = 'string', dest = 'proxy_listen', default = '127.0.0.1:8080',
+		help = 'Address and port to serve CDN files on [default 127.0.0.1:8080, only used for mode=proxy]' )
+parser.add_option( '--proxy-store', type = 'string', dest = 'proxy_store', default = 'proxy',
+		help = 'Store directory for proxied CDN files [default proxy, only used for mode=proxy]' )
+parser.add_option( '--watch-interval', type = 'int', dest = 'watch_interval', default = 300,
+		help = 'Seconds between polls of the versions files [default 300, only used for mode=watch]' )
+parser.add_option( '--watch-polls', type = 'int', dest = 'watch_polls', default = 0,
+		help = 'Exit after this many polls [default 0, run until interrupted, only used for mode=watch]' )
+parser.add_option( '--dry-run', action = 'store_true', dest = 'dry_run', default = False,
+		help = 'Print the CDN requests needed to fetch the files, without fetching them [only used for mode=batch with --cdn]' )
+parser.add_option( '--stats', action = 'store_true', dest = 'stats', default = False,
+		help = 'Print time spent and bytes processed per extraction phase, and peak memory use at exit [default no]' )
+parser.add_option( '--stats-json', type = 'string', dest = 'stats_json', default = None,
+		help = 'Also write the --stats summary into a JSON file' )
+parser.add_option( '--cache-size', type = 'int', dest = 'cache_size', default = 0,
+		help = 'Cache directory size limit in megabytes, least recently used files are evicted past it [default 0, unlimited]' )
+parser.add_option( '--cache-stats', action = 'store_true', dest = 'cache_stats', default = False,
+		help = 'Print cache hit, miss and eviction statistics at exit [default no]' )
+parser.add_option( '--store', type = 'string', dest = 'store',
+		help = 'Content addressed store directory for extracted files, output files are linked to it [only used for mode=batch]' )
+parser.add_option( '--snapshot', action = 'store_true', dest = 'snapshot', default = False,
+		help = 'Use (and write) pre-parsed encoding, root and CDN index snapshots in CACHE_DIR/snapshot, implies --compact-index [default no]' )
+parser.add_option( '-j', '--jobs', type = 'int', dest = 'jobs', default = 1,
+		help = 'Number of worker processes for batch extraction from local files [default 1]' )
+parser.add_option( '--pipeline', action = 'store_true', dest = 'pipeline', default = False,
+		help = 'Extract with overlapping read, decompress and write stages, instead of --jobs worker processes. Chunks are decompressed by the --blte-workers pool, or by --jobs threads [default no, one thread per CPU, only used for mode=batch without --cdn]' )
+parser.add_option( '--pipeline-memory', type = 'int', dest = 'pipeline_memory', default = 64,
+		help = 'Megabytes of compressed and decoded BLTE chunks --pipeline keeps in flight at most [default 64]' )
+parser.add_option( '--data-pool-size', type = 'int', dest = 'data_pool_size', default = 16,
+		help = 'Maximum number of local data archives kept memory mapped [default 16]' )
+parser.add_option( '--data-advise', action = 'store_true', dest = 'data_advise', default = False,
+		help = 'Give the kernel prefetch hints for the data archive ranges about to be extracted [default no]' )
+parser.add_option( '--blte-workers', type = 'int', dest = 'blte_workers', default = 0,
+		help = 'Number of workers used to decompress BLTE chunks in parallel [default 0, decompress serially]' )
+parser.add_option( '--blte-pool', dest = 'blte_pool', choices = [ 'thread', 'process' ], default = 'thread',
+		help = 'Worker pool type for parallel BLTE decompression, "thread" or "process" [default thread]' )
+
+# (product, locale) targets from --targets
+def parse_targets(opts):
+	targets = []
+	for target in opts.targets.split(','):
+		product, separator, locale = target.strip().partition(':')
+		if (product, locale or opts.locale) not in targets:
+			targets.append((product, locale or opts.locale))
+
+	return targets
+
+# Files of a CDN build to extract into output_path, as (file name, md5,
+# key, output file) tuples
+def cdn_files(fname_db, encoding, root, output_path, store):
+	files = []
+	for file_hash, file_name in fname_db.items():
+		file_md5s = root.GetFileHashMD5(file_hash)
+		if not file_md5s:
+			continue
+
+		if len(file_md5s) > 1:
+			print('Duplicate files found (%d) for %s, selecting first one ...' % (len(file_md5s), file_name))
+
+		file_keys = encoding.GetFileKeys(file_md5s[0])
+
+		if len(file_keys) == 0:
+			continue
+
+		if len(file_keys) > 1:
+			print('More than one key found for %s, selecting first one ...' % file_name)
+
+		output_file = os.path.join(output_path, file_name.replace('\\', '/'))
+		# Unchanged content is linked from the store without fetching it
+		if store and store.link(file_md5s[0], output_file):
+			continue
+
+		files.append((file_name, file_md5s[0], file_keys[0], output_file))
+
+	return files
+
+# Fetch and extract (file name, md5, key, output file, CDNIndex) files of
+# one or more CDN builds
+def extract_cdn_files(opts, builds, files, blte, store):
+	# Keys are content addressed, so a key referenced by several builds is
+	# fetched once, through the first build that references it
+	build_keys = collections.OrderedDict([ (cdn, []) for cdn in builds ])
+	seen = set()
+	for file_name, md5s, file_key, output_file, file_cdn in files:
+		if file_key not in seen:
+			seen.add(file_key)
+			build_keys[file_cdn].append(file_key)
+
+	if opts.dry_run:
+		for cdn, keys in build_keys.items():
+			cdn.print_plan(cdn.plan_files(keys))
+		return True
+
+	# Download everything concurrently up front, extraction reads from the cache
+	for cdn, keys in build_keys.items():
+		cdn.prefetch_files(keys)
+
+	for file_name, md5s, file_key, output_file, file_cdn in files:
+		print('Extracting %s ...' % file_name)
+
+		data = file_cdn.fetch_file(file_key)
+		if not data:
+			print('No data for a given key %s' % binascii.hexlify(file_key).decode('utf-8'))
+			continue
+
+		if store:
+			if not store.extract(md5s, output_file, lambda sink: blte.extract_buffer_to(data, sink)):
+				return False
+		else:
+			blte.extract_buffer_to_file(data, output_file)
+
+	return True
 
 if __name__ == '__main__':
 	(opts, args) = parser.parse_args()
 	opts.parser = parser
 
+	# Snapshots store the compact lookup tables as is
+	if opts.snapshot:
+		opts.compact_index = True
+
+	stats = casc.stats_manager(opts)
+	if stats:
+		stats.instrument(build_cfg.DBFileList, 'open', 'listfile')
+
 	if not opts.mode and opts.online:
 		cdn = casc.CDNIndex(opts)
 		cdn.CheckVersion()
@@ -53,6 +195,7 @@ if __name__ == '__main__':
 			sys.exit(1)
 
 		blte = casc.BLTEExtract(opts)
+		store = opts.store and casc.CASCContentStore(opts) or None
 
 		if not opts.online:
 			build = build_cfg.BuildCfg(opts)
@@ -71,6 +214,7 @@ if __name__ == '__main__':
 			if not root.open():
 				sys.exit(1)
 
+			jobs = []
 			for file_hash, file_name in fname_db.items():
 				extract_data = None
 
@@ -89,13 +233,76 @@ if __name__ == '__main__':
 				if not extract_data:
 					continue
 
-				print('Extracting %s ...' % file_name)
+				# Unchanged content is linked from the store without extracting it
+				if store and store.link(extract_data[1], os.path.join(opts.output, extract_data[2])):
+					continue
 
-				if not blte.extract_file(*extract_data):
-					sys.exit(1)
+				jobs.append((file_name, extract_data))
+
+			if not casc.BLTEBatchExtract(opts, store).extract(jobs):
+				sys.exit(1)
 		else:
-			cdn = casc.CDNIndex(opts)
-			if not cdn.open():
+			targets = opts.targets and parse_targets(opts) or [ (None, opts.locale) ]
+			locales = collections.Counter([ product for product, locale in targets ])
+
+			# Builds are opened once per product, and share their CDN index
+			builds = collections.OrderedDict()
+			files = []
+			for product, locale in targets:
+				if product not in builds:
+					cdn = casc.CDNIndex(opts, product, len(builds) > 0 and list(builds.values())[0][0] or None)
+					if not cdn.open():
+						sys.exit(1)
+
+					encoding = casc.CASCEncodingFile(opts, cdn)
+					if not encoding.open():
+						sys.exit(1)
+
+					builds[product] = (cdn, encoding)
+
+				cdn, encoding = builds[product]
+				root = casc.CASCRootFile(opts, cdn, encoding, None, locale)
+				if not root.open():
+					sys.exit(1)
+
+				# Products may share a build version string, so each gets a
+				# directory of its own when several are extracted
+				output_path = os.path.join(opts.output, cdn.build())
+				if len(locales) > 1:
+					output_path = os.path.join(output_path, product)
+				if locales[product] > 1:
+					output_path = os.path.join(output_path, locale)
+
+				files += [ file + (cdn,) for file in cdn_files(fname_db, encoding, root, output_path, store) ]
+
+			if not extract_cdn_files(opts, [ cdn for cdn, encoding in builds.values() ], files, blte, store):
+				sys.exit(1)
+
+		if store:
+			store.report()
+
+		if opts.online:
+			for cdn, encoding in builds.values():
+				cdn.download_report()
+
+	elif opts.mode == 'diff':
+		if not opts.online:
+			parser.error('Diff mode requires --cdn')
+
+		if len(args) != 2:
+			parser.error('Diff mode requires two builds, given as product names (e.g., wow, wowt) or build configuration hashes')
+
+		fname_db = build_cfg.DBFileList(opts)
+		if not fname_db.open():
+			sys.exit(1)
+
+		# Only versions, configuration, encoding and root files are fetched
+		# for the comparison
+		builds = []
+		for arg in args:
+			build_cfg_hash = re.match('^[0-9a-f]{32}$', arg) and arg or None
+			cdn = casc.CDNIndex(opts, not build_cfg_hash and arg or None, build_cfg_hash = build_cfg_hash)
+			if not cdn.open_build():
 				sys.exit(1)
 
 			encoding = casc.CASCEncodingFile(opts, cdn)
@@ -106,31 +313,60 @@ if __name__ == '__main__':
 			if not root.open():
 				sys.exit(1)
 
-			output_path = os.path.join(opts.output, cdn.build())
-			for file_hash, file_name in fname_db.items():
-				file_md5s = root.GetFileHashMD5(file_hash)
-				if not file_md5s:
-					continue
+			builds.append((cdn, encoding, root))
 
-				if len(file_md5s) > 1:
-					print('Duplicate files found (%d) for %s, selecting first one ...' % (len(file_md5s), file_name))
+		(old_cdn, old_encoding, old_root), (new_cdn, new_encoding, new_root) = builds
+		added, removed, changed = new_root.Diff(old_root, fname_db)
+		for status, entries in (('A', added), ('D', removed), ('M', changed)):
+			for file_hash, file_name in sorted(entries, key = lambda entry: entry[1]):
+				print('%s %s' % (status, file_name))
 
-				file_keys = encoding.GetFileKeys(file_md5s[0])
+		print('%s -> %s: %u added, %u removed, %u changed' % (old_cdn.build(), new_cdn.build(), len(added), len(removed), len(changed)))
 
-				if len(file_keys) == 0:
-					continue
+		# Extract the added and changed files of the new build
+		if opts.output:
+			blte = casc.BLTEExtract(opts)
+			store = opts.store and casc.CASCContentStore(opts) or None
 
-				if len(file_keys) > 1:
-					print('More than one key found for %s, selecting first one ...' % file_name)
+			new_cdn.open_archives()
 
-				print('Extracting %s ...' % file_name)
+			output_path = os.path.join(opts.output, new_cdn.build())
+			files = [ file + (new_cdn,) for file in cdn_files(dict(added + changed), new_encoding, new_root, output_path, store) ]
+			if not extract_cdn_files(opts, [ new_cdn ], files, blte, store):
+				sys.exit(1)
 
-				data = cdn.fetch_file(file_keys[0])
-				if not data:
-					print('No data for a given key %s' % file_keys[0].encode('hex'))
-					continue
+			if store:
+				store.report()
+
+			new_cdn.download_report()
 
-				blte.extract_buffer_to_file(data, os.path.join(output_path, file_name.replace('\\', '/')))
+	elif opts.mode == 'watch':
+		opts.online = True
+		if not opts.targets:
+			opts.targets = ','.join([ casc.CDNIndex.PATCH_LIVE, casc.CDNIndex.PATCH_PTR, casc.CDNIndex.PATCH_BETA ])
+
+		# Without a listfile, only the build metadata is prefetched
+		fname_db = None
+		if os.access(opts.dbfile, os.R_OK):
+			fname_db = build_cfg.DBFileList(opts)
+			if not fname_db.open():
+				sys.exit(1)
+
+		casc.CDNWatcher(opts, parse_targets(opts), fname_db).run(opts.watch_interval, opts.watch_polls)
+
+	elif opts.mode == 'proxy':
+		host, separator, port = opts.proxy_listen.rpartition(':')
+		if not separator or not port.isdigit():
+			parser.error('Invalid proxy address %s, expected host:port' % opts.proxy_listen)
+
+		# Upstream CDN hosts come from the patch server, unless --cdn-host is given
+		hosts = opts.cdn_host and [ opts.cdn_host ] or None
+		if not hosts:
+			cdn = casc.CDNIndex(opts)
+			cdn.open_cdns()
+			hosts = cdn.cdn_hosts
+
+		casc.CDNProxy(opts, hosts).serve(host, int(port))
 
 	elif opts.mode == 'unpack':
 		blte = casc.BLTEExtract(opts)
@@ -140,6 +376,10 @@ if __name__ == '__main__':
 				sys.exit(1)
 
 	elif opts.mode == 'extract':
+		# Single file lookups only touch one encoding page
+		if opts.lazy_encoding is None:
+			opts.lazy_encoding = not opts.snapshot
+
 		build = None
 		index = None
 		if not opts.online:
@@ -165,6 +405,7 @@ if __name__ == '__main__':
 
 		keys = []
 		md5s = None
+		output_name = None
 		if 'key:' in args[0]:
 			keys.append(binascii.unhexlify(args[0][4:]))
 			file_name = args[0][4:]
@@ -175,6 +416,20 @@ if __name__ == '__main__':
 				parser.error('No file found with md5sum %s' % args[0][4:])
 			else:
 				file_name = binascii.hexlify(keys[0]).decode('utf-8')
+		elif 'hash:' in args[0]:
+			file_md5s = root.GetFileHashMD5(int(args[0][5:], 16))
+			if len(file_md5s) == 0:
+				parser.error('No file with name hash %s found' % args[0][5:])
+
+			keys = encoding.GetFileKeys(file_md5s[0])
+
+			# Name the output through the listfile, if there is one
+			file_name = args[0][5:]
+			if os.access(opts.dbfile, os.R_OK):
+				fname_db = build_cfg.DBFileList(opts)
+				if fname_db.open():
+					file_name = fname_db.get(int(args[0][5:], 16), file_name)
+					output_name = file_name.replace('\\', '/')
 		else:
 			file_md5s = root.GetFileMD5(args[0])
 			if len(file_md5s) == 0:
@@ -198,7 +453,7 @@ if __name__ == '__main__':
 				parser.error('No file location found for %s' % args[0])
 
 
-			if not blte.extract_file(keys[0], md5s and md5s.decode('hex') or None, None, *file_location):
+			if not blte.extract_file(keys[0], md5s and md5s.decode('hex') or None, output_name, *file_location):
 				sys.exit(1)
 		else:
 			data = build.fetch_file(keys[0])
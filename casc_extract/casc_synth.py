@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Synthetic local CASC installation generator. Writes a small, well formed
+# World of Warcraft style installation (.build.info, build configuration,
+# .idx buckets, data.NNN archives of BLTE encoded files, encoding and root
+# files), and a listfile naming the files, so casc_extract can be run and
+# timed without a game installation or the CDN. Optionally also writes the
+# same build as a patch server and CDN tree (--cdn), to be served with any
+# static HTTP server, e.g., python3 -m http.server.
+
+import optparse, os, sys, struct, zlib, hashlib, random, collections
+
+import jenkins
+
+_BLTE_MAGIC = b'BLTE'
+_DATA_HEADER_LEN = 30
+_ENCODING_PAGE_SIZE = 4096
+_IDX_BUCKETS = 16
+_IDX_HEADER = b'\x07\x00\x00\x00\x04\x05\x09\x1e' + b'\x00' * 8
+_ARCHIVE_INDEX_BLOCK_SIZE = 4096
+_ARCHIVE_INDEX_ENTRY = struct.Struct('>16sii')
+_CDN_PATH = 'tpr/wow'
+
+_LOCALE_ALL = 0xFFFFFFFF
+_LOCALE_ENUS = 0x2
+_LOCALE_DEDE = 0x20
+
+SynthFile = collections.namedtuple( 'SynthFile', [ 'name', 'md5', 'key', 'size' ] )
+
+# BLTE encode data with a chunk table, returns (BLTE data, encoding key)
+def blte_encode(data, chunk_size, compress = True):
+	chunks = []
+	for offset in range(0, max(len(data), 1), chunk_size):
+		chunk = data[offset:offset + chunk_size]
+		if compress:
+			chunks.append((b'Z' + zlib.compress(chunk), len(chunk)))
+		else:
+			chunks.append((b'N' + chunk, len(chunk)))
+
+	table = [ b'\x0f' + struct.pack('>I', len(chunks))[1:] ]
+	for chunk, length in chunks:
+		table.append(struct.pack('>II', len(chunk), length) + hashlib.md5(chunk).digest())
+
+	table = b''.join(table)
+	header = _BLTE_MAGIC + struct.pack('>I', 8 + len(table)) + table
+
+	return header + b''.join([ chunk for chunk, length in chunks ]), hashlib.md5(header).digest()
+
+# Index bucket of a key, the xor of the nibbles of its first 9 bytes
+def idx_bucket(key):
+	value = 0
+	for byte in key[:9]:
+		value ^= byte
+
+	return (value & 0xF) ^ (value >> 4)
+
+class CASCSynth(object):
+	def __init__(self, options):
+		self.options = options
+		self.random = random.Random(options.seed)
+
+		self.data_dir = os.path.join(options.synth_dir, 'Data', 'data')
+		self.config_dir = os.path.join(options.synth_dir, 'Data', 'config')
+
+		self.data_file = None
+		self.data_file_number = -1
+		self.data_file_offset = 0
+		self.data_files = []
+
+		self.idx_entries = collections.defaultdict(list)
+		self.encoding_entries = []
+		self.keys = {}
+		self.files = []
+
+		self.cdn = getattr(options, 'cdn', None)
+		self.archive_file = None
+		self.archive_offset = 0
+		self.archive_entries = []
+		self.archives = []
+
+	# Content with a zlib compression ratio of roughly options.ratio
+	def __content(self, size):
+		block_size = 4096
+		blocks = []
+		for offset in range(0, size, block_size):
+			length = min(block_size, size - offset)
+			random_length = int(length * self.options.ratio)
+			blocks.append(self.random.getrandbits(8 * random_length).to_bytes(random_length, 'little') if random_length else b'')
+			blocks.append(b'\x00' * (length - random_length))
+
+		return b''.join(blocks)
+
+	def __size(self):
+		return max(1, int(self.random.expovariate(1.0 / self.options.file_size)))
+
+	def __write_data(self, key, blte):
+		length = _DATA_HEADER_LEN + len(blte)
+		if not self.data_file or self.data_file_offset + length > self.options.data_file_size * 1024 * 1024:
+			if self.data_file:
+				self.data_file.close()
+
+			self.data_file_number += 1
+			self.data_file_offset = 0
+			path = os.path.join(self.data_dir, 'data.%03u' % self.data_file_number)
+			self.data_file = open(path, 'wb')
+			self.data_files.append(path)
+
+		self.data_file.write(key[::-1] + struct.pack('<I', length) + b'\x00' * 10)
+		self.data_file.write(blte)
+
+		self.idx_entries[idx_bucket(key)].append((key[:9], self.data_file_number, self.data_file_offset, length))
+		self.data_file_offset += length
+
+		if self.cdn:
+			self.__write_archive(key, blte)
+
+	def __cdn_path(self, type, name):
+		path = os.path.join(self.cdn, _CDN_PATH, type, name[0:2], name[2:4])
+		if not os.path.exists(path):
+			os.makedirs(path)
+
+		return os.path.join(path, name)
+
+	# CDN archives hold the BLTE encoded files without local data file
+	# headers, and are named after their index
+	def __write_archive(self, key, blte):
+		if not self.archive_file or self.archive_offset + len(blte) > self.options.data_file_size * 1024 * 1024:
+			self.__close_archive()
+
+			self.archive_file = open(os.path.join(self.cdn, 'archive.tmp'), 'wb')
+			self.archive_offset = 0
+			self.archive_entries = []
+
+		self.archive_file.write(blte)
+		self.archive_entries.append((key, len(blte), self.archive_offset))
+		self.archive_offset += len(blte)
+
+	# Archive index entries fill 4096 byte blocks, followed by the entry count
+	def __close_archive(self):
+		if not self.archive_file:
+			return
+
+		self.archive_file.close()
+		self.archive_file = None
+
+		per_block = _ARCHIVE_INDEX_BLOCK_SIZE // _ARCHIVE_INDEX_ENTRY.size
+		entries = sorted(self.archive_entries)
+		blocks = []
+		for idx in range(0, len(entries), per_block):
+			block = b''.join([ _ARCHIVE_INDEX_ENTRY.pack(*entry) for entry in entries[idx:idx + per_block] ])
+			blocks.append(block + b'\x00' * (_ARCHIVE_INDEX_BLOCK_SIZE - len(block)))
+
+		index = b''.join(blocks) + struct.pack('<i', len(entries)) + b'\x00' * 8
+		name = hashlib.md5(index).hexdigest()
+
+		os.replace(os.path.join(self.cdn, 'archive.tmp'), self.__cdn_path('data', name))
+		with open(self.__cdn_path('data', '%s.index' % name), 'wb') as f:
+			f.write(index)
+
+		self.archives.append(name)
+
+	def __write_config(self, data):
+		name = hashlib.md5(data).hexdigest()
+		with open(self.__cdn_path('config', name), 'wb') as f:
+			f.write(data)
+
+		return name
+
+	def __write_cdn(self, build_cfg, encoding_blte, encoding_key):
+		self.__close_archive()
+
+		# The encoding file is fetched on its own, not from an archive
+		with open(self.__cdn_path('data', encoding_key.hex()), 'wb') as f:
+			f.write(encoding_blte)
+
+		build_cfg_hash = self.__write_config(build_cfg + ('build-name = WOW-%upatch0.0.0_Synth\n' % self.options.seed).encode('utf-8'))
+		cdn_cfg_hash = self.__write_config(('archives = %s\n' % ' '.join(self.archives)).encode('utf-8'))
+
+		for product in self.options.products.split(','):
+			product_dir = os.path.join(self.cdn, product)
+			if not os.path.exists(product_dir):
+				os.makedirs(product_dir)
+
+			with open(os.path.join(product_dir, 'versions'), 'w') as f:
+				f.write('Region!STRING:0|BuildConfig!HEX:16|CDNConfig!HEX:16|KeyRing!HEX:16|BuildId!DEC:4|VersionsName!String:0|ProductConfig!HEX:16\n')
+				f.write('us|%s|%s||%u|0.0.0.%u|\n' % (build_cfg_hash, cdn_cfg_hash, self.options.seed, self.options.seed))
+
+			with open(os.path.join(product_dir, 'cdns'), 'w') as f:
+				f.write('Name!STRING:0|Path!STRING:0|Hosts!STRING:0|Servers!STRING:0|ConfigPath!STRING:0\n')
+				f.write('us|%s|%s||\n' % (_CDN_PATH, self.options.cdn_host))
+
+	# Store data in the archives, returns (content md5, encoding key). Files
+	# with the same contents (e.g., tiny files) share a single stored copy and
+	# encoding entry, as they do in real builds.
+	def __add(self, data, compress = True):
+		md5s = hashlib.md5(data).digest()
+		if md5s in self.keys:
+			return md5s, self.keys[md5s]
+
+		blte, key = blte_encode(data, self.options.chunk_size, compress)
+
+		self.__write_data(key, blte)
+		self.encoding_entries.append((md5s, len(data), key))
+		self.keys[md5s] = key
+
+		return md5s, key
+
+	def __write_idx(self):
+		for bucket in range(0, _IDX_BUCKETS):
+			entries = sorted(self.idx_entries[bucket])
+			body = b''.join([ key + struct.pack('>BI', data_file >> 2, ((data_file & 3) << 30) | offset) + struct.pack('<I', size)
+				for key, data_file, offset, size in entries ])
+
+			header = struct.pack('<I', len(_IDX_HEADER)) + b'\x00' * 4 + _IDX_HEADER
+			header += b'\x00' * (((8 + len(_IDX_HEADER) + 0x0F) & 0xFFFFFFF0) - len(header))
+
+			with open(os.path.join(self.data_dir, '%02x%08x.idx' % (bucket, 1)), 'wb') as f:
+				f.write(header + struct.pack('<II', len(body), 0) + body)
+
+	def __encoding(self):
+		pages = []
+		first_entries = []
+		page = []
+		page_len = 0
+		for md5s, size, key in sorted(self.encoding_entries):
+			entry = struct.pack('<H', 1) + struct.pack('>I', size) + md5s + key
+			# Pages end with a zero key count
+			if page_len + len(entry) + 2 > _ENCODING_PAGE_SIZE:
+				pages.append(b''.join(page) + b'\x00' * (_ENCODING_PAGE_SIZE - page_len))
+				page = []
+				page_len = 0
+
+			if len(page) == 0:
+				first_entries.append(md5s)
+
+			page.append(entry)
+			page_len += len(entry)
+
+		pages.append(b''.join(page) + b'\x00' * (_ENCODING_PAGE_SIZE - page_len))
+
+		header = b'EN' + struct.pack('>BBBHHIIBI', 1, 16, 16, 4, 4, len(pages), 0, 0, 0)
+		table = b''.join([ first + hashlib.md5(page).digest() for first, page in zip(first_entries, pages) ])
+
+		return header + table + b''.join(pages)
+
+	def __root(self, entries):
+		blocks = []
+		# The listed files go into an enUS block, a quarter of them also get a
+		# deDE variant that enUS extraction skips
+		for flags, block_entries in ((_LOCALE_ENUS, entries), (_LOCALE_DEDE, entries[:len(entries) // 4])):
+			blocks.append(struct.pack('<iII', len(block_entries), 0, flags))
+			blocks.append(b'\x00' * 4 * len(block_entries))
+			for md5s, name_hash in block_entries:
+				blocks.append(md5s + struct.pack('<Q', name_hash))
+
+		return b''.join(blocks)
+
+	def generate(self):
+		for path in (self.data_dir, self.config_dir, self.cdn):
+			if path and not os.path.exists(path):
+				os.makedirs(path)
+
+		names = [ 'DBFilesClient\\Synth%06u.db2' % idx for idx in range(0, self.options.files) ]
+		unlisted = [ 'Synth\\Unlisted%06u.bin' % idx for idx in range(0, self.options.unlisted) ]
+
+		root_entries = []
+		hashes = jenkins.hashlittle2_many([ name.upper() for name in names + unlisted ])
+		for idx, (name, name_hash) in enumerate(zip(names + unlisted, hashes)):
+			data = self.__content(self.__size())
+			md5s, key = self.__add(data)
+			root_entries.append((md5s, name_hash))
+			if idx < len(names):
+				self.files.append(SynthFile(name, md5s, key, len(data)))
+
+		root = self.__root(root_entries)
+		root_md5, root_key = self.__add(root)
+
+		encoding = self.__encoding()
+		encoding_blte, encoding_key = blte_encode(encoding, self.options.chunk_size)
+		self.__write_data(encoding_key, encoding_blte)
+
+		self.data_file.close()
+		self.__write_idx()
+
+		build_cfg = ('root = %s\nencoding = %s %s\n' % (
+			root_md5.hex(), hashlib.md5(encoding).hexdigest(), encoding_key.hex())).encode('utf-8')
+		build_cfg_hash = hashlib.md5(build_cfg).hexdigest()
+		build_cfg_dir = os.path.join(self.config_dir, build_cfg_hash[0:2], build_cfg_hash[2:4])
+		if not os.path.exists(build_cfg_dir):
+			os.makedirs(build_cfg_dir)
+
+		with open(os.path.join(build_cfg_dir, build_cfg_hash), 'wb') as f:
+			f.write(build_cfg)
+
+		if self.cdn:
+			self.__write_cdn(build_cfg, encoding_blte, encoding_key)
+
+		with open(os.path.join(self.options.synth_dir, '.build.info'), 'w') as f:
+			f.write('Branch!STRING:0|Active!DEC:1|Build Key!HEX:16|CDN Key!HEX:16|Install Key!HEX:16|IM Size!DEC:4|CDN Path!STRING:0|CDN Hosts!STRING:0|Tags!STRING:0|Armadillo!STRING:0|Last Activated!STRING:0|Version!STRING:0\n')
+			f.write('us|1|%s|%s|||tpr/wow|127.0.0.1||||0.0.0.%u\n' % (build_cfg_hash, '0' * 32, self.options.seed))
+
+		# The encoding file is fetched from the CDN, place its BLTE encoded
+		# copy in the cache so casc_extract decodes it from there instead
+		if self.options.cache:
+			cache_data = os.path.join(self.options.cache, 'data')
+			if not os.path.exists(cache_data):
+				os.makedirs(cache_data)
+
+			with open(os.path.join(cache_data, encoding_key.hex()), 'wb') as f:
+				f.write(encoding_blte)
+
+		with open(os.path.join(self.options.synth_dir, 'listfile'), 'w') as f:
+			for name in names:
+				f.write('%s\n' % name.replace('\\', '/'))
+
+		return {
+			'files': len(names),
+			'unlisted': len(unlisted),
+			'data_files': len(self.data_files),
+			'data_bytes': sum([ os.path.getsize(path) for path in self.data_files ]),
+			'content_bytes': sum([ file.size for file in self.files ]),
+			'encoding_bytes': len(encoding),
+			'root_bytes': len(root),
+		}
+
+parser = optparse.OptionParser( usage = '%prog [options]', conflict_handler = 'resolve' )
+parser.add_option( '-d', '--datadir', type = 'string', dest = 'synth_dir', default = 'synth',
+		help = 'Output directory for the synthetic installation [default synth]' )
+parser.add_option( '-x', '--cache', type = 'string', dest = 'cache', default = 'cache',
+		help = 'casc_extract cache directory to place the encoding file into [default cache]' )
+parser.add_option( '-n', '--files', type = 'int', dest = 'files', default = 1000,
+		help = 'Number of listed files [default 1000]' )
+parser.add_option( '--unlisted', type = 'int', dest = 'unlisted', default = 0,
+		help = 'Number of files in the root file, but not in the listfile [default 0]' )
+parser.add_option( '--file-size', type = 'int', dest = 'file_size', default = 65536,
+		help = 'Mean file size in bytes, sizes are exponentially distributed [default 65536]' )
+parser.add_option( '--chunk-size', type = 'int', dest = 'chunk_size', default = 65536,
+		help = 'BLTE chunk size in bytes [default 65536]' )
+parser.add_option( '--ratio', type = 'float', dest = 'ratio', default = 0.5,
+		help = 'Approximate compression ratio of the file contents, 1.0 is incompressible [default 0.5]' )
+parser.add_option( '--data-file-size', type = 'int', dest = 'data_file_size', default = 256,
+		help = 'Maximum data.NNN archive size in megabytes [default 256]' )
+parser.add_option( '--seed', type = 'int', dest = 'seed', default = 1,
+		help = 'Random seed [default 1]' )
+parser.add_option( '--cdn', type = 'string', dest = 'cdn', default = None,
+		help = 'Also write the build as a patch server and CDN tree into this directory, for casc_extract --patch-url' )
+parser.add_option( '--cdn-host', type = 'string', dest = 'cdn_host', default = '127.0.0.1:8000',
+		help = 'host:port the CDN tree is served from [default 127.0.0.1:8000]' )
+parser.add_option( '--products', type = 'string', dest = 'products', default = 'wow',
+		help = 'Comma separated list of patch server products to list the build for [default wow]' )
+
+if __name__ == '__main__':
+	(opts, args) = parser.parse_args()
+	opts.parser = parser
+
+	if opts.ratio <= 0 or opts.ratio > 1:
+		parser.error('Compression ratio must be in (0, 1]')
+
+	summary = CASCSynth(opts).generate()
+	print('Generated %(files)u listed and %(unlisted)u unlisted files, %(content_bytes)u bytes of content in %(data_files)u data files (%(data_bytes)u bytes)' % summary)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# CDN download tests. A synthetic build (casc_synth --cdn) is served by a
+# local http.server, which can also cut a response short once, or leave out
+# a host entirely. Covers fetching a build and its files, resumed downloads,
+# host failover, conditional polls of the build watcher, and single byte
+# ranges through the caching proxy. Run in this directory with
+#
+#   python3 -m unittest casc_test
+
+import os, io, re, shutil, socket, tempfile, threading, unittest, contextlib, hashlib
+import http.client, http.server, functools
+
+import casc, casc_extract, casc_synth
+
+# Static file handler of the synthetic CDN tree, with single range requests
+# (which SimpleHTTPRequestHandler does not do), and responses that can be
+# cut short once after a number of bytes
+class CDNTestHandler(http.server.SimpleHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		with self.server.lock:
+			self.server.requests.append((self.path, self.headers.get('Range')))
+			cut = self.server.cut.pop(self.path, None)
+
+		mobj = re.match('^bytes=([0-9]+)-([0-9]*)$', self.headers.get('Range') or '')
+		if not mobj and cut is None:
+			http.server.SimpleHTTPRequestHandler.do_GET(self)
+			return
+
+		path = self.translate_path(self.path)
+		if not os.path.isfile(path):
+			self.send_error(404)
+			return
+
+		with open(path, 'rb') as f:
+			data = f.read()
+
+		first, last = 0, len(data) - 1
+		if mobj:
+			first = int(mobj.group(1))
+			if mobj.group(2) != '':
+				last = min(int(mobj.group(2)), len(data) - 1)
+
+		if first >= len(data):
+			self.send_error(416)
+			return
+
+		self.send_response(mobj and 206 or 200)
+		if mobj:
+			self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last, len(data)))
+		self.send_header('Content-Length', str(last - first + 1))
+		self.end_headers()
+
+		body = data[first:last + 1]
+		if cut is not None:
+			self.wfile.write(body[:cut])
+			self.wfile.flush()
+			self.close_connection = True
+			self.connection.shutdown(socket.SHUT_RDWR)
+			return
+
+		self.wfile.write(body)
+
+def _serve(handler):
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+	server.daemon_threads = True
+	threading.Thread(target = server.serve_forever, daemon = True).start()
+
+	return server, '127.0.0.1:%u' % server.server_address[1]
+
+# host:port with nothing listening on it
+def _dead_host():
+	with socket.socket() as s:
+		s.bind(('127.0.0.1', 0))
+		return '127.0.0.1:%u' % s.getsockname()[1]
+
+class CDNTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.dir = tempfile.mkdtemp(prefix = 'casc_test')
+		cdn = os.path.join(cls.dir, 'cdn')
+
+		cls.server, cls.host = _serve(functools.partial(CDNTestHandler, directory = cdn))
+		cls.server.lock = threading.Lock()
+		cls.server.requests = []
+		cls.server.cut = {}
+
+		options, args = casc_synth.parser.parse_args([ '-d', os.path.join(cls.dir, 'synth'), '-x', os.path.join(cls.dir, 'synth_cache'),
+			'-n', '20', '--file-size', '20000', '--chunk-size', '4096', '--cdn', cdn, '--cdn-host', cls.host ])
+		options.parser = casc_synth.parser
+		cls.synth = casc_synth.CASCSynth(options)
+		cls.synth.generate()
+
+		# The largest file of the CDN data directory, and its contents
+		data_dir = os.path.join(cdn, *casc_synth._CDN_PATH.split('/'), 'data')
+		paths = [ os.path.join(root, file) for root, dirs, files in os.walk(data_dir) for file in files ]
+		cls.data_path = max(paths, key = os.path.getsize)
+
+		cls.data_url = '/' + os.path.relpath(cls.data_path, cdn).replace(os.sep, '/')
+		with open(cls.data_path, 'rb') as f:
+			cls.data = f.read()
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
+		shutil.rmtree(cls.dir)
+
+	def options(self, *args):
+		options, rest = casc_extract.parser.parse_args([ '--cdn', '--patch-url', 'http://%s' % self.host,
+			'-x', tempfile.mkdtemp(dir = self.dir) ] + list(args))
+		options.parser = casc_extract.parser
+
+		return options
+
+	def requests(self, path):
+		with self.server.lock:
+			return [ value for request, value in self.server.requests if request == path ]
+
+	def test_fetch_build(self):
+		options = self.options()
+		with contextlib.redirect_stdout(io.StringIO()):
+			cdn = casc.CDNIndex(options, 'wow')
+			self.assertTrue(cdn.open())
+
+			encoding = casc.CASCEncodingFile(options, cdn)
+			self.assertTrue(encoding.open())
+
+			root = casc.CASCRootFile(options, cdn, encoding, None)
+			self.assertTrue(root.open())
+
+			blte = casc.BLTEExtract(options)
+			for file in self.synth.files[:5]:
+				md5s = root.GetFileMD5(file.name)
+				self.assertEqual(list(md5s), [ file.md5 ])
+
+				data = blte.extract_buffer(cdn.fetch_file(encoding.GetFileKeys(file.md5)[0]))
+				self.assertEqual(hashlib.md5(data).digest(), file.md5)
+
+	def test_resume(self):
+		downloader = casc.CDNDownloader(self.options(), [ self.host ])
+		with self.server.lock:
+			self.server.cut[self.data_url] = len(self.data) // 2
+
+		self.assertEqual(downloader.fetch(self.data_url), self.data)
+		self.assertEqual(downloader.resumes, 1)
+		self.assertEqual(self.requests(self.data_url)[-1], 'bytes=%d-' % (len(self.data) // 2))
+
+	def test_resume_range(self):
+		downloader = casc.CDNDownloader(self.options(), [ self.host ])
+		with self.server.lock:
+			self.server.cut[self.data_url] = 100
+
+		self.assertEqual(downloader.fetch(self.data_url, { 'Range': 'bytes=50-549' }), self.data[50:550])
+		self.assertEqual(self.requests(self.data_url)[-1], 'bytes=150-549')
+
+	def test_one_byte_range(self):
+		downloader = casc.CDNDownloader(self.options(), [ self.host ])
+
+		self.assertEqual(downloader.fetch(self.data_url, { 'Range': 'bytes=0-0' }), self.data[:1])
+		self.assertEqual(downloader.fetch(self.data_url, { 'Range': 'bytes=7-7' }), self.data[7:8])
+
+	def test_failover(self):
+		downloader = casc.CDNDownloader(self.options(), [ _dead_host(), self.host ])
+
+		self.assertEqual(downloader.fetch(self.data_url), self.data)
+		self.assertEqual(downloader.host_idx, 1)
+
+	def test_failover_exhausted(self):
+		downloader = casc.CDNDownloader(self.options('--cdn-retries', '1'), [ _dead_host() ])
+
+		with self.assertRaises(IOError):
+			downloader.fetch(self.data_url)
+
+	def test_watch_not_modified(self):
+		options = self.options()
+		watcher = casc.CDNWatcher(options, [ ('wow', 'en_US') ])
+		with contextlib.redirect_stdout(io.StringIO()):
+			watcher.check()
+			watcher.collect(True)
+			self.assertEqual(watcher.prefetched, 1)
+
+			# The versions file did not change, so the poll is answered with a 304
+			watcher.check()
+			watcher.collect(True)
+			watcher.executor.shutdown()
+
+		self.assertEqual(watcher.polls, 2)
+		self.assertEqual(watcher.not_modified, 1)
+		self.assertEqual(watcher.prefetched, 1)
+		self.assertIn('If-Modified-Since', watcher.validators['wow'])
+
+	def test_proxy_ranges(self):
+		options = self.options('--proxy-store', tempfile.mkdtemp(dir = self.dir))
+		proxy = casc.CDNProxy(options, [ self.host ])
+		server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), casc.CDNProxyHandler)
+		server.daemon_threads = True
+		server.proxy = proxy
+		threading.Thread(target = server.serve_forever, daemon = True).start()
+
+		try:
+			connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout = 5)
+			for first, last in ((0, 0), (0, 0), (10, 19)):
+				connection.request('GET', self.data_url, headers = { 'Range': 'bytes=%d-%d' % (first, last) })
+				response = connection.getresponse()
+
+				self.assertEqual(response.status, 206)
+				self.assertTrue(response.headers['Content-Range'].startswith('bytes %d-%d/' % (first, last)))
+				self.assertEqual(response.read(), self.data[first:last + 1])
+
+			connection.close()
+		finally:
+			server.shutdown()
+			server.server_close()
+
+		# The repeated one byte range is served from the store
+		self.assertEqual(proxy.misses, 2)
+		self.assertEqual(proxy.hits, 1)
+
+if __name__ == '__main__':
+	unittest.main()
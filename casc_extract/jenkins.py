@@ -73,3 +73,172 @@ def hashlittle2(data, initval = 0, initval2 = 0):
 def hashlittle(data, initval=0):
 	c, b = hashlittle2(data, initval, 0)
 	return c
+
+# Bulk hashing, returns the (c << 32) | b 64-bit hash values of all names in
+# an array('Q'). Names of equal length are hashed lane-parallel with NumPy if
+# it is available, otherwise a stdlib path working on whole 32-bit words is
+# used. Both produce results identical to hashlittle2, names with characters
+# past latin-1 are hashed with hashlittle2 itself.
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+import sys, array, struct
+
+_WORDS = struct.Struct('<III')
+
+# Names as bytes, or None for names hashlittle2_many() leaves to hashlittle2
+def _bytes(name):
+	if isinstance(name, (bytes, bytearray)):
+		return bytes(name)
+
+	# hashlittle2 hashes characters by their ordinal, which latin-1 preserves.
+	# Wider characters spill into the neighboring bytes in hashlittle2, so
+	# names with them can not be hashed as bytes.
+	try:
+		return name.encode('latin-1')
+	except UnicodeEncodeError:
+		return None
+
+# mix() and final() with only the masking needed to stay within 32 bits
+def _mix_words(a, b, c):
+	M = 0xffffffff
+	a = (a - c) & M; a ^= ((c << 4) | (c >> 28)) & M;  c = (c + b) & M
+	b = (b - a) & M; b ^= ((a << 6) | (a >> 26)) & M;  a = (a + c) & M
+	c = (c - b) & M; c ^= ((b << 8) | (b >> 24)) & M;  b = (b + a) & M
+	a = (a - c) & M; a ^= ((c << 16) | (c >> 16)) & M; c = (c + b) & M
+	b = (b - a) & M; b ^= ((a << 19) | (a >> 13)) & M; a = (a + c) & M
+	c = (c - b) & M; c ^= ((b << 4) | (b >> 28)) & M;  b = (b + a) & M
+	return a, b, c
+
+def _final_words(a, b, c):
+	M = 0xffffffff
+	c ^= b; c = (c - ((b << 14) | (b >> 18))) & M
+	a ^= c; a = (a - ((c << 11) | (c >> 21))) & M
+	b ^= a; b = (b - ((a << 25) | (a >> 7))) & M
+	c ^= b; c = (c - ((b << 16) | (b >> 16))) & M
+	a ^= c; a = (a - ((c << 4) | (c >> 28))) & M
+	b ^= a; b = (b - ((a << 14) | (a >> 18))) & M
+	c ^= b; c = (c - ((b << 24) | (b >> 8))) & M
+	return a, b, c
+
+def _hashlittle2_words(data, initval = 0, initval2 = 0):
+	length = len(data)
+
+	a = b = c = (0xdeadbeef + length + initval) & 0xffffffff
+	c = (c + initval2) & 0xffffffff
+	if length == 0:
+		return c, b
+
+	# Blocks are zero padded, the final block (1-12 bytes) is mixed with final()
+	data += bytes(-length % 12)
+	n_blocks = len(data) // 12
+	for block in range(0, n_blocks - 1):
+		w0, w1, w2 = _WORDS.unpack_from(data, block * 12)
+		a, b, c = _mix_words((a + w0) & 0xffffffff, (b + w1) & 0xffffffff, (c + w2) & 0xffffffff)
+
+	w0, w1, w2 = _WORDS.unpack_from(data, (n_blocks - 1) * 12)
+	a, b, c = _final_words((a + w0) & 0xffffffff, (b + w1) & 0xffffffff, (c + w2) & 0xffffffff)
+
+	return c, b
+
+def _rot_np(x, k):
+	return (x << numpy.uint32(k)) | (x >> numpy.uint32(32 - k))
+
+def _mix_np(a, b, c):
+	a -= c; a ^= _rot_np(c, 4);  c += b
+	b -= a; b ^= _rot_np(a, 6);  a += c
+	c -= b; c ^= _rot_np(b, 8);  b += a
+	a -= c; a ^= _rot_np(c, 16); c += b
+	b -= a; b ^= _rot_np(a, 19); a += c
+	c -= b; c ^= _rot_np(b, 4);  b += a
+
+def _final_np(a, b, c):
+	c ^= b; c -= _rot_np(b, 14)
+	a ^= c; a -= _rot_np(c, 11)
+	b ^= a; b -= _rot_np(a, 25)
+	c ^= b; c -= _rot_np(b, 16)
+	a ^= c; a -= _rot_np(c, 4)
+	b ^= a; b -= _rot_np(a, 14)
+	c ^= b; c -= _rot_np(b, 24)
+
+# Hash a group of equal length names, one name per lane
+def _hashlittle2_np(names, length, initval, initval2):
+	n_blocks = max(1, (length + 11) // 12)
+	buf = numpy.zeros((len(names), n_blocks * 12), dtype = numpy.uint8)
+	if length > 0:
+		buf[:, :length] = numpy.frombuffer(b''.join(names), dtype = numpy.uint8).reshape(len(names), length)
+	words = buf.view('<u4').astype(numpy.uint32)
+
+	a = numpy.full(len(names), (0xdeadbeef + length + initval) & 0xffffffff, dtype = numpy.uint32)
+	b = a.copy()
+	c = a + numpy.uint32(initval2 & 0xffffffff)
+	if length > 0:
+		for block in range(0, n_blocks):
+			a += words[:, block * 3]
+			b += words[:, block * 3 + 1]
+			c += words[:, block * 3 + 2]
+			if block < n_blocks - 1:
+				_mix_np(a, b, c)
+
+		_final_np(a, b, c)
+
+	return (c.astype(numpy.uint64) << numpy.uint64(32)) | b.astype(numpy.uint64)
+
+# Names of all lengths up to a few blocks, including full final blocks, and
+# bytes with the high bit set
+_CHECK_NAMES = [ bytes([ (idx * 37 + length) & 0xff for idx in range(0, length) ]) for length in range(0, 40) ]
+
+# The NumPy path is checked against hashlittle2 once, before it is first
+# used, and left unused if the results differ (e.g., with a NumPy version
+# that handles uint32 overflow differently)
+_numpy_checked = False
+
+def _numpy_usable():
+	global numpy, _numpy_checked
+
+	if numpy is None or _numpy_checked:
+		return numpy is not None
+
+	_numpy_checked = True
+	for initval, initval2 in ((0, 0), (0x12345678, 0x9abcdef0)):
+		with numpy.errstate(over = 'ignore'):
+			bulk = [ int(_hashlittle2_np([ name ], len(name), initval, initval2)[0]) for name in _CHECK_NAMES ]
+
+		scalar = [ hashlittle2(name.decode('latin-1'), initval, initval2) for name in _CHECK_NAMES ]
+		if bulk != [ (c << 32) | b for c, b in scalar ]:
+			sys.stderr.write('NumPy Jenkins hashes differ from hashlittle2, hashing without NumPy\n')
+			numpy = None
+			break
+
+	return numpy is not None
+
+def hashlittle2_many(names, initval = 0, initval2 = 0):
+	data = [ _bytes(name) for name in names ]
+
+	hashes = array.array('Q', bytes(8 * len(data)))
+	for idx, name in enumerate(data):
+		if name is None:
+			c, b = hashlittle2(names[idx], initval, initval2)
+			hashes[idx] = (c << 32) | b
+
+	if not _numpy_usable():
+		for idx, name in enumerate(data):
+			if name is not None:
+				c, b = _hashlittle2_words(name, initval, initval2)
+				hashes[idx] = (c << 32) | b
+
+		return hashes
+
+	groups = {}
+	for idx, name in enumerate(data):
+		if name is not None:
+			groups.setdefault(len(name), []).append(idx)
+
+	output = numpy.frombuffer(hashes, dtype = numpy.uint64)
+	with numpy.errstate(over = 'ignore'):
+		for length, indices in groups.items():
+			output[indices] = _hashlittle2_np([ data[idx] for idx in indices ], length, initval, initval2)
+
+	return hashes
@@ -35,7 +35,7 @@ class DBCFileIterator:
         return self._decorator(self._parser, dbc_id, data)
 
 class DBCFile:
-    def __init__(self, options, filename, wdb_file = None):
+    def __init__(self, options, filename, wdb_file = None, data = None):
 
         self.data_parser = None
         self.data_class = None
@@ -46,23 +46,41 @@ class DBCFile:
         self.options = options
         self.file_name = filename
 
-        self.parser = self.__parser(filename, wdb_file)
+        # Tables can also come from an in memory source (e.g., a CASC build)
+        # instead of the file system. The magic is probed first, so tables
+        # in formats without a parser are not decoded in full.
+        source = getattr(options, 'source', None)
+        if data is None and source:
+            magic = source.header(os.path.basename(filename), 4)
+            if magic is not None and not _PARSERS.get(magic, None):
+                self.magic = magic
+            else:
+                data = source.get(os.path.basename(filename))
+
+        if self.magic is None:
+            self.parser = self.__parser(filename, wdb_file, data)
+        else:
+            self.parser = None
+
+    def __parser(self, file_name, wdb_file = None, data = None):
+        if data is not None:
+            self.magic = bytes(memoryview(data)[:4])
+        else:
+            f = None
+            # See that file exists already
+            normalized_path = os.path.abspath(file_name)
+            for i in ['', '.db2', '.dbc', '.adb']:
+                if os.access(normalized_path + i, os.R_OK):
+                    f = open(normalized_path + i, 'rb')
+                    break
 
-    def __parser(self, file_name, wdb_file = None):
-        f = None
-        # See that file exists already
-        normalized_path = os.path.abspath(file_name)
-        for i in ['', '.db2', '.dbc', '.adb']:
-            if os.access(normalized_path + i, os.R_OK):
-                f = open(normalized_path + i, 'rb')
-                break
+            if not f:
+                logging.error('Unable to find DBC file through %s', file_name)
+                sys.exit(1)
 
-        if not f:
-            logging.error('Unable to find DBC file through %s', file_name)
-            sys.exit(1)
+            self.magic = f.read(4)
+            f.close()
 
-        self.magic = f.read(4)
-        f.close()
         parser = _PARSERS.get(self.magic, None)
         if not parser:
             return None
@@ -74,7 +92,7 @@ class DBCFile:
         # parse the entries
         if b'WCH' in self.magic:
             if wdb_file:
-                parser_obj = parser(self.options, wdb_file, file_name)
+                parser_obj = parser(self.options, wdb_file, file_name, data)
             else:
                 if self.options.type == 'view' and not self.options.wdb_file:
                     logging.error('Unable to parse WCH file %s without --wdbfile parameter',
@@ -87,9 +105,9 @@ class DBCFile:
                 if not wdb_parser.open():
                     return None
 
-                parser_obj = parser(self.options, wdb_parser, file_name)
+                parser_obj = parser(self.options, wdb_parser, file_name, data)
         else:
-            parser_obj = parser(self.options, file_name)
+            parser_obj = parser(self.options, file_name, data)
 
         return parser_obj
 
@@ -1,4 +1,4 @@
-import os, io, struct, sys, logging, math, re
+import os, io, struct, sys, logging, math, re, mmap
 
 import dbc.fmt
 
@@ -18,11 +18,24 @@ _FIELD_DATA  = struct.Struct('HH')
 X_ID_BLOCK = 0x04
 X_OFFSET_MAP = 0x01
 
+# Parsers need slicing and find() on their data. Bytes like objects that
+# support those are used as is, views that cover a whole bytes like object are
+# unwrapped to it, and anything else is copied.
+def _buffer(data):
+    if isinstance(data, (bytes, bytearray, mmap.mmap)):
+        return data
+
+    view = memoryview(data)
+    if view.contiguous and isinstance(view.obj, (bytes, bytearray, mmap.mmap)) and view.nbytes == len(view.obj):
+        return view.obj
+
+    return view.tobytes()
+
 class DBCParserBase:
     def is_magic(self):
         raise Exception()
 
-    def __init__(self, options, fname):
+    def __init__(self, options, fname, data = None):
         self.file_name_ = None
         self.options = options
 
@@ -47,6 +60,14 @@ class DBCParserBase:
 
         self.id_format_str = None
 
+        # In memory data (e.g., extracted from a CASC build), the file name
+        # only names the table
+        self.buffer_ = None
+        if data is not None:
+            self.file_name_ = fname
+            self.buffer_ = _buffer(data)
+            return
+
         # See that file exists already
         normalized_path = os.path.abspath(fname)
         for i in ['', '.db2', '.dbc', '.adb']:
@@ -285,12 +306,15 @@ class DBCParserBase:
         return True
 
     def open(self):
-        if self.data:
+        if self.data is not None:
             return True
 
-        f = io.open(self.file_name_, mode = 'rb')
-        self.data = f.read()
-        f.close()
+        if self.buffer_ is not None:
+            self.data = self.buffer_
+        else:
+            f = io.open(self.file_name_, mode = 'rb')
+            self.data = f.read()
+            f.close()
 
         if not self.parse_header():
             return False
@@ -475,8 +499,8 @@ class InlineStringRecordParser:
         return full_data
 
 class LegionWDBParser(DBCParserBase):
-    def __init__(self, options, fname):
-        super().__init__(options, fname)
+    def __init__(self, options, fname, data = None):
+        super().__init__(options, fname, data)
 
         self.id_block_offset = 0
         self.clone_block_offset = 0
@@ -773,8 +797,8 @@ class LegionWCHParser(LegionWDBParser):
 
     def is_magic(self): return self.magic == b'WCH5' or self.magic == b'WCH6'
 
-    def __init__(self, options, wdb_parser, fname):
-        super().__init__(options, fname)
+    def __init__(self, options, wdb_parser, fname, data = None):
+        super().__init__(options, fname, data)
 
         self.clone_segment_size = 0 # WCH files never have a clone segment
         self.wdb_parser = wdb_parser
@@ -886,8 +910,8 @@ class LegionWCHParser(LegionWDBParser):
 class WCH7Parser(LegionWCHParser):
     def is_magic(self): return self.magic == b'WCH7'
 
-    def __init__(self, options, wdb_parser, fname):
-        super().__init__(options, wdb_parser, fname)
+    def __init__(self, options, wdb_parser, fname, data = None):
+        super().__init__(options, wdb_parser, fname, data)
 
     # Completely rewrite WCH7 parser, since the base header gained a new field
     def parse_header(self):
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import argparse, sys, os, glob, re, datetime, signal, logging
+import argparse, sys, os, glob, re, datetime, signal, logging, shlex, contextlib
 import dbc.generator, dbc.db, dbc.parser, dbc.file, dbc.config
 
 
@@ -49,6 +49,10 @@ parser.add_argument("--cache",       dest = "cache_dir",    default = '',
                     help = "World of Warcraft Cache directory.")
 parser.add_argument("--wdbfile",     dest = "wdb_file",     default = '',
                     help = "Path to WDB file to determine attributes when using 'view' type on adb files")
+parser.add_argument("--casc",        dest = "casc_dir",     default = '',
+                    help = "Read client data tables directly from a World of Warcraft installation directory")
+parser.add_argument("--casc-options", dest = "casc_options", default = '',
+                    help = "casc_extract options to open the installation with, e.g., \"-x cache --cdn\"")
 parser.add_argument("args", metavar = "ARGS", type = str, nargs = argparse.REMAINDER)
 options = parser.parse_args()
 
@@ -73,6 +77,23 @@ if options.cache_dir and not os.path.isdir(options.cache_dir):
 if options.debug:
     logging.getLogger().setLevel(logging.DEBUG)
 
+# Tables are decoded from the CASC installation into memory, instead of read
+# from extracted files in --path
+options.source = None
+if options.casc_dir or options.casc_options:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'casc_extract'))
+    import casc_extract, casc
+
+    casc_options, casc_args = casc_extract.parser.parse_args(shlex.split(options.casc_options) +
+            (options.casc_dir and [ '-d', options.casc_dir ] or []))
+    casc_options.parser = casc_extract.parser
+
+    # Keep casc_extract progress output out of the generated output
+    options.source = casc.CASCFileSource(casc_options)
+    with contextlib.redirect_stdout(sys.stderr):
+        if not options.source.open():
+            sys.exit(1)
+
 # Initialize the base model for dbc.data, creating the relevant classes for all patch levels
 # up to options.build
 dbc.data.initialize_data_model(options, dbc.data)